@@ -0,0 +1,256 @@
+# coding: utf-8
+
+"""
+Benchmarks of the selectors on synthetic events with json baselines.
+
+Usage:
+
+    python -m httcp.benchmark.suite [--update] [--baselines PATH] [--tolerance 0.3] ...
+
+Each benchmark is timed per chunk size and multiplicity scale, and the best time out of a few
+repetitions is stored in microseconds per event. Benchmarks depending on the size of the trigger
+menu (:py:attr:`MENU_BENCHMARKS`) are additionally timed for the full trigger lists of the menus
+given by ``--menus``, e.g. the 2017 and Run-3 menus. Without ``--update``, the timings are compared to
+the baselines and the process exits with a non-zero code when any of them is slower by more than
+the relative tolerance or has no baseline. Baselines depend on the machine, so they are not part
+of the repository and must be recorded with ``--update`` on the machine that runs the checks. The
+timing comparison is therefore not part of ``tests/run_all``, which instead runs the equivalence
+tests in ``tests/test_selection.py`` on the same synthetic events.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+from collections import defaultdict
+from typing import Callable
+
+import law
+
+from columnflow.util import maybe_import
+from columnflow.production.util import attach_coffea_behavior
+
+from httcp.util import load_analysis_insts
+from httcp.benchmark.synthetic import DEFAULT_MULTIPLICITIES, TRIGGER_MENUS, generate_events, menu_triggers
+from httcp.selection.main import main
+from httcp.selection.trigger import trigger_selection
+from httcp.selection.physics_objects import muon_selection, electron_selection, tau_selection
+from httcp.selection.lepton_pair_etau import etau_selection
+from httcp.selection.lepton_pair_mutau import mutau_selection
+from httcp.selection.lepton_pair_tautau import tautau_selection
+from httcp.selection.match_trigobj import match_trigobj
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+default_baselines = os.path.join(
+    os.getenv("HTTCP_BASE", os.getcwd()), "tests", "benchmark_baselines.json",
+)
+
+
+def prepare(main_inst, events: ak.Array) -> dict:
+    """
+    Runs all selection steps once to obtain the inputs of the individual benchmarks.
+    """
+    inputs = {"events": events}
+    events, inputs["trigger_results"] = main_inst[trigger_selection](events)
+    _, _, inputs["muon"], _, _ = main_inst[muon_selection](events, call_force=True)
+    _, _, inputs["electron"], _, _ = main_inst[electron_selection](events, call_force=True)
+    _, _, inputs["tau"] = main_inst[tau_selection](events, inputs["electron"], inputs["muon"], call_force=True)
+    inputs["events"] = events
+    return inputs
+
+
+# benchmarks as functions receiving the main selector instance and prepared inputs, returning a
+# function without arguments to be timed
+BENCHMARKS = {
+    "trigger_selection": lambda inst, inp: lambda: inst[trigger_selection](inp["events"]),
+    "muon_selection": lambda inst, inp: lambda: inst[muon_selection](inp["events"], call_force=True),
+    "electron_selection": lambda inst, inp: lambda: inst[electron_selection](inp["events"], call_force=True),
+    "tau_selection": lambda inst, inp: lambda: inst[tau_selection](
+        inp["events"], inp["electron"], inp["muon"], call_force=True,
+    ),
+    "etau_selection": lambda inst, inp: lambda: inst[etau_selection](
+        inp["events"], inp["electron"], inp["tau"], call_force=True,
+    ),
+    "mutau_selection": lambda inst, inp: lambda: inst[mutau_selection](
+        inp["events"], inp["muon"], inp["tau"], call_force=True,
+    ),
+    "tautau_selection": lambda inst, inp: lambda: inst[tautau_selection](
+        inp["events"], inp["tau"], call_force=True,
+    ),
+    "match_trigobj": lambda inst, inp: lambda: inst[match_trigobj](
+        inp["events"], inp["trigger_results"], inp["electron"], inp["muon"], inp["tau"], True,
+    ),
+    "main": lambda inst, inp: lambda: inst(inp["events"], defaultdict(float)),
+}
+
+
+# benchmarks whose cost scales with the number of triggers and trigger legs
+MENU_BENCHMARKS = ("trigger_selection", "match_trigobj")
+
+
+def create_main(inst_dict: dict, triggers=None):
+    """
+    Returns an instance of the main selector for the *inst_dict*, using the *triggers* instead of
+    those of the config when given.
+    """
+    config_inst = inst_dict["config_inst"]
+    if triggers is None:
+        return main(inst_dict=inst_dict)
+
+    # the trigger selection reads the triggers of the config during initialization
+    config_triggers = config_inst.x.triggers
+    config_inst.x.triggers = triggers
+    try:
+        return main(inst_dict=inst_dict)
+    finally:
+        config_inst.x.triggers = config_triggers
+
+
+def time_func(func: Callable, repeat: int) -> float:
+    # run once for warm-up (e.g. jit compilation), then take the best of all repetitions
+    func()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(
+    chunk_sizes: list[int],
+    scales: list[float],
+    benchmarks: list[str],
+    menus: list[str] | None = None,
+    repeat: int = 3,
+    **inst_kwargs,
+) -> dict[str, float]:
+    """
+    Runs the *benchmarks* for all *chunk_sizes* and multiplicity *scales* and returns the timings
+    in microseconds per event, keyed by ``"<benchmark>/n<chunk_size>/x<scale>"``. Benchmarks in
+    :py:attr:`MENU_BENCHMARKS` are also run with the trigger lists of all *menus*, keyed by
+    ``"<benchmark>/menu_<menu>/n<chunk_size>/x<scale>"``.
+    """
+    analysis_inst, config_inst, dataset_inst = load_analysis_insts(**inst_kwargs)
+    inst_dict = {
+        "analysis_inst": analysis_inst,
+        "config_inst": config_inst,
+        "dataset_inst": dataset_inst,
+    }
+
+    timings = {}
+    # the menu of the config first, then the explicitly requested ones
+    for menu in [None, *(menus or [])]:
+        menu_benchmarks = benchmarks if menu is None else [name for name in benchmarks if name in MENU_BENCHMARKS]
+        if not menu_benchmarks:
+            continue
+        triggers = config_inst.x.triggers if menu is None else menu_triggers(menu)
+        main_inst = create_main(inst_dict, triggers=None if menu is None else triggers)
+        columns = main_inst.used_columns - main_inst.produced_columns
+        tag = "" if menu is None else f"/menu_{menu}"
+
+        for chunk_size in chunk_sizes:
+            for scale in scales:
+                multiplicities = {name: mean * scale for name, mean in DEFAULT_MULTIPLICITIES.items()}
+                events = generate_events(
+                    columns,
+                    chunk_size,
+                    multiplicities=multiplicities,
+                    triggers=triggers,
+                )
+                events = main_inst[attach_coffea_behavior](events)
+                inputs = prepare(main_inst, events)
+                for name in menu_benchmarks:
+                    key = f"{name}{tag}/n{chunk_size}/x{scale:g}"
+                    seconds = time_func(BENCHMARKS[name](main_inst, inputs), repeat)
+                    timings[key] = seconds / chunk_size * 1e6
+                    logger.info(f"{key}: {timings[key]:.3f} us/event")
+
+    return timings
+
+
+def compare(timings: dict[str, float], baselines: dict[str, float], tolerance: float) -> list[str]:
+    """
+    Returns messages for all *timings* that are slower than their *baselines* by more than the
+    relative *tolerance* or that have no baseline.
+    """
+    regressions = []
+    for key, value in timings.items():
+        if key not in baselines:
+            regressions.append(f"{key}: no baseline, run with --update to record it")
+            continue
+        limit = baselines[key] * (1.0 + tolerance)
+        if value > limit:
+            regressions.append(
+                f"{key}: {value:.3f} us/event exceeds baseline {baselines[key]:.3f} us/event by more "
+                f"than {tolerance:.0%}",
+            )
+    return regressions
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--baselines", default=default_baselines, help="path of the json baselines")
+    parser.add_argument("--update", action="store_true", help="store timings as new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative slowdown")
+    parser.add_argument("--chunk-sizes", default="1000,10000", help="comma-separated chunk sizes")
+    parser.add_argument("--scales", default="1,3", help="comma-separated multiplicity scales")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="comma-separated benchmarks")
+    parser.add_argument(
+        "--menus",
+        default=",".join(TRIGGER_MENUS),
+        help="comma-separated trigger menus for the menu-dependent benchmarks, empty to skip them",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed repetitions")
+    parser.add_argument("--analysis", help="analysis instance, defaults to the law.cfg")
+    parser.add_argument("--config", help="config name, defaults to the law.cfg")
+    parser.add_argument("--dataset", help="dataset name, defaults to the law.cfg")
+    args = parser.parse_args(argv)
+
+    timings = run(
+        [int(n) for n in args.chunk_sizes.split(",")],
+        [float(s) for s in args.scales.split(",")],
+        args.benchmarks.split(","),
+        menus=[menu for menu in args.menus.split(",") if menu],
+        repeat=args.repeat,
+        analysis=args.analysis,
+        config=args.config,
+        dataset=args.dataset,
+    )
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, "r") as f:
+            baselines = json.load(f)
+    elif not args.update:
+        logger.error(f"baselines {args.baselines} do not exist, run with --update to record them")
+        return 1
+
+    if args.update:
+        baselines.setdefault("timings", {}).update(timings)
+        baselines["machine"] = platform.node()
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+        logger.info(f"updated {len(timings)} baselines in {args.baselines}")
+        return 0
+
+    if baselines.get("machine") not in (None, platform.node()):
+        logger.warning(f"baselines were recorded on {baselines['machine']}, timings might not be comparable")
+
+    regressions = compare(timings, baselines.get("timings", {}), args.tolerance)
+    for msg in regressions:
+        logger.error(msg)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
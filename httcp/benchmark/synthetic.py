@@ -0,0 +1,215 @@
+# coding: utf-8
+
+"""
+Generation of synthetic NanoAOD-like events for benchmarks.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable, Sequence
+
+import order as od
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# default mean multiplicities of jagged collections per event
+DEFAULT_MULTIPLICITIES = {
+    "Muon": 1.0,
+    "Electron": 1.0,
+    "Tau": 2.5,
+    "Jet": 5.0,
+    "TrigObj": 8.0,
+}
+
+# nano dtypes of fields, keyed by "Collection.field" or, as a fallback, by field name only
+FIELD_DTYPES = {
+    "event": np.uint64,
+    "run": np.uint32,
+    "luminosityBlock": np.uint32,
+    "charge": np.int32,
+    "pdgId": np.int32,
+    "mediumId": np.bool_,
+    "isGlobal": np.bool_,
+    "isPFcand": np.bool_,
+    "isTracker": np.bool_,
+    "convVeto": np.bool_,
+    "mvaIso_WP80": np.bool_,
+    "mvaIso_WP90": np.bool_,
+    "mvaNoIso_WP90": np.bool_,
+    "mvaFall17V2Iso_WP80": np.bool_,
+    "mvaFall17V2Iso_WP90": np.bool_,
+    "mvaFall17V2noIso_WP90": np.bool_,
+    "cutBased": np.uint8,
+    "lostHits": np.uint8,
+    "idDeepTau2018v2p5VSe": np.uint8,
+    "idDeepTau2018v2p5VSmu": np.uint8,
+    "idDeepTau2018v2p5VSjet": np.uint8,
+    "decayMode": np.int32,
+    "jetId": np.int32,
+    "puId": np.int32,
+    "hadronFlavour": np.int32,
+    "TrigObj.id": np.int32,
+    "filterBits": np.int32,
+    "PV.npvs": np.int32,
+    "Pileup.nPU": np.int32,
+}
+
+
+# functions in httcp.config.triggers adding the trigger menus per name
+TRIGGER_MENUS = {
+    "2017": "add_triggers_2017",
+    "run3_2022_preEE": "add_triggers_run3_2022_preEE",
+    "run3_2022_postEE": "add_triggers_run3_2022_postEE",
+}
+
+
+def menu_triggers(menu: str) -> od.UniqueObjectIndex:
+    """
+    Returns the trigger list of the *menu* in :py:attr:`TRIGGER_MENUS`.
+    """
+    import httcp.config.triggers
+
+    config = od.Config(name="synthetic", id=1, campaign=od.Campaign(name="synthetic", id=1))
+    getattr(httcp.config.triggers, TRIGGER_MENUS[menu])(config)
+    return config.x.triggers
+
+
+def default_triggers() -> od.UniqueObjectIndex:
+    """
+    Returns the 2017 trigger list, see :py:func:`httcp.config.triggers.add_triggers_2017`.
+    """
+    return menu_triggers("2017")
+
+
+def _field_dtype(collection: str | None, field: str) -> np.dtype:
+    if collection in ("HLT", "Flag"):
+        return np.dtype(np.bool_)
+    key = f"{collection}.{field}" if collection else field
+    return np.dtype(FIELD_DTYPES.get(key, FIELD_DTYPES.get(field, np.float32)))
+
+
+def _field_values(
+    rng: np.random.Generator,
+    field: str,
+    dtype: np.dtype,
+    n: int,
+    triggers: Sequence,
+) -> np.ndarray:
+    # rough, physics-inspired distributions that exercise all selection branches
+    if dtype.kind == "b":
+        return rng.random(n) < 0.8
+    if field == "charge":
+        return rng.choice(np.array([-1, 1], dtype=dtype), n)
+    if field == "id":
+        pdg_ids = sorted({leg.pdg_id for trigger in triggers for leg in trigger.legs or [] if leg.pdg_id})
+        return rng.choice(np.array(pdg_ids or [11, 13, 15], dtype=dtype), n)
+    if field == "filterBits":
+        bits = 0
+        for trigger in triggers:
+            for leg in trigger.legs or []:
+                for b in leg.trigger_bits or []:
+                    bits |= b
+        return (rng.integers(0, 2**31 - 1, n, dtype=np.int64) & bits).astype(dtype)
+    if field.startswith("idDeepTau"):
+        return rng.integers(0, 9, n).astype(dtype)
+    if field == "cutBased":
+        return rng.integers(0, 5, n).astype(dtype)
+    if field == "jetId":
+        return rng.choice(np.array([0, 2, 6], dtype=dtype), n)
+    if dtype.kind in "iu":
+        return rng.integers(0, 50, n).astype(dtype)
+    if field == "pt":
+        return (10.0 + rng.exponential(30.0, n)).astype(dtype)
+    if field == "eta":
+        return rng.uniform(-2.6, 2.6, n).astype(dtype)
+    if field == "phi":
+        return rng.uniform(-np.pi, np.pi, n).astype(dtype)
+    if field == "mass":
+        return rng.uniform(0.0, 1.8, n).astype(dtype)
+    if field in ("dxy", "dz"):
+        return rng.normal(0.0, 0.1, n).astype(dtype)
+    if field.startswith("pfRelIso"):
+        return rng.exponential(0.15, n).astype(dtype)
+    if field.startswith("raw") or field.startswith("btag"):
+        return rng.random(n).astype(dtype)
+    if field == "genWeight":
+        return rng.choice(np.array([-1.0, 1.0], dtype=dtype), n, p=[0.1, 0.9])
+    return rng.normal(1.0, 0.5, n).astype(dtype)
+
+
+def generate_events(
+    columns: Iterable[str | Route],
+    n_events: int,
+    multiplicities: dict[str, float] | None = None,
+    triggers: Sequence | None = None,
+    hlt_fire_probability: float = 0.3,
+    seed: int = 42,
+) -> ak.Array:
+    """
+    Generates *n_events* synthetic events containing all *columns*, e.g. the ``used_columns`` of a
+    selector. Collections in *multiplicities* (updating :py:attr:`DEFAULT_MULTIPLICITIES`) are
+    jagged with Poisson-distributed numbers of objects around the given means and sorted by pt, all
+    other nested columns such as ``MET.pt`` are flat records. Fields follow the nano dtypes in
+    :py:attr:`FIELD_DTYPES`, and ``HLT`` paths of the *triggers* (defaulting to the 2017 list) fire
+    with *hlt_fire_probability*, while ``TrigObj.filterBits`` only contain bits used by their legs.
+    """
+    rng = np.random.default_rng(seed)
+    multiplicities = {**DEFAULT_MULTIPLICITIES, **(multiplicities or {})}
+    if triggers is None:
+        triggers = default_triggers()
+
+    # group requested fields by collection
+    flat_fields = []
+    collections = {}
+    for column in columns:
+        fields = Route(column).fields
+        if fields[0].startswith("HLT_"):
+            # flat nano names of trigger paths, covered by the HLT record below
+            continue
+        if len(fields) == 1:
+            flat_fields.append(fields[0])
+        else:
+            collections.setdefault(fields[0], set()).add(fields[1])
+
+    # all HLT paths of the triggers, as used by the trigger selection
+    collections.setdefault("HLT", set()).update(trigger.hlt_field for trigger in triggers)
+
+    data = {}
+    for field in flat_fields:
+        if field == "event":
+            data[field] = np.arange(n_events, dtype=np.uint64)
+        else:
+            data[field] = _field_values(rng, field, _field_dtype(None, field), n_events, triggers)
+
+    for collection, fields in collections.items():
+        if collection in multiplicities:
+            counts = rng.poisson(multiplicities[collection], n_events)
+            n_objects = int(counts.sum())
+            fields = set(fields) | {"pt"}
+            values = {
+                field: _field_values(rng, field, _field_dtype(collection, field), n_objects, triggers)
+                for field in sorted(fields)
+            }
+            # sort objects by pt per event, as in nano
+            event_index = np.repeat(np.arange(n_events), counts)
+            order = np.lexsort((-values["pt"], event_index))
+            data[collection] = ak.zip(
+                {field: ak.unflatten(arr[order], counts) for field, arr in values.items()},
+            )
+        elif collection == "HLT":
+            data[collection] = ak.zip({
+                field: rng.random(n_events) < hlt_fire_probability
+                for field in sorted(fields)
+            })
+        else:
+            data[collection] = ak.zip({
+                field: _field_values(rng, field, _field_dtype(collection, field), n_events, triggers)
+                for field in sorted(fields)
+            })
+
+    return ak.zip(data, depth_limit=1)
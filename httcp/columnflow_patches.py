@@ -34,6 +34,31 @@ def patch_bundle_repo_exclude_files():
     logger.debug("patched exclude_files of cf.BundleRepo")
 
 
+@memoize
+def patch_select_events_chunk_info():
+    from columnflow.tasks.selection import SelectEvents
+
+    iter_chunked_io = SelectEvents.iter_chunked_io
+
+    # store the input file and entry range of each chunk on the selector, so that the selector
+    # can identify its chunk, e.g. to count the generated events of the file with its first chunk
+    def patched_iter_chunked_io(self, paths, *args, **kwargs):
+        input_file = law.util.make_list(paths)[0]
+        input_file = getattr(input_file, "abspath", input_file)
+        for chunk, pos in iter_chunked_io(self, paths, *args, **kwargs):
+            self.selector_inst.chunk_info = {
+                "input_file": input_file,
+                "entry_start": pos.entry_start,
+                "entry_stop": pos.entry_stop,
+            }
+            yield chunk, pos
+
+    SelectEvents.iter_chunked_io = patched_iter_chunked_io
+
+    logger.debug("patched iter_chunked_io of cf.SelectEvents")
+
+
 @memoize
 def patch_all():
     patch_bundle_repo_exclude_files()
+    patch_select_events_chunk_info()
@@ -0,0 +1,272 @@
+# coding: utf-8
+
+"""
+Minimal set of columns to keep after the event reduction, resolved from the columns read by the
+consumers of the reduced events.
+
+Usage:
+
+    python -m httcp.config.column_pruning [--config NAME] [--check] [--write]
+
+The consumers are the producers (defaulting to the default producer of the config), the
+categorizers of all categories, the ML models (defaulting to the default ML model), the expressions
+of all variables and the event weight columns, evaluated for all datasets of the config. Columns
+produced by the producers and ML models themselves are not required.
+
+Without options, the required columns are compared to the configured ``keep_columns`` of
+``cf.ReduceEvents``. With ``--write``, they are stored in ``httcp/config/keep_columns/<config>.json``,
+which :py:func:`httcp.config.variables.keep_columns` then uses instead of the hard-coded set.
+``--check`` exits with an error when the kept columns differ from the required ones, e.g. when a
+stored set went stale after a producer changed.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import json
+import fnmatch
+import argparse
+
+import law
+import order as od
+
+from columnflow.production import Producer
+from columnflow.categorization import Categorizer
+from columnflow.selection import Selector
+from columnflow.ml import MLModel
+from columnflow.columnar_util import Route, ColumnCollection
+
+from httcp.util import load_analysis_insts, import_analysis_modules
+from httcp.config.variables import pruned_columns_path
+
+
+logger = law.logger.get_logger(__name__)
+
+# columns that are always kept
+IDENTITY_COLUMNS = ("run", "luminosityBlock", "event")
+
+# columns read when creating histograms, in addition to variables and weights
+HISTOGRAM_COLUMNS = ("process_id", "category_ids")
+
+# prefixes of variable expressions referring to outputs of other tasks than the reduction
+FOREIGN_PREFIXES = ("cutflow.",)
+
+
+def _columns(routes) -> set[str]:
+    return {Route(route).column for route in routes}
+
+
+def variable_columns(config_inst: od.Config) -> dict[str, set[str]]:
+    """
+    Returns the columns read by the expressions of all variables of *config_inst*, per variable.
+    Callable expressions are resolved through the ``inputs`` auxiliary entry of the variable.
+    """
+    columns = {}
+    for variable_inst in config_inst.variables:
+        expression = variable_inst.expression
+        if callable(expression):
+            inputs = variable_inst.x("inputs", None)
+            if inputs is None:
+                logger.warning(
+                    f"cannot resolve the columns of variable '{variable_inst.name}' with a callable "
+                    "expression, define them in its 'inputs' auxiliary entry",
+                )
+                continue
+            columns[variable_inst.name] = _columns(inputs)
+        elif not expression.startswith(FOREIGN_PREFIXES):
+            # strip slices such as [:,0]
+            columns[variable_inst.name] = _columns([re.sub(r"\[.*?\]", "", expression)])
+    return columns
+
+
+def category_selections(config_inst: od.Config) -> set[str]:
+    """
+    Returns the names of the categorizers of all categories of *config_inst*.
+    """
+    names = set()
+    for category_inst, _, _ in config_inst.walk_categories():
+        names |= {
+            selection for selection in law.util.make_list(category_inst.selection or [])
+            if isinstance(selection, str)
+        }
+    return names
+
+
+def required_columns(
+    analysis_inst: od.Analysis,
+    config_inst: od.Config,
+    producers: list[str],
+    ml_models: list[str],
+    dataset_insts: list[od.Dataset],
+) -> dict:
+    """
+    Returns a dictionary with the columns read per consumer (``"consumers"``), the columns produced
+    by the *producers* and *ml_models* (``"produced"``) and the sorted columns that need to be kept
+    after the reduction (``"required"``), evaluated for all *dataset_insts*.
+    """
+    consumers = {f"variable {name}": cols for name, cols in variable_columns(config_inst).items()}
+    consumers["histograms"] = set(HISTOGRAM_COLUMNS)
+    consumers["event weights"] = set(config_inst.x("event_weights", {}))
+    produced = set()
+
+    categorizers = sorted(category_selections(config_inst))
+    for dataset_inst in dataset_insts:
+        inst_dict = {
+            "analysis_inst": analysis_inst,
+            "config_inst": config_inst,
+            "dataset_inst": dataset_inst,
+        }
+        for name in producers:
+            producer_inst = Producer.get_cls(name)(inst_dict=inst_dict)
+            consumers.setdefault(f"producer {name}", set()).update(_columns(producer_inst.used_columns))
+            produced |= _columns(producer_inst.produced_columns)
+        for name in categorizers:
+            categorizer_inst = Categorizer.get_cls(name)(inst_dict=inst_dict)
+            consumers.setdefault(f"categorizer {name}", set()).update(_columns(categorizer_inst.used_columns))
+        if dataset_inst.is_mc:
+            consumers["event weights"] |= set(dataset_inst.x("event_weights", {}))
+
+    for name in ml_models:
+        model_inst = MLModel.get_cls(name)(analysis_inst)
+        consumers[f"ml model {name}"] = _columns(model_inst.uses(config_inst))
+        produced |= _columns(model_inst.produces(config_inst))
+
+    required = set(IDENTITY_COLUMNS)
+    for columns in consumers.values():
+        required |= columns - produced
+
+    return {
+        "consumers": consumers,
+        "produced": produced,
+        "required": sorted(required),
+    }
+
+
+def selector_columns(analysis_inst: od.Analysis, config_inst: od.Config, dataset_insts: list[od.Dataset]) -> set[str]:
+    """
+    Returns the columns produced by the default selector of *config_inst* for all *dataset_insts*,
+    i.e., the columns covered by ``ColumnCollection.ALL_FROM_SELECTOR``.
+    """
+    columns = set()
+    for dataset_inst in dataset_insts:
+        selector_inst = Selector.get_cls(config_inst.x.default_selector)(inst_dict={
+            "analysis_inst": analysis_inst,
+            "config_inst": config_inst,
+            "dataset_inst": dataset_inst,
+        })
+        columns |= _columns(selector_inst.produced_columns)
+    return columns
+
+
+def _covered(column: str, patterns) -> bool:
+    # whether the *column* is kept by one of the *patterns*, either exactly, as a subfield or via
+    # wildcards
+    return any(
+        column == pattern or column.startswith(f"{pattern}.") or fnmatch.fnmatch(column, pattern)
+        for pattern in patterns
+    )
+
+
+def compare_keep_columns(
+    keep_columns,
+    required: list[str],
+    from_selector: set[str] | None = None,
+) -> tuple[list[str], list[str]]:
+    """
+    Compares the configured *keep_columns* of the reduction to the *required* columns and returns
+    the kept columns that are not required and the required columns that are not kept.
+    *from_selector* is the set of columns covered by ``ColumnCollection.ALL_FROM_SELECTOR``.
+    """
+    patterns = sorted(str(column) for column in keep_columns if not isinstance(column, ColumnCollection))
+    covering = list(patterns)
+    if ColumnCollection.ALL_FROM_SELECTOR in keep_columns:
+        covering.extend(from_selector or [])
+
+    unused = [
+        pattern for pattern in patterns
+        if not any(_covered(column, [pattern]) or _covered(pattern, [column]) for column in required)
+    ]
+    missing = [column for column in required if not _covered(column, covering)]
+
+    return unused, missing
+
+
+def write_pruned_columns(config_inst: od.Config, result: dict, **meta) -> str:
+    """
+    Stores the required columns of *result* (see :py:func:`required_columns`) together with the
+    *meta* information and returns the path of the file.
+    """
+    path = pruned_columns_path(config_inst.name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({**meta, "columns": result["required"]}, f, indent=4)
+        f.write("\n")
+    return path
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--analysis", help="analysis instance, defaults to the law.cfg")
+    parser.add_argument("--config", help="config name, defaults to the law.cfg")
+    parser.add_argument("--producers", help="comma-separated producers, defaults to the config")
+    parser.add_argument("--ml-models", help="comma-separated ML models, defaults to the config")
+    parser.add_argument("--datasets", help="comma-separated datasets, defaults to all datasets of the config")
+    parser.add_argument("--write", action="store_true", help="store the required columns to be used by the config")
+    parser.add_argument("--check", action="store_true", help="fail when kept and required columns differ")
+    parser.add_argument("--verbose", action="store_true", help="print the columns per consumer")
+    args = parser.parse_args(argv)
+
+    import_analysis_modules(
+        "calibration_modules", "selection_modules", "production_modules", "categorization_modules",
+        "ml_modules",
+    )
+    analysis_inst, config_inst, _ = load_analysis_insts(analysis=args.analysis, config=args.config)
+
+    producers = (
+        args.producers.split(",") if args.producers else
+        law.util.make_list(config_inst.x("default_producer", None) or [])
+    )
+    ml_models = (
+        args.ml_models.split(",") if args.ml_models else
+        law.util.make_list(config_inst.x("default_ml_model", None) or [])
+    )
+    dataset_insts = (
+        [config_inst.get_dataset(name) for name in args.datasets.split(",")] if args.datasets else
+        list(config_inst.datasets)
+    )
+
+    result = required_columns(analysis_inst, config_inst, producers, ml_models, dataset_insts)
+    if args.verbose:
+        for consumer, columns in sorted(result["consumers"].items()):
+            print(f"{consumer}: {', '.join(sorted(columns - result['produced']))}")
+
+    keep_columns = config_inst.x.keep_columns["cf.ReduceEvents"]
+    unused, missing = compare_keep_columns(
+        keep_columns,
+        result["required"],
+        selector_columns(analysis_inst, config_inst, dataset_insts)
+        if ColumnCollection.ALL_FROM_SELECTOR in keep_columns else None,
+    )
+    print(f"{len(result['required'])} required columns: {', '.join(result['required'])}")
+    print(f"{len(unused)} kept but not required: {', '.join(unused)}")
+    print(f"{len(missing)} required but not kept: {', '.join(missing)}")
+
+    if args.write:
+        path = write_pruned_columns(
+            config_inst,
+            result,
+            config=config_inst.name,
+            producers=producers,
+            ml_models=ml_models,
+        )
+        print(f"stored required columns in {path}")
+
+    if args.check and (unused or missing):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
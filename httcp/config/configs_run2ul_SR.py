@@ -163,6 +163,17 @@ def add_config(
         },
     )
     
+    # overrides of thresholds in the selection cut tables, per table, selection and cut name
+    # (see httcp/selection/cut_tables.py), e.g. {"muon": {"good": {"muon_pt_26": 28.0}}}
+    cfg.x.cut_overrides = DotDict.wrap({})
+
+    # loosening of the good lepton cuts per variable for the preskim (see httcp/selection/preskim.py)
+    cfg.x.preskim_loosening = DotDict.wrap({
+        "pt": 5.0,
+        "pfRelIso04_all": 0.1,
+        "idDeepTau2018v2p5VSjet": 2,
+    })
+
     # names of electron correction sets and working points
     # (used in the muon producer)
     cfg.x.electron_sf_names = ("UL-Electron-ID-SF", f"{year}", "wp80iso")
@@ -1,5 +1,8 @@
 ### This config is used for listing the variables used in the analysis ###
 
+import os
+import json
+
 from columnflow.config_util import add_category
 
 import order as od
@@ -54,6 +57,21 @@ def keep_columns(cfg: od.Config) -> None:
         },
     })
 
+    # replace the columns kept after the reduction by the minimal set of columns read downstream
+    # when it was stored with httcp.config.column_pruning
+    pruned_path = pruned_columns_path(cfg.name)
+    if os.path.exists(pruned_path):
+        with open(pruned_path, "r") as f:
+            cfg.x.keep_columns["cf.ReduceEvents"] = set(json.load(f)["columns"])
+
+
+def pruned_columns_path(config_name: str) -> str:
+    """
+    Returns the path of the file with the pruned columns to keep after the reduction for the config
+    *config_name*.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "keep_columns", f"{config_name}.json")
+
 
 
 def add_common_features(cfg: od.config) -> None:
@@ -0,0 +1,241 @@
+# coding: utf-8
+
+"""
+Persistent index of the files in dataset directories, refreshed incrementally.
+
+Usage:
+
+    python -m httcp.dataset_index [--config NAME] [--datasets NAMES] [--workers N] [--entries]
+
+The index of a directory stores its modification time and the path, size, modification time and,
+optionally, number of entries of all ROOT files in it. As long as the modification time of the
+directory is unchanged, files are returned from the index without listing the directory again.
+Otherwise, the directory is listed, new files are inspected and known files are stat'ed again so
+that files rewritten in place are updated. Since directory modification times can have a coarse
+resolution, a directory is also listed again when its index was written within that resolution of
+its modification time. Index files are stored in ``$HTTCP_BASE/.data/dataset_index`` and can be
+filled for all datasets of a config in parallel via the command line, e.g. before starting a
+workflow for a full campaign.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import law
+import order as od
+
+from columnflow.util import maybe_import
+
+from httcp.util import load_analysis_insts
+
+uproot = maybe_import("uproot")
+
+
+logger = law.logger.get_logger(__name__)
+
+# version of the index format, older indices are discarded
+INDEX_VERSION = 2
+
+# assumed resolution of modification times in seconds, e.g. on shared file systems
+MTIME_RESOLUTION = 2.0
+
+
+def default_index_dir() -> str:
+    return os.path.join(os.getenv("HTTCP_BASE", os.getcwd()), ".data", "dataset_index")
+
+
+def _count_entries(target: law.FileSystemFileTarget, treepath: str = "Events") -> int | None:
+    try:
+        with uproot.open(target.uri()) as f:
+            return int(f[treepath].num_entries)
+    except Exception as e:
+        logger.warning(f"could not read the number of entries of {target.path}: {e}")
+        return None
+
+
+class DatasetIndex(object):
+    """
+    Index of the ROOT files in the directory *dataset_key* on the file system *fs*, stored in
+    *index_dir* (defaulting to ``$HTTCP_BASE/.data/dataset_index``). When *count_entries* is
+    *True*, the number of entries of new or changed files is read as well. When *check_files* is
+    *True*, all known files are stat'ed even if the directory did not change, which detects files
+    rewritten in place at the cost of one stat call per file.
+    """
+
+    def __init__(
+        self,
+        dataset_key: str,
+        fs: str = "local",
+        index_dir: str | None = None,
+        count_entries: bool = False,
+        check_files: bool = False,
+        mtime_resolution: float = MTIME_RESOLUTION,
+    ):
+        super().__init__()
+
+        self.dataset_key = dataset_key
+        self.fs = fs
+        self.count_entries = count_entries
+        self.check_files = check_files
+        self.mtime_resolution = mtime_resolution
+        name = hashlib.sha1(f"{fs}:{dataset_key}".encode()).hexdigest()
+        self.path = os.path.join(index_dir or default_index_dir(), f"{name}.json")
+
+    def _load(self) -> dict | None:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r") as f:
+                index = json.load(f)
+        except ValueError:
+            return None
+        if index.get("version") != INDEX_VERSION or index.get("dataset_key") != self.dataset_key:
+            return None
+        return index
+
+    def _save(self, index: dict) -> None:
+        # write atomically since several processes might index the same directory
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _record(self, target: law.FileSystemFileTarget, record: dict | None) -> dict:
+        # stat the file and keep the known number of entries unless size or modification time changed
+        stat = target.stat()
+        if record is None or record["size"] != stat.st_size or record["mtime"] != stat.st_mtime:
+            record = {
+                "path": target.path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "entries": None,
+            }
+        if self.count_entries and record["entries"] is None:
+            record["entries"] = _count_entries(target)
+        return record
+
+    def _is_current(self, index: dict | None, dir_mtime: float) -> bool:
+        # changes within the mtime resolution before the listing might not be visible in dir_mtime
+        if index is None or index["mtime"] != dir_mtime:
+            return False
+        if index["indexed_at"] - dir_mtime <= self.mtime_resolution:
+            return False
+        # entries were not requested when the index was created
+        if self.count_entries and any(f["entries"] is None for f in index["files"].values()):
+            return False
+        return True
+
+    def refresh(self, force: bool = False) -> dict:
+        """
+        Returns the index, listing the directory only if it might have changed since the last listing
+        or *force* is *True*.
+        """
+        directory = law.wlcg.WLCGDirectoryTarget(self.dataset_key, fs=self.fs)
+        dir_mtime = directory.stat().st_mtime
+
+        index = None if force else self._load()
+        if self._is_current(index, dir_mtime) and not self.check_files:
+            return index
+
+        # time of the listing, taken before listing so that later changes trigger a new one
+        indexed_at = time.time()
+        known = index["files"] if index else {}
+        if self._is_current(index, dir_mtime):
+            basenames = list(known)
+        else:
+            basenames = sorted(directory.listdir(pattern="*.root"))
+        files = {
+            basename: self._record(directory.child(basename, type="f"), known.get(basename))
+            for basename in basenames
+        }
+
+        n_changed = sum(known.get(basename) is not record for basename, record in files.items())
+        n_removed = len(set(known) - set(files))
+        logger.debug(f"indexed {self.dataset_key}: {len(files)} files, {n_changed} new or changed, {n_removed} removed")
+
+        index = {
+            "version": INDEX_VERSION,
+            "dataset_key": self.dataset_key,
+            "fs": self.fs,
+            "mtime": dir_mtime,
+            "indexed_at": indexed_at,
+            "files": files,
+        }
+        self._save(index)
+
+        return index
+
+    def paths(self) -> list[str]:
+        return [record["path"] for record in self.refresh()["files"].values()]
+
+
+def index_datasets(
+    dataset_keys: list[str],
+    fs: str = "local",
+    workers: int = 8,
+    **kwargs,
+) -> dict[str, dict]:
+    """
+    Refreshes the indices of all *dataset_keys* with a pool of *workers* threads and returns them
+    per key. *kwargs* are forwarded to :py:class:`DatasetIndex`.
+    """
+    def refresh(dataset_key: str) -> dict:
+        return DatasetIndex(dataset_key, fs=fs, **kwargs).refresh()
+
+    dataset_keys = list(dict.fromkeys(dataset_keys))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        return dict(zip(dataset_keys, pool.map(refresh, dataset_keys)))
+
+
+def config_dataset_keys(config_inst: od.Config, dataset_names: list[str] | None = None) -> list[str]:
+    """
+    Returns the keys of all datasets of *config_inst* (or those in *dataset_names*) for all shifts.
+    """
+    dataset_insts = (
+        [config_inst.get_dataset(name) for name in dataset_names] if dataset_names else
+        list(config_inst.datasets)
+    )
+    return [
+        key
+        for dataset_inst in dataset_insts
+        for info in dataset_inst.info.values()
+        for key in info.keys
+    ]
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--analysis", help="analysis instance, defaults to the law.cfg")
+    parser.add_argument("--config", help="config name, defaults to the law.cfg")
+    parser.add_argument("--datasets", help="comma-separated datasets, defaults to all datasets of the config")
+    parser.add_argument("--fs", default="local", help="file system of the dataset directories")
+    parser.add_argument("--workers", type=int, default=8, help="number of directories listed in parallel")
+    parser.add_argument("--entries", action="store_true", help="read the number of entries of new files")
+    parser.add_argument("--check-files", action="store_true", help="stat known files of unchanged directories")
+    args = parser.parse_args(argv)
+
+    _, config_inst, _ = load_analysis_insts(analysis=args.analysis, config=args.config)
+    dataset_keys = config_dataset_keys(config_inst, args.datasets.split(",") if args.datasets else None)
+    indices = index_datasets(
+        dataset_keys,
+        fs=args.fs,
+        workers=args.workers,
+        count_entries=args.entries,
+        check_files=args.check_files,
+    )
+
+    n_files = sum(len(index["files"]) for index in indices.values())
+    logger.info(f"indexed {n_files} files in {len(indices)} directories")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,204 @@
+# coding: utf-8
+
+"""
+Four-vector math on flat pt, eta, phi and mass buffers, without coffea vector behaviors.
+
+The functions operating on numpy arrays broadcast like numpy ufuncs. The jagged wrappers
+(:py:func:`delta_r`, :py:func:`transverse_mass`, ...) accept awkward arrays of records with fields
+``pt``, ``eta``, ``phi`` and ``mass``, either flat per event or jagged with one level of nesting,
+compute on their flat buffers and return arrays with the same structure. Delta phi, delta R and the
+transverse mass use the same formulas as the coffea vector methods. :py:func:`delta_r2_kernel` can be
+called from other compiled kernels.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+from httcp.util import njit, flat_column
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+#
+# numpy functions on flat buffers
+#
+
+def delta_phi_np(phi1: np.ndarray, phi2: np.ndarray) -> np.ndarray:
+    return (phi1 - phi2 + np.pi) % (2 * np.pi) - np.pi
+
+
+def delta_r_np(eta1: np.ndarray, phi1: np.ndarray, eta2: np.ndarray, phi2: np.ndarray) -> np.ndarray:
+    return np.sqrt((eta1 - eta2) ** 2 + delta_phi_np(phi1, phi2) ** 2)
+
+
+def to_cartesian(
+    pt: np.ndarray,
+    eta: np.ndarray,
+    phi: np.ndarray,
+    mass: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns px, py, pz and the energy.
+    """
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+    pz = pt * np.sinh(eta)
+    e = np.sqrt(px ** 2 + py ** 2 + pz ** 2 + mass ** 2)
+    return px, py, pz, e
+
+
+def from_cartesian(
+    px: np.ndarray,
+    py: np.ndarray,
+    pz: np.ndarray,
+    e: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns pt, eta, phi and the mass, which is set to zero for negative squared masses.
+    """
+    pt = np.hypot(px, py)
+    eta = np.arcsinh(pz / np.where(pt == 0, np.inf, pt))
+    phi = np.arctan2(py, px)
+    mass = np.sqrt(np.maximum(e ** 2 - px ** 2 - py ** 2 - pz ** 2, 0))
+    return pt, eta, phi, mass
+
+
+def invariant_mass_np(
+    pt1: np.ndarray, eta1: np.ndarray, phi1: np.ndarray, mass1: np.ndarray,
+    pt2: np.ndarray, eta2: np.ndarray, phi2: np.ndarray, mass2: np.ndarray,
+) -> np.ndarray:
+    px1, py1, pz1, e1 = to_cartesian(pt1, eta1, phi1, mass1)
+    px2, py2, pz2, e2 = to_cartesian(pt2, eta2, phi2, mass2)
+    return from_cartesian(px1 + px2, py1 + py2, pz1 + pz2, e1 + e2)[3]
+
+
+def transverse_mass_np(pt1: np.ndarray, phi1: np.ndarray, pt2: np.ndarray, phi2: np.ndarray) -> np.ndarray:
+    return np.sqrt(2 * pt1 * pt2 * (1 - np.cos(delta_phi_np(phi1, phi2))))
+
+
+def boost(
+    px: np.ndarray, py: np.ndarray, pz: np.ndarray, e: np.ndarray,
+    bx: np.ndarray, by: np.ndarray, bz: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Boosts the cartesian four-vectors by the velocity (*bx*, *by*, *bz*), e.g. into the rest frame
+    of a system with velocity ``-p / E``, see :py:func:`boost_vector`.
+    """
+    b2 = bx ** 2 + by ** 2 + bz ** 2
+    gamma = 1 / np.sqrt(1 - b2)
+    bp = bx * px + by * py + bz * pz
+    gamma2 = np.where(b2 > 0, (gamma - 1) / np.where(b2 > 0, b2, 1), 0)
+    factor = gamma2 * bp + gamma * e
+    return (
+        px + factor * bx,
+        py + factor * by,
+        pz + factor * bz,
+        gamma * (e + bp),
+    )
+
+
+def boost_vector(
+    px: np.ndarray,
+    py: np.ndarray,
+    pz: np.ndarray,
+    e: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the velocity ``p / E`` of the four-vectors.
+    """
+    return px / e, py / e, pz / e
+
+
+def sum_per_event(
+    offsets: np.ndarray,
+    pt: np.ndarray,
+    eta: np.ndarray,
+    phi: np.ndarray,
+    mass: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns pt, eta, phi and mass of the sums of all objects per event, given the *offsets* of the
+    flat object buffers.
+    """
+    event_idx = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    n_events = len(offsets) - 1
+    sums = [
+        np.bincount(event_idx, weights=component, minlength=n_events)
+        for component in to_cartesian(pt, eta, phi, mass)
+    ]
+    return from_cartesian(*sums)
+
+
+#
+# kernel helpers
+#
+
+@njit(cache=True)
+def delta_r2_kernel(eta1, phi1, eta2, phi2):
+    deta = eta1 - eta2
+    dphi = (phi1 - phi2 + np.pi) % (2 * np.pi) - np.pi
+    return deta * deta + dphi * dphi
+
+
+#
+# wrappers for awkward arrays
+#
+
+def _flat(array: ak.Array, field: str) -> np.ndarray:
+    values = array[field]
+    return flat_column(values) if values.ndim > 1 else np.asarray(values)
+
+
+def _like(values: np.ndarray, array: ak.Array) -> ak.Array:
+    # restore the structure of *array*, which is either flat or jagged
+    first = array[array.fields[0]]
+    if first.ndim > 1:
+        return ak.unflatten(values, ak.num(first, axis=1))
+    return ak.Array(values)
+
+
+def _per_object(per_event: ak.Array, array: ak.Array, field: str) -> np.ndarray:
+    # broadcast a flat per-event field to the objects of the jagged *array*
+    values = np.asarray(per_event[field])
+    first = array[array.fields[0]]
+    if first.ndim > 1:
+        return np.repeat(values, np.asarray(ak.num(first, axis=1)))
+    return values
+
+
+def delta_phi(obj1: ak.Array, obj2: ak.Array) -> ak.Array:
+    return _like(delta_phi_np(_flat(obj1, "phi"), _flat(obj2, "phi")), obj1)
+
+
+def delta_r(obj1: ak.Array, obj2: ak.Array) -> ak.Array:
+    """
+    Delta R between objects of identical structure.
+    """
+    return _like(delta_r_np(_flat(obj1, "eta"), _flat(obj1, "phi"), _flat(obj2, "eta"), _flat(obj2, "phi")), obj1)
+
+
+def invariant_mass(obj1: ak.Array, obj2: ak.Array) -> ak.Array:
+    """
+    Invariant mass of the sums of objects of identical structure.
+    """
+    return _like(
+        invariant_mass_np(*(_flat(obj1, f) for f in ("pt", "eta", "phi", "mass")),
+                          *(_flat(obj2, f) for f in ("pt", "eta", "phi", "mass"))),
+        obj1,
+    )
+
+
+def transverse_mass(obj: ak.Array, met: ak.Array) -> ak.Array:
+    """
+    Transverse mass of objects and the missing transverse momentum *met*, which has one entry per
+    event and is broadcast to the objects.
+    """
+    return _like(
+        transverse_mass_np(
+            _flat(obj, "pt"), _flat(obj, "phi"),
+            _per_object(met, obj, "pt"), _per_object(met, obj, "phi"),
+        ),
+        obj,
+    )
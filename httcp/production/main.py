@@ -7,7 +7,6 @@ import functools
 
 from columnflow.production import Producer, producer
 from columnflow.production.categories import category_ids
-from columnflow.production.normalization import normalization_weights
 from columnflow.production.cms.seeds import deterministic_seeds
 from columnflow.production.cms.mc_weight import mc_weight
 #from columnflow.production.cms.muon import muon_weights
@@ -15,10 +14,13 @@ from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 
+from httcp.production.normalization import normalization_weights_generated
 from httcp.production.mutau_vars import dilepton_mass, mT, rel_charge
 from httcp.production.weights import pu_weight, muon_weight, tau_weight
 from httcp.production.sample_split import split_dy
 from httcp.calibration.tau import tau_energy_scale
+from httcp.fourvector import delta_r_np, invariant_mass_np
+from httcp.selection.candidates import gather_flat
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -62,18 +64,24 @@ def features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
 def hcand_features(
         self: Producer, 
         events: ak.Array,
-        hcand_pair: ak.Array,
+        hcand: ak.Array,
         **kwargs
 ) -> ak.Array:
-
-    hcand_pair_p4 = ak.firsts(1 * hcand_pair, axis=1)
-    hcand1 = hcand_pair_p4[:,0:1]
-    hcand2 = hcand_pair_p4[:,1:2]
-
-    mass = (hcand1 + hcand2).mass
-    dr = ak.firsts(hcand1.metric_table(hcand2), axis=1)
+    """
+    Invariant mass and delta R of the legs of the first higgs candidate per event, see
+    :py:mod:`httcp.selection.candidates`.
+    """
+    # legs of the first candidate, with only the needed fields gathered
+    first = hcand[:, :1]
+    legs = [
+        {field: gather_flat(events, first, field, leg) for field in ("pt", "eta", "phi", "mass")}
+        for leg in (1, 2)
+    ]
+    counts = ak.num(first.channel, axis=1)
+
+    mass = ak.unflatten(invariant_mass_np(*legs[0].values(), *legs[1].values()), counts)
+    dr = ak.unflatten(delta_r_np(legs[0]["eta"], legs[0]["phi"], legs[1]["eta"], legs[1]["phi"]), counts)
     
-    #from IPython import embed; embed()
     events = set_ak_column_f32(events, "hcand_invm", ak.firsts(mass))
     events = set_ak_column_f32(events, "hcand_dr", ak.firsts(dr))
 
@@ -82,10 +90,10 @@ def hcand_features(
 
 @producer(
     uses={
-        rel_charge, category_ids, features, normalization_weights , dilepton_mass, mT, pu_weight, muon_weight, tau_weight, split_dy
+        rel_charge, category_ids, features, normalization_weights_generated, dilepton_mass, mT, pu_weight, muon_weight, tau_weight, split_dy
     },
     produces={
-        rel_charge, category_ids, features, normalization_weights, dilepton_mass, mT, pu_weight, muon_weight, tau_weight, split_dy
+        rel_charge, category_ids, features, normalization_weights_generated, dilepton_mass, mT, pu_weight, muon_weight, tau_weight, split_dy
     },
 )
 def main(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
@@ -93,7 +101,7 @@ def main(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     events = self[rel_charge](events, **kwargs)
     events = self[category_ids](events, **kwargs)
     if self.dataset_inst.is_mc:
-        events = self[normalization_weights](events, **kwargs)
+        events = self[normalization_weights_generated](events, **kwargs)
         processes = self.dataset_inst.processes.names()
         if ak.any(['dy' in proc for proc in processes]):
             print("Splitting Drell-Yan dataset...")
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+"""
+Normalization weights based on the generated event weights of the input files.
+"""
+
+import law
+
+from columnflow.production import Producer
+from columnflow.production.normalization import normalization_weights
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def load_selection_stats(inputs: dict) -> dict:
+    """
+    Returns the merged selection stats among the *inputs* of the normalization weight producer.
+    """
+    key = "normalization_selection_stats" if "normalization_selection_stats" in inputs else "selection_stats"
+    targets = [target for target in law.util.flatten(inputs[key]) if target.path.endswith(".json")]
+    return targets[0].load(formatter="json")
+
+
+# variant of the normalization weights that uses the sum of generated instead of processed weights
+normalization_weights_generated = normalization_weights.derive("normalization_weights_generated")
+
+
+@normalization_weights_generated.setup
+def normalization_weights_generated_setup(self: Producer, reqs: dict, inputs: dict, reader_targets: dict) -> None:
+    """
+    Sets up the weights of :py:func:`normalization_weights` and, when the selection stats contain
+    the sum of generated weights ``sum_mc_weight_generated`` (see
+    :py:func:`httcp.selection.main.custom_increment_stats`), rescales them by the ratio of the
+    processed to the generated weights. Weights then also account for events removed by a
+    NanoAOD-level skim, assuming that the skim efficiency does not depend on the process.
+    """
+    normalization_weights.setup_func(self, reqs, inputs, reader_targets)
+
+    stats = load_selection_stats(inputs)
+    sum_generated = stats.get("sum_mc_weight_generated")
+    if not sum_generated or not stats.get("sum_mc_weight"):
+        logger.warning(
+            f"no sum of generated weights in the selection stats of {self.dataset_inst.name}, "
+            "using the sum of processed weights",
+        )
+        return
+
+    self.process_weight_table *= stats["sum_mc_weight"] / sum_generated
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+"""
+Index-based representation of higgs candidates.
+
+Candidates are stored as a jagged record ``hcand`` with one entry per channel with a selected pair,
+in the order of :py:attr:`httcp.selection.event_category.PAIR_CHANNELS`, and the small integer
+fields ``channel`` (config channel id), ``leg1_coll``, ``leg1_idx``, ``leg2_coll`` and ``leg2_idx``
+(collection ids, see :py:attr:`COLLECTION_IDS`, and local object indices). Quantities of the legs are
+fetched on demand with :py:func:`gather_flat` and :py:func:`gather`.
+"""
+
+from __future__ import annotations
+
+from columnflow.production import Producer, producer
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column
+
+from httcp.util import layout_offsets, flat_column
+from httcp.selection.event_category import PAIR_CHANNELS
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# ids of the collections of candidate legs
+COLLECTION_IDS = {"Electron": 1, "Muon": 2, "Tau": 3}
+
+# collections of the two legs per channel
+CHANNEL_LEGS = {
+    "etau": ("Electron", "Tau"),
+    "mutau": ("Muon", "Tau"),
+    "tautau": ("Tau", "Tau"),
+}
+
+# fields of the candidate record and their dtypes
+CANDIDATE_FIELDS = {
+    "channel": np.int8,
+    "leg1_coll": np.int8,
+    "leg1_idx": np.int16,
+    "leg2_coll": np.int8,
+    "leg2_idx": np.int16,
+}
+
+
+def build_candidates(config_inst, pair_indices: dict[str, ak.Array]) -> ak.Array:
+    """
+    Returns the jagged candidate record for the *pair_indices* per channel name, each holding either
+    the two local indices of the legs of the selected pair or no index per event.
+    """
+    channels = [ch for ch in PAIR_CHANNELS if ch in pair_indices]
+    n_events = len(pair_indices[channels[0]])
+
+    # candidate fields per event and channel, and whether a pair was found
+    values = {field: np.zeros((n_events, len(channels)), dtype=dtype) for field, dtype in CANDIDATE_FIELDS.items()}
+    found = np.zeros((n_events, len(channels)), dtype=bool)
+    for c, ch in enumerate(channels):
+        indices = pair_indices[ch]
+        found[:, c] = np.asarray(ak.num(indices, axis=1)) == 2
+        padded = ak.fill_none(ak.pad_none(indices, 2, axis=1, clip=True), 0)
+        coll1, coll2 = CHANNEL_LEGS[ch]
+        values["channel"][:, c] = config_inst.get_channel(ch).id
+        values["leg1_coll"][:, c] = COLLECTION_IDS[coll1]
+        values["leg1_idx"][:, c] = np.asarray(padded[:, 0])
+        values["leg2_coll"][:, c] = COLLECTION_IDS[coll2]
+        values["leg2_idx"][:, c] = np.asarray(padded[:, 1])
+
+    # keep found pairs only, row-major so that the channel order is preserved per event
+    counts = found.sum(axis=1)
+    return ak.zip({
+        field: ak.unflatten(arr[found], counts)
+        for field, arr in values.items()
+    })
+
+
+def gather_flat(events: ak.Array, candidates: ak.Array, field: str, leg: int) -> np.ndarray:
+    """
+    Returns the values of *field* of leg *leg* (1 or 2) of all *candidates* as a flat array, with
+    the dtype of the field in the first of the involved collections.
+    """
+    coll_ids = flat_column(candidates[f"leg{leg}_coll"])
+    local_idx = flat_column(candidates[f"leg{leg}_idx"]).astype(np.int64)
+    event_idx = np.repeat(np.arange(len(candidates)), np.asarray(ak.num(candidates.channel, axis=1)))
+
+    out = None
+    for collection, coll_id in COLLECTION_IDS.items():
+        mask = coll_ids == coll_id
+        if not mask.any():
+            continue
+        column = events[collection][field]
+        flat = flat_column(column)
+        if out is None:
+            out = np.zeros(len(coll_ids), dtype=flat.dtype)
+        out[mask] = flat[layout_offsets(column)[event_idx[mask]] + local_idx[mask]]
+
+    return np.zeros(0, dtype=np.float32) if out is None else out
+
+
+def gather(events: ak.Array, candidates: ak.Array, field: str, leg: int) -> ak.Array:
+    """
+    Returns the values of *field* of leg *leg* (1 or 2) of all *candidates* with the jagged
+    structure of the candidates.
+    """
+    return ak.unflatten(
+        gather_flat(events, candidates, field, leg),
+        ak.num(candidates.channel, axis=1),
+    )
+
+
+@producer(
+    produces={f"hcand.{field}" for field in CANDIDATE_FIELDS},
+)
+def hcand_columns(self: Producer, events: ak.Array, hcand: ak.Array, **kwargs) -> ak.Array:
+    """
+    Stores the candidate record *hcand* as column ``hcand``.
+    """
+    return set_ak_column(events, "hcand", hcand)
@@ -0,0 +1,205 @@
+# coding: utf-8
+
+"""
+Declarative cut tables that are compiled into fused selection kernels.
+
+A cut table maps names of selections (e.g. ``"good"``, ``"veto"``) to lists of cuts
+``(name, variable, operator, threshold, use_abs)``, such as ``("muon_pt_26", "pt", ">", 26, False)``.
+Consecutive cuts with the same name form a single step. All selections of a table are evaluated by
+one generated and jit-compiled kernel that walks the objects of each event once in a given order,
+records the cumulative steps of the first selection, and collects the local indices of the objects
+passing each selection.
+
+Thresholds can be changed per config without code edits through the auxiliary entry
+``cut_overrides`` with the structure ``{table: {selection: {cut_name: threshold}}}``, e.g.
+``cfg.x.cut_overrides = {"muon": {"good": {"muon_pt_26": 28.0}}}``.
+"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+from columnflow.util import maybe_import
+
+from httcp.util import njit, as_threshold, layout_offsets, flat_column
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+OPERATORS = ("<", "<=", ">", ">=", "==", "!=")
+
+# compiled kernels per table structure, shared between tables that only differ in thresholds
+_kernel_cache = {}
+
+
+def cut_names(cuts: Sequence[tuple]) -> tuple[str]:
+    """
+    Returns the unique names of *cuts* in the order of their first appearance, i.e. the step names.
+    """
+    return tuple(dict.fromkeys(cut[0] for cut in cuts))
+
+
+def _generate_kernel_source(structure: tuple) -> str:
+    # structure: per selection a tuple of (variable position, operator, use_abs, step or -1)
+    n_vars = 1 + max(cut[0] for cuts in structure for cut in cuts)
+    n_steps = 1 + max(cut[3] for cut in structure[0])
+    n_sel = len(structure)
+
+    lines = [
+        f"def kernel(offsets, sorted_local, thr, {', '.join(f'c{i}' for i in range(n_vars))}):",
+        "    n_events = len(offsets) - 1",
+        f"    steps = np.zeros(({n_steps}, len(sorted_local)), dtype=np.bool_)",
+        f"    indices = np.empty(({n_sel}, len(sorted_local)), dtype=np.int32)",
+        f"    counts = np.zeros(({n_sel}, n_events), dtype=np.int64)",
+        f"    fill = np.zeros({n_sel}, dtype=np.int64)",
+        "    for i in range(n_events):",
+        "        start = offsets[i]",
+        "        for j in range(start, offsets[i + 1]):",
+        "            loc = sorted_local[j]",
+        "            k = start + loc",
+    ]
+    t = 0
+    for s, cuts in enumerate(structure):
+        lines.append("            passed = True")
+        for var, op, use_abs, step in cuts:
+            value = f"abs(c{var}[k])" if use_abs else f"c{var}[k]"
+            lines.append(f"            passed = passed and {value} {op} thr[{t}]")
+            if step >= 0:
+                lines.append(f"            steps[{step}, k] = passed")
+            t += 1
+        lines += [
+            "            if passed:",
+            f"                indices[{s}, fill[{s}]] = loc",
+            f"                fill[{s}] += 1",
+            f"                counts[{s}, i] += 1",
+        ]
+    lines.append("    return steps, indices, counts")
+
+    return "\n".join(lines) + "\n"
+
+
+def compile_kernel(structure: tuple):
+    if structure not in _kernel_cache:
+        namespace = {"np": np}
+        exec(_generate_kernel_source(structure), namespace)
+        _kernel_cache[structure] = njit(namespace["kernel"])
+    return _kernel_cache[structure]
+
+
+class CutTable(object):
+    """
+    Compiled version of a cut table *selections* (see module docstring), optionally updated with
+    thresholds in *overrides*. Calling the table with the offsets of the collection, the order in
+    which objects are visited per event, and a dictionary of flat columns per variable returns
+
+        - the cumulative step masks of the first selection, shape (n_steps, n_objects),
+        - the local indices passing each selection, in visiting order, shape (n_selections, n_objects),
+        - the number of passing objects per selection and event, shape (n_selections, n_events).
+
+    Thresholds are rounded to the precision of float columns (see :py:func:`httcp.util.as_threshold`)
+    so that all decisions are identical to plain comparisons of the columns.
+    """
+
+    def __init__(
+        self,
+        selections: dict[str, Sequence[tuple]],
+        overrides: dict[str, dict[str, float]] | None = None,
+    ):
+        super().__init__()
+
+        overrides = overrides or {}
+        unknown = set(overrides) - set(selections)
+        if unknown:
+            raise ValueError(f"cut overrides refer to unknown selections: {', '.join(sorted(unknown))}")
+
+        self.selections = {}
+        for sel_name, cuts in selections.items():
+            sel_overrides = dict(overrides.get(sel_name, {}))
+            unknown = set(sel_overrides) - set(cut_names(cuts))
+            if unknown:
+                raise ValueError(
+                    f"cut overrides of selection '{sel_name}' refer to unknown cuts: {', '.join(sorted(unknown))}",
+                )
+            for name, variable, op, threshold, use_abs in cuts:
+                if op not in OPERATORS:
+                    raise ValueError(f"unknown operator '{op}' in cut '{name}'")
+            self.selections[sel_name] = [
+                (name, variable, op, sel_overrides.get(name, threshold), use_abs)
+                for name, variable, op, threshold, use_abs in cuts
+            ]
+
+        # variables in order of appearance and names of the steps of the first selection
+        self.variables = tuple(dict.fromkeys(
+            cut[1]
+            for cuts in self.selections.values()
+            for cut in cuts
+        ))
+        first_cuts = next(iter(self.selections.values()))
+        self.step_names = cut_names(first_cuts)
+
+        # structure of the table, with steps being recorded at the last cut of each name
+        structure = []
+        for s, cuts in enumerate(self.selections.values()):
+            sel_structure = []
+            for c, (name, variable, op, _, use_abs) in enumerate(cuts):
+                is_last = s == 0 and (c == len(cuts) - 1 or cuts[c + 1][0] != name)
+                step = self.step_names.index(name) if is_last else -1
+                sel_structure.append((self.variables.index(variable), op, use_abs, step))
+            structure.append(tuple(sel_structure))
+        self.kernel = compile_kernel(tuple(structure))
+
+    @classmethod
+    def from_config(cls, config_inst, table_name: str, selections: dict[str, Sequence[tuple]]) -> CutTable:
+        """
+        Creates the table for *selections* with the overrides stored for *table_name* in the
+        ``cut_overrides`` auxiliary entry of *config_inst*, if any.
+        """
+        overrides = {}
+        if config_inst is not None and config_inst.has_aux("cut_overrides"):
+            overrides = config_inst.x.cut_overrides.get(table_name, {})
+        return cls(selections, overrides=overrides)
+
+    def thresholds(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        return np.array([
+            as_threshold(threshold, columns[variable])
+            for cuts in self.selections.values()
+            for _, variable, _, threshold, _ in cuts
+        ], dtype=np.float64)
+
+    def __call__(
+        self,
+        offsets: np.ndarray,
+        sorted_local: np.ndarray,
+        columns: dict[str, np.ndarray],
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self.kernel(
+            offsets,
+            sorted_local,
+            self.thresholds(columns),
+            *(columns[variable] for variable in self.variables),
+        )
+
+    def steps(self, offsets: np.ndarray, columns: dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Returns only the step masks of the first selection, visiting objects in their stored order.
+        """
+        counts = np.diff(offsets)
+        sorted_local = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], counts)
+        return self(offsets, sorted_local, columns)[0]
+
+    def jagged_steps(self, columns: dict[str, ak.Array]) -> dict[str, ak.Array]:
+        """
+        Evaluates the first selection on jagged *columns* with identical structure, e.g. quantities
+        of lepton pairs, and returns the cumulative step masks per step name.
+        """
+        first = columns[self.variables[0]]
+        steps = self.steps(
+            layout_offsets(first),
+            {variable: flat_column(columns[variable]) for variable in self.variables},
+        )
+        counts = ak.num(first, axis=1)
+        return {
+            name: ak.unflatten(steps[i], counts)
+            for i, name in enumerate(self.step_names)
+        }
@@ -10,6 +10,36 @@ np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+# channels with a dedicated pair selection, the position defines the bit in the channel mask
+PAIR_CHANNELS = ("etau", "mutau", "tautau")
+
+# maximum number of simultaneously found pairs for which a category is defined
+MAX_OVERLAPPING_CHANNELS = 2
+
+
+def channel_lookup(config_inst, channels=PAIR_CHANNELS) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    Returns a lookup table mapping channel bitmasks (bit *i* set when a pair of ``channels[i]`` was
+    found) to channel ids, as well as a dictionary that maps category step names such as
+    ``"cat_is_etau_mutau"`` to their bitmask. Overlaps are assigned the sum of the channel ids,
+    masks without a defined category are mapped to 0.
+    """
+    ids = [config_inst.get_channel(ch).id for ch in channels]
+    table = np.zeros(1 << len(channels), dtype=np.uint8)
+    step_masks = {}
+    for mask in range(1, len(table)):
+        bits = [i for i in range(len(channels)) if mask & (1 << i)]
+        if len(bits) > MAX_OVERLAPPING_CHANNELS:
+            continue
+        table[mask] = sum(ids[i] for i in bits)
+        step_masks["cat_is_" + "_".join(channels[i] for i in bits)] = mask
+
+    # keep single channel categories first
+    step_masks = dict(sorted(step_masks.items(), key=lambda item: bin(item[1]).count("1")))
+
+    return table, step_masks
+
+
 @selector(
     #uses={#
     #
@@ -28,51 +58,45 @@ def get_categories(
         tautau_pair_indices: ak.Array,
         **kwargs
 ) -> tuple[ak.Array, SelectionResult]:
-    # get channels from the config
-    ch_etau   = self.config_inst.get_channel("etau")
-    ch_mutau  = self.config_inst.get_channel("mutau")
-    ch_tautau = self.config_inst.get_channel("tautau")
-
-    false_mask       = (abs(events.event) < 0)
-    single_triggered = false_mask
-    cross_triggered  = false_mask
-    empty_indices    = ak.zeros_like(1 * events.event, dtype=np.uint16)[..., None][..., :0]
-
-    channel_selections = {
-        "cat_is_etau"           : [ch_etau.id, 
-                                   ((ak.num(etau_pair_indices, axis=1) == 2) 
-                                    & (ak.num(mutau_pair_indices, axis=1) == 0) 
-                                    & (ak.num(tautau_pair_indices, axis=1) == 0))],
-        "cat_is_mutau"          : [ch_mutau.id, 
-                                   ((ak.num(etau_pair_indices, axis=1) == 0) 
-                                    & (ak.num(mutau_pair_indices, axis=1) == 2) 
-                                    & (ak.num(tautau_pair_indices, axis=1) == 0))],
-        "cat_is_tautau"         : [ch_tautau.id, 
-                                   ((ak.num(etau_pair_indices, axis=1) == 0) 
-                                    & (ak.num(mutau_pair_indices, axis=1) == 0) 
-                                    & (ak.num(tautau_pair_indices, axis=1) == 2))],
-        "cat_is_etau_mutau"     : [ch_etau.id + ch_mutau.id, 
-                                   ((ak.num(etau_pair_indices, axis=1) == 2) 
-                                    & (ak.num(mutau_pair_indices, axis=1) == 2) 
-                                    & (ak.num(tautau_pair_indices, axis=1) == 0))],
-        "cat_is_etau_tautau"    : [ch_etau.id + ch_tautau.id, 
-                                   ((ak.num(etau_pair_indices, axis=1) == 2) 
-                                    & (ak.num(mutau_pair_indices, axis=1) == 0) 
-                                    & (ak.num(tautau_pair_indices, axis=1) == 2))], 
-        "cat_is_mutau_tautau"   : [ch_mutau.id + ch_tautau.id, 
-                                   ((ak.num(etau_pair_indices, axis=1) == 0) 
-                                    & (ak.num(mutau_pair_indices, axis=1) == 2) 
-                                    & (ak.num(tautau_pair_indices, axis=1) == 2))], 
+    """
+    Assigns the ``channel_id`` based on which of the channels in :py:attr:`PAIR_CHANNELS` have a
+    selected pair. Pair indices of further channels such as ``emu`` are taken from *kwargs* as
+    ``<channel>_pair_indices`` and are appended to the channels of the bitmask in their order.
+    """
+    pair_indices = {
+        "etau": etau_pair_indices,
+        "mutau": mutau_pair_indices,
+        "tautau": tautau_pair_indices,
+        **{
+            key[:-len("_pair_indices")]: indices
+            for key, indices in kwargs.items()
+            if key.endswith("_pair_indices")
+        },
+    }
+    channels = tuple(pair_indices)
+    if channels not in self.channel_lookups:
+        self.channel_lookups[channels] = channel_lookup(self.config_inst, channels)
+    channel_table, channel_step_masks = self.channel_lookups[channels]
+
+    # pack the found pairs into one small integer per event
+    channel_mask = np.zeros(len(events), dtype=np.uint8)
+    for bit, ch in enumerate(channels):
+        has_pair = np.asarray(ak.num(pair_indices[ch], axis=1)) == 2
+        channel_mask |= has_pair.astype(np.uint8) << np.uint8(bit)
+
+    channel_id = channel_table[channel_mask]
+    selection_steps = {
+        name: channel_mask == mask
+        for name, mask in channel_step_masks.items()
     }
 
-    selection_steps  = {}
-    channel_id       = np.uint8(1) * false_mask
-    for key, val in channel_selections.items():
-        selection_steps[key] = val[1]
-        channel_id = ak.where(val[1], val[0], channel_id)
-        
-    # some final type conversions
-    channel_id = ak.values_astype(channel_id, np.uint8)
     events = set_ak_column(events, "channel_id", channel_id)
 
     return events, SelectionResult(aux=selection_steps)
+
+
+@get_categories.init
+def get_categories_init(self: Selector) -> None:
+    self.channel_table, self.channel_step_masks = channel_lookup(self.config_inst)
+    # lookups per tuple of channels, extended when further channels are passed
+    self.channel_lookups = {PAIR_CHANNELS: (self.channel_table, self.channel_step_masks)}
@@ -0,0 +1,102 @@
+# coding: utf-8
+
+"""
+Exact per-file event and weight counts from NanoAOD metadata, cached on local disk.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+
+import law
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+uproot = maybe_import("uproot")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def default_cache_dir() -> str:
+    return os.path.join(os.getenv("HTTCP_BASE", os.getcwd()), ".data", "file_counts")
+
+
+def file_identity(path: str) -> str | None:
+    """
+    Returns a string identifying the file at *path* by its path, size and modification time. Files
+    that cannot be stat'ed, e.g. remote files, are identified by their path and the UUID stored in
+    their ROOT header, which changes whenever a file is written anew. *None* is returned when the
+    file cannot be identified at all, in which case nothing should be cached for it.
+    """
+    try:
+        stat = os.stat(path)
+        return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        pass
+
+    try:
+        with uproot.open(path) as f:
+            return f"{path}:{f.file.uuid}"
+    except Exception as e:
+        logger.warning(f"could not identify {path}: {e}")
+        return None
+
+
+def count_file(path: str) -> dict[str, float]:
+    """
+    Returns the number of generated events and the sum of generator weights for the NanoAOD file at
+    *path*. Both are taken from the ``Runs`` tree (``genEventCount`` and ``genEventSumw``), which also
+    covers events removed by a NanoAOD-level skim. When these branches are missing, e.g. for data,
+    the number of entries of the ``Events`` tree is used and only the ``genWeight`` branch is read,
+    if present.
+    """
+    with uproot.open(path) as f:
+        runs = f["Runs"] if "Runs" in f else None
+        if runs is not None and "genEventCount" in runs and "genEventSumw" in runs:
+            return {
+                "num_events": int(np.sum(runs["genEventCount"].array(library="np"))),
+                "sum_mc_weight": float(np.sum(runs["genEventSumw"].array(library="np"))),
+            }
+
+        tree = f["Events"]
+        num_events = int(tree.num_entries)
+        sum_mc_weight = (
+            float(np.sum(tree["genWeight"].array(library="np"), dtype=np.float64))
+            if "genWeight" in tree
+            else float(num_events)
+        )
+        return {"num_events": num_events, "sum_mc_weight": sum_mc_weight}
+
+
+def get_file_counts(path: str, cache_dir: str | None = None) -> dict[str, float]:
+    """
+    Cached version of :py:func:`count_file`. Results are stored as one json file per input file in
+    *cache_dir* (defaults to ``$HTTCP_BASE/.data/file_counts``), keyed by the
+    :py:func:`file_identity` of the input file, so that changed files are counted again. Files that
+    cannot be identified are counted without caching.
+    """
+    identity = file_identity(path)
+    if identity is None:
+        return count_file(path)
+
+    cache_dir = cache_dir or default_cache_dir()
+    cache_path = os.path.join(cache_dir, hashlib.sha256(identity.encode()).hexdigest() + ".json")
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return json.load(f)
+
+    counts = count_file(path)
+
+    # write atomically since several jobs might count the same file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(counts, f)
+    os.replace(tmp_path, cache_path)
+    logger.debug(f"counted {counts['num_events']} events in {path}")
+
+    return counts
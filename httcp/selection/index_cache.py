@@ -0,0 +1,111 @@
+# coding: utf-8
+
+"""
+Chunk-scoped cache of sorted and local indices of collections.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class IndexCache(object):
+    """
+    Cache of index arrays per chunk, created by the main selector and passed to the selectors it
+    calls as *index_cache*. Entries are keyed by collection and sort key, e.g. ``("Tau", "pt",
+    False)``, and remember the flat buffer of the column they were computed from. When the column was
+    replaced in the meantime, e.g. by ``set_ak_column`` in a calibrator or in a selector, the entry
+    is computed again.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self._entries = {}
+
+    @staticmethod
+    def _buffer_key(values: ak.Array) -> tuple[tuple[int, int]]:
+        # addresses and lengths of all index and data buffers from the outer list to the values
+        key = []
+        node = ak.to_layout(values)
+        while node is not None:
+            if isinstance(node, ak.contents.NumpyArray):
+                buffers = [node.data]
+            else:
+                buffers = [
+                    getattr(node, attr).data
+                    for attr in ("offsets", "starts", "stops", "index", "mask")
+                    if getattr(node, attr, None) is not None
+                ]
+            key.extend((buf.__array_interface__["data"][0], len(buf)) for buf in buffers)
+            node = getattr(node, "content", None)
+        return tuple(key)
+
+    def _get(self, key: tuple, column: ak.Array, compute) -> ak.Array:
+        buffer_key = self._buffer_key(column)
+        entry = self._entries.get(key)
+        # the cached column is kept alive by the entry, so its buffer address cannot be reused
+        if entry is None or entry[0] != buffer_key:
+            entry = self._entries[key] = (buffer_key, column, compute(column))
+        return entry[2]
+
+    def sorted_indices(
+        self,
+        events: ak.Array,
+        collection: str,
+        key: str = "pt",
+        ascending: bool = False,
+    ) -> ak.Array:
+        """
+        Returns the local indices of the objects in *collection* sorted by the field *key*.
+        """
+        column = Route(f"{collection}.{key}").apply(events)
+        return self._get(
+            ("sorted", collection, key, ascending),
+            column,
+            lambda values: ak.argsort(values, axis=-1, ascending=ascending),
+        )
+
+    def local_index(self, events: ak.Array, collection: str, key: str = "pt") -> ak.Array:
+        """
+        Returns the local indices of the objects in *collection*, whose structure is taken from the
+        field *key*.
+        """
+        column = Route(f"{collection}.{key}").apply(events)
+        return self._get(("local", collection, key), column, ak.local_index)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+def sorted_indices(
+    events: ak.Array,
+    collection: str,
+    key: str = "pt",
+    ascending: bool = False,
+    index_cache: IndexCache | None = None,
+) -> ak.Array:
+    """
+    Returns the local indices of *collection* sorted by *key*, taken from *index_cache* if given.
+    """
+    if index_cache is not None:
+        return index_cache.sorted_indices(events, collection, key=key, ascending=ascending)
+    return ak.argsort(Route(f"{collection}.{key}").apply(events), axis=-1, ascending=ascending)
+
+
+def local_index(
+    events: ak.Array,
+    collection: str,
+    key: str = "pt",
+    index_cache: IndexCache | None = None,
+) -> ak.Array:
+    """
+    Returns the local indices of *collection*, taken from *index_cache* if given.
+    """
+    if index_cache is not None:
+        return index_cache.local_index(events, collection, key=key)
+    return ak.local_index(Route(f"{collection}.{key}").apply(events))
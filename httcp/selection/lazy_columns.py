@@ -0,0 +1,171 @@
+# coding: utf-8
+
+"""
+Deferred reading of NanoAOD columns for selector inputs.
+
+The reader is only used by the local executor (see :py:mod:`httcp.selection.local_executor`), which
+passes it to the selector as *lazy_columns*. ``cf.SelectEvents`` reads all columns of the selector
+up front and does not defer any of them.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable
+
+import law
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, has_ak_column, set_ak_column
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+uproot = maybe_import("uproot")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def branch_name(column: str | Route) -> str:
+    """
+    Returns the flat NanoAOD branch name of a *column*, e.g. ``"Muon_pt"`` for ``"Muon.pt"``.
+    """
+    return "_".join(Route(column).fields)
+
+
+def nano_route(column: str | Route) -> Route:
+    """
+    Returns the route of a *column* in events structured like the NanoAOD schema of the columnflow
+    reader, where branches are grouped by the prefix before their first underscore, e.g.
+    ``"HLT.IsoMu24"`` for ``"HLT_IsoMu24"`` and ``"Muon.pt"`` for ``"Muon_pt"`` or ``"Muon.pt"``.
+    """
+    return Route(branch_name(column).split("_", 1))
+
+
+def is_optional(column: str | Route) -> bool:
+    # optional columns are routes tagged "optional", e.g. via columnflow's optional_column
+    return callable(getattr(column, "has_tag", None)) and column.has_tag("optional")
+
+
+class LazyColumns(object):
+    """
+    Reader of NanoAOD branches from an uproot *tree* within an entry range, used to defer reading
+    columns until a selector needs them. Columns are read with :py:meth:`read` or
+    :py:meth:`attach`. When they are restricted to a subset of events via a boolean *keep* mask,
+    only the baskets containing kept events are read and decompressed.
+
+    Column names follow the columnflow notation, e.g. ``"Muon.pt"`` or ``"HLT_IsoMu24"``. They are
+    translated into flat branch names and attached at their location in the NanoAOD schema (see
+    :py:func:`nano_route`). Optional columns whose branches do not exist are skipped. All branches
+    from which entries were read are recorded, so that declared columns that were never read can
+    be reported with :py:meth:`untouched` and :py:meth:`report_untouched`.
+    """
+
+    def __init__(
+        self,
+        tree: uproot.TTree,
+        entry_start: int | None = None,
+        entry_stop: int | None = None,
+    ):
+        super().__init__()
+
+        self.tree = tree
+        self.entry_start = entry_start or 0
+        self.entry_stop = tree.num_entries if entry_stop is None else entry_stop
+        self.branches = set(tree.keys())
+
+        # cache of columns read for the full entry range and names of all read branches
+        self._cache = {}
+        self.read_branches = set()
+
+    @classmethod
+    def open(cls, path: str, treepath: str = "Events", **kwargs) -> LazyColumns:
+        return cls(uproot.open(path)[treepath], **kwargs)
+
+    def has(self, column: str | Route) -> bool:
+        return branch_name(column) in self.branches
+
+    def _read_kept(self, branch: uproot.TBranch, keep: np.ndarray) -> ak.Array:
+        # read only the baskets that contain kept entries, merging adjacent ones into single ranges
+        kept = self.entry_start + np.flatnonzero(keep)
+        if not len(kept):
+            return branch.array(entry_start=self.entry_start, entry_stop=self.entry_start, library="ak")
+        basket_offsets = np.asarray(branch.entry_offsets)
+        baskets = np.unique(np.searchsorted(basket_offsets, kept, side="right") - 1)
+        breaks = np.flatnonzero(np.diff(baskets) > 1) + 1
+        pieces = []
+        for group in np.split(baskets, breaks):
+            start = max(int(basket_offsets[group[0]]), self.entry_start)
+            stop = min(int(basket_offsets[group[-1] + 1]), self.entry_stop)
+            values = branch.array(entry_start=start, entry_stop=stop, library="ak")
+            local = kept[(kept >= start) & (kept < stop)] - start
+            pieces.append(values[local])
+        return pieces[0] if len(pieces) == 1 else ak.concatenate(pieces, axis=0)
+
+    def read(self, column: str | Route, keep: np.ndarray | None = None) -> ak.Array:
+        """
+        Returns the values of a *column*, optionally restricted to events selected by the boolean
+        *keep* mask over the entry range.
+        """
+        name = branch_name(column)
+        if name not in self.branches:
+            raise KeyError(f"branch '{name}' of column '{Route(column)}' not found in tree {self.tree.name}")
+
+        if name in self._cache:
+            values = self._cache[name]
+            return values if keep is None else values[keep]
+        if keep is not None:
+            keep = np.asarray(keep)
+            if keep.any():
+                self.read_branches.add(name)
+            return self._read_kept(self.tree[name], keep)
+
+        self.read_branches.add(name)
+
+        self._cache[name] = self.tree[name].array(
+            entry_start=self.entry_start,
+            entry_stop=self.entry_stop,
+            library="ak",
+        )
+        return self._cache[name]
+
+    def attach(
+        self,
+        events: ak.Array,
+        columns: Iterable[str | Route],
+        keep: np.ndarray | None = None,
+    ) -> ak.Array:
+        """
+        Adds all *columns* that are not yet present in *events*, skipping missing optional ones.
+        When *events* is a subset of the entry range, *keep* must be the boolean mask that was used
+        to obtain it.
+        """
+        for column in columns:
+            route = nano_route(column)
+            if has_ak_column(events, route):
+                continue
+            if not self.has(column):
+                if is_optional(column):
+                    logger.debug(f"skipping missing optional column {route}")
+                    continue
+            events = set_ak_column(events, route, self.read(column, keep=keep))
+        return events
+
+    def untouched(self, declared: Iterable[str | Route]) -> set[str]:
+        """
+        Returns the *declared* columns whose branches exist but were never read, e.g. columns of the
+        candidate selection in chunks without any event passing the preceding steps.
+        """
+        return {
+            str(Route(column))
+            for column in declared
+            if self.has(column) and branch_name(column) not in self.read_branches
+        }
+
+    def report_untouched(self, declared: Iterable[str | Route]) -> set[str]:
+        untouched = self.untouched(declared)
+        if untouched:
+            logger.info(
+                f"{len(untouched)} declared columns were never read in entries {self.entry_start} to "
+                f"{self.entry_stop}: {', '.join(sorted(untouched))}",
+            )
+        return untouched
@@ -5,12 +5,14 @@ Prepare h-Candidate from SelectionResult: selected lepton indices & channel_id [
 """
 
 from typing import Optional
-from columnflow.selection import SelectionResult
+from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 
-from hcp.util import invariant_mass, deltaR, transverse_mass
+from httcp.fourvector import delta_r, transverse_mass
+from httcp.selection.pair_ranking import get_best_pair
+from httcp.selection.cut_tables import CutTable
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -18,80 +20,20 @@ coffea = maybe_import("coffea")
 maybe_import("coffea.nanoevents.methods.nanoaod")
 
 
-def get_sorted_pair(
-        dtrpairs: ak.Array,
-        dtrpairindices: ak.Array
-)->ak.Array:
-
-    sorted_idx = ak.argsort(dtrpairs["0"].pfRelIso03_all, ascending=True)
-    # Sort the pairs based on pfRelIso03_all of the first object in each pair
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # Extract the pfRelIso03_all values for the first object in each pair
-    lep1_pfRelIso03_all = dtrpairs["0"].pfRelIso03_all
-    # Check if the pfRelIso03_all values are the same for the first two objects in each pair
-    where_same_iso_1 = ak.fill_none(
-        (
-            ak.firsts(dtrpairs["0"].pfRelIso03_all[:,:1], axis=1) 
-            ==
-            ak.firsts(dtrpairs["0"].pfRelIso03_all[:,1:2], axis=1)
-        ), False
-    )
-    
-    # Sort the pairs based on pt if pfRelIso03_all is the same for the first two objects
-    sorted_idx = ak.where(where_same_iso_1,
-                          ak.argsort(dtrpairs["0"].pt, ascending=False),
-                          sorted_idx)
-
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # Check if the pt values are the same for the first two objects in each pair    
-    where_same_pt_1 = ak.fill_none(
-        (
-            ak.firsts(dtrpairs["0"].pt[:,:1], axis=1)
-            ==
-            ak.firsts(dtrpairs["0"].pt[:,1:2], axis=1)
-        ), False
-    )
-    
-    # if so, sort the pairs with tau rawDeepTau2017v2p1VSjet
-    sorted_idx = ak.where(where_same_pt_1,
-                          ak.argsort(dtrpairs["1"].pfRelIso03_all, ascending=False),
-                          sorted_idx)
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-    # check if the first two pairs have taus with same rawDeepTau2017v2p1VSjet
-    where_same_iso_2 = ak.fill_none(
-        (
-            ak.firsts(dtrpairs["1"].pfRelIso03_all[:,:1], axis=1)
-            ==
-            ak.firsts(dtrpairs["1"].pfRelIso03_all[:,1:2], axis=1)
-        ), False
-    )
-    
-    # Sort the pairs based on pt if rawDeepTau2017v2p1VSjet is the same for the first two objects
-    sorted_idx = ak.where(where_same_iso_2,
-                          ak.argsort(dtrpairs["1"].pt, ascending=False),
-                          sorted_idx)
-    # finally, the pairs are sorted
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # Extract the first object in each pair (lep1) and the second object (lep2)
-    lep1 = ak.singletons(ak.firsts(dtrpairs["0"], axis=1))
-    lep2 = ak.singletons(ak.firsts(dtrpairs["1"], axis=1))
-
-    lep1idx = ak.singletons(ak.firsts(dtrpairindices["0"], axis=1))
-    lep2idx = ak.singletons(ak.firsts(dtrpairindices["1"], axis=1))
-
-    # Concatenate lep1 and lep2 to create the final dtrpair
-    dtrpair    = ak.concatenate([lep1, lep2], axis=1)
-    dtrpairidx = ak.concatenate([lep1idx, lep2idx], axis=1)
-
-    return dtrpairidx
+# preselection of emu pairs as (name, variable, operator, threshold, use_abs)
+PAIR_PRESELECTION = [
+    ("emu_is_os", "charge_product", "<", 0, False),
+    ("emu_dr_0p5", "delta_r", ">", 0.5, False),
+    ("emu_mT_50", "mt", "<", 50, False),
+]
 
+# ranking of emu pairs: most isolated electron, highest electron pt, most isolated muon, highest muon pt
+PAIR_RANKING = [
+    ("0", "pfRelIso03_all", True),
+    ("0", "pt", False),
+    ("1", "pfRelIso03_all", True),
+    ("1", "pt", False),
+]
 
 
 @selector(
@@ -115,36 +57,37 @@ def emu_selection(
     lep_indices_pair = ak.cartesian([lep1_indices, 
                                      lep2_indices], axis=1)
     leps_pair        = ak.cartesian([events.Electron[lep1_indices], 
-                                     events.Tau[lep2_indices]], axis=1)
+                                     events.Muon[lep2_indices]], axis=1)
     
     # pair of leptons: probable higgs candidate -> leps_pair
     # and their indices                         -> lep_indices_pair 
     lep1, lep2 = ak.unzip(leps_pair)
     lep1_idx, lep2_idx = ak.unzip(lep_indices_pair)
 
-    preselection = {
-        "is_os"         : (lep1.charge * lep2.charge) < 0,
-        "dr_0p5"        : deltaR(lep1, lep2) > 0.5,
-        "mT_50"         : transverse_mass(lep1, events.MET) < 50
-    }
-
-    good_pair_mask = lep1_idx >= 0
-    pair_selection_steps = {}
-    for cut in preselection.keys():
-        good_pair_mask = good_pair_mask & preselection[cut]
-        pair_selection_steps[cut] = ak.sum(preselection[cut], axis=1) > 0
-        
+    pair_selection_steps = self.cut_table.jagged_steps({
+        "charge_product": lep1.charge * lep2.charge,
+        "delta_r": delta_r(lep1, lep2),
+        "mt": transverse_mass(lep1, events.MET),
+    })
+    good_pair_mask = pair_selection_steps[self.cut_table.step_names[-1]]
 
     leps_pair_sel = leps_pair[good_pair_mask]
     lep_indices_pair_sel = lep_indices_pair[good_pair_mask]
 
-    where_many   = ak.num(lep_indices_pair_sel, axis=1) > 1
-    pair_indices = ak.where(where_many, 
-                            get_sorted_pair(leps_pair_sel,
-                                            lep_indices_pair_sel),
-                            lep_indices_pair_sel)
+    # if multipairs, pick the best one according to Section 7.6
+    pair_indices = get_best_pair(leps_pair_sel, lep_indices_pair_sel, PAIR_RANKING)
 
 
     return events, SelectionResult(
-        steps = pair_selection_steps,
+        # events with at least one pair passing all cuts up to each step
+        steps = {name: ak.any(mask, axis=1) for name, mask in pair_selection_steps.items()},
     ), pair_indices
+
+
+@emu_selection.init
+def emu_selection_init(self: Selector) -> None:
+    self.cut_table = CutTable.from_config(
+        getattr(self, "config_inst", None),
+        "emu",
+        {"pair": PAIR_PRESELECTION},
+    )
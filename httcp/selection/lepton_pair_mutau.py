@@ -10,7 +10,9 @@ from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 
-from httcp.util import transverse_mass
+from httcp.fourvector import delta_r, invariant_mass, transverse_mass
+from httcp.selection.pair_ranking import get_best_pair
+from httcp.selection.cut_tables import CutTable
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -19,72 +21,21 @@ maybe_import("coffea.nanoevents.methods.nanoaod")
 
 
 
-def get_sorted_pair(
-        dtrpairs: ak.Array,
-        dtrpairindices: ak.Array
-)->ak.Array:
-
-    sorted_idx = ak.argsort(dtrpairs["0"].pfRelIso03_all, ascending=True)
-
-    # Sort the pairs based on pfRelIso03_all of the first object in each pair
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # Check if the pfRelIso03_all values are the same for the first two objects in each pair
-    where_same_iso_1 = (
-        ak.firsts(dtrpairs["0"].pfRelIso03_all[:,:1], axis=1)
-        ==
-        ak.firsts(dtrpairs["0"].pfRelIso03_all[:,1:2], axis=1)
-    )
-    # Sort the pairs based on pt if pfRelIso03_all is the same for the first two objects
-    sorted_idx = ak.where(where_same_iso_1,
-                          ak.argsort(dtrpairs["0"].pt, ascending=False),
-                          sorted_idx)
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # Check if the pt values are the same for the first two objects in each pair    
-    where_same_pt_1 = (
-        ak.firsts(dtrpairs["0"].pt[:,:1], axis=1)
-        ==
-        ak.firsts(dtrpairs["0"].pt[:,1:2], axis=1)
-    )
-
-    # if so, sort the pairs with tau rawDeepTau2017v2p1VSjet
-    sorted_idx = ak.where(where_same_pt_1,
-                          ak.argsort(dtrpairs["1"].rawDeepTau2018v2p5VSjet, ascending=False),
-                          sorted_idx)
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # check if the first two pairs have taus with same rawDeepTau2017v2p1VSjet
-    where_same_iso_2 = (
-        ak.firsts(dtrpairs["1"].rawDeepTau2018v2p5VSjet[:,:1], axis=1)
-        ==
-        ak.firsts(dtrpairs["1"].rawDeepTau2018v2p5VSjet[:,1:2], axis=1)
-    )
-    # Sort the pairs based on pt if rawDeepTau2017v2p1VSjet is the same for the first two objects
-    sorted_idx = ak.where(where_same_iso_2,
-                          ak.argsort(dtrpairs["1"].pt, ascending=False),
-                          sorted_idx)
-    # finally, the pairs are sorted
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # Extract the first object in each pair (lep1) and the second object (lep2)
-    lep1 = ak.singletons(ak.firsts(dtrpairs["0"], axis=1))
-    lep2 = ak.singletons(ak.firsts(dtrpairs["1"], axis=1))
-
-    lep1idx = ak.singletons(ak.firsts(dtrpairindices["0"], axis=1))
-    lep2idx = ak.singletons(ak.firsts(dtrpairindices["1"], axis=1))
-
-    # Concatenate lep1 and lep2 to create the final dtrpair
-    dtrpair    = ak.concatenate([lep1, lep2], axis=1)
-    dtrpairidx = ak.concatenate([lep1idx, lep2idx], axis=1)
-
-    return dtrpairidx
-
+# preselection of mutau pairs as (name, variable, operator, threshold, use_abs)
+PAIR_PRESELECTION = [
+    ("mutau_is_os", "charge_product", "<", 0, False),
+    ("mutau_dr_0p5", "delta_r", ">", 0.5, False),
+    ("mutau_mT_50", "mt", "<", 50, False),
+    ("mutau_invmass_40", "mass", ">", 40, False),
+]
 
+# ranking of mutau pairs: most isolated muon, highest muon pt, most isolated tau, highest tau pt
+PAIR_RANKING = [
+    ("0", "pfRelIso03_all", True),
+    ("0", "pt", False),
+    ("1", "rawDeepTau2018v2p5VSjet", False),
+    ("1", "pt", False),
+]
 
 
 @selector(
@@ -108,15 +59,6 @@ def mutau_selection(
         **kwargs,
 ) -> tuple[ak.Array, SelectionResult, ak.Array]:
 
-    # Sorting lep1 [Electron] by isolation [ascending]
-    lep1_sort_key       = events.Muon[lep1_indices].pfRelIso03_all
-    lep1_sorted_indices = ak.argsort(lep1_sort_key, axis=-1, ascending=True)
-    lep1_indices        = lep1_indices[lep1_sorted_indices]
-    # Sorting lep2 [Tau] by DeepTau [descending]
-    lep2_sort_key       = events.Tau[lep2_indices].rawDeepTau2018v2p5VSjet
-    lep2_sorted_indices = ak.argsort(lep2_sort_key, axis=-1, ascending=False)
-    lep2_indices        = lep2_indices[lep2_sorted_indices]
-
     leps_pair        = ak.cartesian([events.Muon[lep1_indices], 
                                      events.Tau[lep2_indices]], axis=1)
     lep_indices_pair = ak.cartesian([lep1_indices, lep2_indices], axis=1)
@@ -126,34 +68,35 @@ def mutau_selection(
     lep1, lep2 = ak.unzip(leps_pair)
     lep1_idx, lep2_idx = ak.unzip(lep_indices_pair)
 
-    preselection = {
-        "mutau_is_os"         : (lep1.charge * lep2.charge) < 0,
-        "mutau_dr_0p5"        : (1*lep1).delta_r(1*lep2) > 0.5,  #deltaR(lep1, lep2) > 0.5,
-        "mutau_mT_50"         : transverse_mass(lep1, events.MET) < 50,
-        "mutau_invmass_40"    : (1*lep1 + 1*lep2).mass > 40,  # invariant_mass(lep1, lep2) > 40
+    pair_columns = {
+        "charge_product": lep1.charge * lep2.charge,
+        "delta_r": delta_r(lep1, lep2),
+        "mt": transverse_mass(lep1, events.MET),
+        "mass": invariant_mass(lep1, lep2),
     }
+    pair_selection_steps = self.cut_table.jagged_steps(pair_columns)
+    good_pair_mask = pair_selection_steps[self.cut_table.step_names[-1]]
 
-    good_pair_mask = lep1_idx >= 0
-    pair_selection_steps = {}
-    for cut in preselection.keys():
-        good_pair_mask = good_pair_mask & preselection[cut]
-        pair_selection_steps[cut] = good_pair_mask
-        
     leps_pair_sel = leps_pair[good_pair_mask]
     lep_indices_pair_sel = lep_indices_pair[good_pair_mask]
 
-    lep1idx = ak.singletons(ak.firsts(lep_indices_pair_sel["0"], axis=1))
-    lep2idx = ak.singletons(ak.firsts(lep_indices_pair_sel["1"], axis=1))
-
-    lep_indices_pair_sel_single = ak.concatenate([lep1idx, lep2idx], axis=1)
+    # if multipairs, pick the best one according to Section 7.6
+    pair_indices = get_best_pair(leps_pair_sel, lep_indices_pair_sel, self.pair_ranking)
 
-
-    where_many   = ak.num(lep_indices_pair_sel, axis=1) > 1
-    pair_indices = ak.where(where_many, 
-                            get_sorted_pair(leps_pair_sel,
-                                            lep_indices_pair_sel),
-                            lep_indices_pair_sel_single)
+    # keep the pairs for the re-evaluation of the MET dependent cuts in shifts of the main selector
+    if kwargs.get("pair_cache") is not None:
+        kwargs["pair_cache"]["mutau"] = (leps_pair, lep_indices_pair, pair_columns)
 
     return SelectionResult(
         aux = pair_selection_steps,
     ), pair_indices
+
+
+@mutau_selection.init
+def mutau_selection_init(self: Selector) -> None:
+    self.cut_table = CutTable.from_config(
+        getattr(self, "config_inst", None),
+        "mutau",
+        {"pair": PAIR_PRESELECTION},
+    )
+    self.pair_ranking = PAIR_RANKING
@@ -10,6 +10,11 @@ from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 
+from httcp.fourvector import delta_r
+from httcp.selection.pair_ranking import get_best_pair
+from httcp.selection.cut_tables import CutTable
+from httcp.selection.index_cache import sorted_indices
+from httcp.util import layout_offsets, flat_column
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -18,69 +23,25 @@ maybe_import("coffea.nanoevents.methods.nanoaod")
 
 
 
-def get_sorted_pair(
-        dtrpairs: ak.Array,
-        dtrpairindices: ak.Array,
-)->ak.Array:
-    # redundant, because taus were sorted by the deeptau before
-    sorted_idx = ak.argsort(dtrpairs["0"].rawDeepTau2018v2p5VSjet, ascending=False)
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    # if the deep tau val of tau-0 is the same for the first two pair
-    where_same_iso_1 = (
-        ak.firsts(dtrpairs["0"].rawDeepTau2018v2p5VSjet[:,:1], axis=1)
-        ==
-        ak.firsts(dtrpairs["0"].rawDeepTau2018v2p5VSjet[:,1:2], axis=1)
-    )
-
-    # if so, sort the pairs according to the deep tau of the 2nd tau
-    sorted_idx = ak.where(where_same_iso_1,
-                          ak.argsort(dtrpairs["1"].rawDeepTau2018v2p5VSjet, ascending=False),
-                          sorted_idx)
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-    # if the deep tau val of tau-1 is the same for the first two pair 
-    where_same_iso_2 = (
-        ak.firsts(dtrpairs["1"].rawDeepTau2018v2p5VSjet[:,:1], axis=1)
-        ==
-        ak.firsts(dtrpairs["1"].rawDeepTau2018v2p5VSjet[:,1:2], axis=1)
-    )
-
-    # sort them with the pt of the 1st tau
-    sorted_idx = ak.where(where_same_iso_2,
-                          ak.argsort(dtrpairs["0"].pt, ascending=False),
-                          sorted_idx)
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-    # check if the first two pairs have the second tau with same rawDeepTau2017v2p1VSjet
-    where_same_pt_1 = (
-        ak.firsts(dtrpairs["0"].pt[:,:1], axis=1)
-        ==
-        ak.firsts(dtrpairs["0"].pt[:,1:2], axis=1)
-    )
-
-    # if so, sort the taus with their pt
-    sorted_idx = ak.where(where_same_pt_1,
-                          ak.argsort(dtrpairs["1"].pt, ascending=False),
-                          sorted_idx)
-
-    # finally, the pairs are sorted
-    dtrpairs = dtrpairs[sorted_idx]
-    dtrpairindices = dtrpairindices[sorted_idx]
-
-    lep1 = ak.singletons(ak.firsts(dtrpairs["0"], axis=1))
-    lep2 = ak.singletons(ak.firsts(dtrpairs["1"], axis=1))
-
-    lep1idx = ak.singletons(ak.firsts(dtrpairindices["0"], axis=1))
-    lep2idx = ak.singletons(ak.firsts(dtrpairindices["1"], axis=1))
-    # print(f"lep1 pt: {lep1.pt}")
-    # print(f"lep2 pt: {lep2.pt}")
-    dtrpair    = ak.concatenate([lep1, lep2], axis=1) 
-    dtrpairidx = ak.concatenate([lep1idx, lep2idx], axis=1)     
-
-    return dtrpairidx
+# preselection of tautau pairs as (name, variable, operator, threshold, use_abs), where cuts with
+# the same name form one step
+PAIR_PRESELECTION = [
+    ("tautau_is_pt_40", "pt1", ">", 40, False),
+    ("tautau_is_pt_40", "pt2", ">", 40, False),
+    ("tautau_is_eta_2p1", "eta1", "<", 2.1, True),
+    ("tautau_is_eta_2p1", "eta2", "<", 2.1, True),
+    ("tautau_is_os", "charge_product", "<", 0, False),
+    ("tautau_dr_0p5", "delta_r", ">", 0.5, False),
+]
 
+# ranking of tautau pairs: most isolated leading tau, most isolated subleading tau, highest pt of the
+# leading and subleading tau
+PAIR_RANKING = [
+    ("0", "rawDeepTau2018v2p5VSjet", False),
+    ("1", "rawDeepTau2018v2p5VSjet", False),
+    ("0", "pt", False),
+    ("1", "pt", False),
+]
 
 
 @selector(
@@ -97,10 +58,16 @@ def tautau_selection(
         **kwargs,
 ) -> tuple[ak.Array, SelectionResult, ak.Array]:
 
-    # Sorting leps [Tau] by deeptau [descending]
-    lep_sort_key       = events.Tau[lep_indices].rawDeepTau2018v2p5VSjet
-    lep_sorted_indices = ak.argsort(lep_sort_key, axis=-1, ascending=False)
-    lep_indices        = lep_indices[lep_sorted_indices]
+    # Sorting leps [Tau] by deeptau [descending], taking the order of all taus (shared per chunk)
+    # and keeping the selected ones
+    tau_sorted_indices = sorted_indices(events, "Tau", key="rawDeepTau2018v2p5VSjet",
+                                        index_cache=kwargs.get("index_cache"))
+    tau_counts   = ak.num(events.Tau.pt, axis=1)
+    tau_offsets  = layout_offsets(events.Tau.pt)
+    is_selected  = np.zeros(tau_offsets[-1], dtype=bool)
+    is_selected[np.repeat(tau_offsets[:-1], ak.num(lep_indices, axis=1)) + flat_column(lep_indices)] = True
+    is_selected  = ak.unflatten(is_selected, tau_counts)
+    lep_indices  = ak.values_astype(tau_sorted_indices[is_selected[tau_sorted_indices]], np.int32)
 
     leps_pair        = ak.combinations(events.Tau[lep_indices], 2, axis=1)
     lep_indices_pair = ak.combinations(lep_indices, 2, axis=1)
@@ -110,33 +77,31 @@ def tautau_selection(
     lep1, lep2 = ak.unzip(leps_pair)
     lep1_idx, lep2_idx = ak.unzip(lep_indices_pair)
 
-    preselection = {
-        "tautau_is_pt_40"      : (lep1.pt > 40) & (lep2.pt > 40),
-        "tautau_is_eta_2p1"    : (np.abs(lep1.eta) < 2.1) & (np.abs(lep2.eta) < 2.1),
-        "tautau_is_os"         : (lep1.charge * lep2.charge) < 0,
-        "tautau_dr_0p5"        : (1*lep1).delta_r(1*lep2) > 0.5,  #deltaR(lep1, lep2) > 0.5,
-    }
-
-    good_pair_mask = lep1_idx >= 0
-    pair_selection_steps = {}
-    for cut in preselection.keys():
-        good_pair_mask = good_pair_mask & preselection[cut]
-        pair_selection_steps[cut] = good_pair_mask
-        
+    pair_selection_steps = self.cut_table.jagged_steps({
+        "pt1": lep1.pt,
+        "pt2": lep2.pt,
+        "eta1": lep1.eta,
+        "eta2": lep2.eta,
+        "charge_product": lep1.charge * lep2.charge,
+        "delta_r": delta_r(lep1, lep2),
+    })
+    good_pair_mask = pair_selection_steps[self.cut_table.step_names[-1]]
+
     leps_pair_sel = leps_pair[good_pair_mask]
     lep_indices_pair_sel = lep_indices_pair[good_pair_mask]
 
-    lep1idx = ak.singletons(ak.firsts(lep_indices_pair_sel["0"], axis=1))
-    lep2idx = ak.singletons(ak.firsts(lep_indices_pair_sel["1"], axis=1))
-
-    lep_indices_pair_sel_single = ak.concatenate([lep1idx, lep2idx], axis=1)
-
-    where_many   = ak.num(lep_indices_pair_sel, axis=1) > 1
-    pair_indices = ak.where(where_many, 
-                            get_sorted_pair(leps_pair_sel,
-                                            lep_indices_pair_sel),
-                            lep_indices_pair_sel_single)
+    # if multipairs, pick the best one according to Section 7.6
+    pair_indices = get_best_pair(leps_pair_sel, lep_indices_pair_sel, PAIR_RANKING)
 
     return SelectionResult(
         aux = pair_selection_steps,
     ), pair_indices
+
+
+@tautau_selection.init
+def tautau_selection_init(self: Selector) -> None:
+    self.cut_table = CutTable.from_config(
+        getattr(self, "config_inst", None),
+        "tautau",
+        {"pair": PAIR_PRESELECTION},
+    )
@@ -6,21 +6,57 @@ https://cms.cern.ch/iCMS/analysisadmin/cadilines?id=2325&ancode=HIG-20-006&tp=an
 http://cms.cern.ch/iCMS/jsp/openfile.jsp?tp=draft&files=AN2019_192_v15.pdf
 """
 
+from __future__ import annotations
+
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.columnar_util import set_ak_column
 from columnflow.util import maybe_import, DotDict
 
+from httcp.util import njit, layout_offsets, flat_column
+from httcp.fourvector import delta_r2_kernel
+from httcp.selection.candidates import gather_flat
 
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
-coffea = maybe_import("coffea")
-maybe_import("coffea.nanoevents.methods.nanoaod")
+
+
+@njit(cache=True)
+def _extra_lepton_veto_kernel(
+    leg_offsets, leg_eta, leg_phi,
+    mu_offsets, mu_eta, mu_phi,
+    el_offsets, el_eta, el_phi,
+):
+    # legs are stored as consecutive (lep1, lep2) pairs per event, and an extra lepton counts when
+    # it is separated from the second leg by dR > 0.5 while not being the first leg itself
+    # (dR > 0.001), or when it is separated from the first leg by dR > 0.5
+    has_extra = np.zeros(len(leg_offsets) - 1, dtype=np.bool_)
+
+    for i in range(len(leg_offsets) - 1):
+        for p in range(leg_offsets[i], leg_offsets[i + 1] - 1, 2):
+            for c in range(2):
+                offsets = mu_offsets if c == 0 else el_offsets
+                eta = mu_eta if c == 0 else el_eta
+                phi = mu_phi if c == 0 else el_phi
+                for k in range(offsets[i], offsets[i + 1]):
+                    dr2_1 = delta_r2_kernel(eta[k], phi[k], leg_eta[p], leg_phi[p])
+                    dr2_2 = delta_r2_kernel(eta[k], phi[k], leg_eta[p + 1], leg_phi[p + 1])
+                    if (dr2_2 > 0.25 and dr2_1 > 1e-6) or dr2_1 > 0.25:
+                        has_extra[i] = True
+                        break
+                if has_extra[i]:
+                    break
+            if has_extra[i]:
+                break
+
+    return has_extra
+
 
 @selector(
     uses={
-        "Muon.pt", "Muon.eta", "Muon.phi", "Muon.mass",
-        "Electron.pt", "Electron.eta", "Electron.phi", "Electron.mass",
+        "Muon.eta", "Muon.phi",
+        "Electron.eta", "Electron.phi",
+        "Tau.eta", "Tau.phi",
     },
     exposed=False,
 )
@@ -29,48 +65,80 @@ def extra_lepton_veto(
         events: ak.Array,
         extra_electron_index: ak.Array,
         extra_muon_index: ak.Array,
-        hcand_pair: ak.Array,
+        hcand: ak.Array,
         **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
-
-    extra_lep  = ak.Array(ak.concatenate([events.Muon[extra_muon_index],
-                                          events.Electron[extra_electron_index]], axis=-1),
-                          behavior=coffea.nanoevents.methods.nanoaod.behavior)
-    extra_lep  = ak.with_name(extra_lep, "PtEtaPhiMLorentzVector")
-
-    has_single_pair = ak.num(hcand_pair.pt, axis=1) == 2
-    # keep all True -> [[True], [True], [True], ..., [True]]
-    # because, not applying any veto if there is more than one higgs cand pair
-    # and keeping those events for now
-    dummy = (events.event < 0)[:,None]
-    hcand_pair_p4 = ak.firsts(1 * hcand_pair, axis=1)
-    hcand_lep1 = hcand_pair_p4[:,:1]
-    hcand_lep2 = hcand_pair_p4[:,1:2]
-
-    #print(hcand_lep1.pt, hcand_lep2.pt)
-    #print("aksnjklansldjknalknxlk")
-    dr_hlep1_extraleps = extra_lep.metric_table(hcand_lep1)
-    dr_hlep2_extraleps = extra_lep.metric_table(hcand_lep2)
-
-    dr_mask = (
-        ((dr_hlep2_extraleps > 0.5) 
-         &  (dr_hlep1_extraleps > 0.001)) 
-        | (dr_hlep1_extraleps > 0.5))
-    
-    has_extra_lepton = ak.where(has_single_pair, 
-                                ak.any(dr_mask, axis=-1),
-                                dummy)
-
-    has_no_extra_lepton = ak.sum(has_extra_lepton, axis=1) == 0
-
-    return events, SelectionResult(steps={"extra_lepton_veto": has_no_extra_lepton})
-
+    """
+    Rejects events with additional veto muons or electrons next to the legs of any of the higgs
+    candidates in *hcand* (see :py:mod:`httcp.selection.candidates`). All distances are computed by a
+    compiled kernel on the flat eta and phi values of the legs and the extra leptons.
+    """
+    # legs of all candidates per event, i.e. [event][lep1, lep2, lep1, lep2, ...]
+    legs_offsets = 2 * layout_offsets(hcand.channel)
+    legs_eta = np.stack([gather_flat(events, hcand, "eta", 1), gather_flat(events, hcand, "eta", 2)], axis=1)
+    legs_phi = np.stack([gather_flat(events, hcand, "phi", 1), gather_flat(events, hcand, "phi", 2)], axis=1)
+
+    extra_mu_eta = events.Muon.eta[extra_muon_index]
+    extra_el_eta = events.Electron.eta[extra_electron_index]
+
+    has_extra_lepton = _extra_lepton_veto_kernel(
+        legs_offsets,
+        legs_eta.ravel().astype(np.float64),
+        legs_phi.ravel().astype(np.float64),
+        layout_offsets(extra_mu_eta),
+        np.asarray(flat_column(extra_mu_eta), dtype=np.float64),
+        np.asarray(flat_column(events.Muon.phi[extra_muon_index]), dtype=np.float64),
+        layout_offsets(extra_el_eta),
+        np.asarray(flat_column(extra_el_eta), dtype=np.float64),
+        np.asarray(flat_column(events.Electron.phi[extra_electron_index]), dtype=np.float64),
+    )
+
+    return events, SelectionResult(steps={"extra_lepton_veto": ~has_extra_lepton})
+
+
+
+@njit(cache=True)
+def _os_pair_kernel(offsets, indices, eta, phi, charge, lep_offsets, min_dr):
+    # per event, scan all pairs of the selected leptons and stop at the first opposite-sign pair
+    # that is separated by more than min_dr
+    found = np.zeros(len(offsets) - 1, dtype=np.bool_)
+    min_dr2 = min_dr * min_dr
+
+    for i in range(len(offsets) - 1):
+        base = lep_offsets[i]
+        for a in range(offsets[i], offsets[i + 1]):
+            ia = base + indices[a]
+            for b in range(a + 1, offsets[i + 1]):
+                ib = base + indices[b]
+                if charge[ia] * charge[ib] < 0 and delta_r2_kernel(eta[ia], phi[ia], eta[ib], phi[ib]) > min_dr2:
+                    found[i] = True
+                    break
+            if found[i]:
+                break
+
+    return found
+
+
+def has_os_pair(leptons: ak.Array, indices: ak.Array, min_dr: float = 0.15) -> np.ndarray:
+    """
+    Returns per event whether the *leptons* at the local *indices* contain at least one
+    opposite-sign pair with a delta R above *min_dr*.
+    """
+    return _os_pair_kernel(
+        layout_offsets(indices),
+        np.asarray(flat_column(indices), dtype=np.int64),
+        np.asarray(flat_column(leptons.eta), dtype=np.float64),
+        np.asarray(flat_column(leptons.phi), dtype=np.float64),
+        np.asarray(flat_column(leptons.charge), dtype=np.int64),
+        layout_offsets(leptons.eta),
+        float(min_dr),
+    )
 
 
 @selector(
     uses={
-        "Muon.pt", "Muon.eta", "Muon.phi", "Muon.mass", "Muon.charge",
-        "Electron.pt", "Electron.eta", "Electron.phi", "Electron.mass", "Electron.charge",
+        "Muon.eta", "Muon.phi", "Muon.charge",
+        "Electron.eta", "Electron.phi", "Electron.charge",
     },
     exposed=False,
 )
@@ -81,31 +149,12 @@ def double_lepton_veto(
         double_veto_muon_index: ak.Array,
         **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
-    double_veto_muon     = ak.Array(events.Muon[double_veto_muon_index], 
-                                    behavior=coffea.nanoevents.methods.nanoaod.behavior)
-
-    double_veto_muon     = ak.with_name(double_veto_muon, "PtEtaPhiMLorentzVector")
-
-    double_veto_electron = ak.Array(events.Electron[double_veto_electron_index], 
-                                    behavior=coffea.nanoevents.methods.nanoaod.behavior)
-    double_veto_electron = ak.with_name(double_veto_electron, "PtEtaPhiMLorentzVector")
-
-    mu_pair = ak.combinations(double_veto_muon, 2, axis=1)
-    el_pair = ak.combinations(double_veto_electron, 2, axis=1)
-
-    mu1,mu2 = ak.unzip(mu_pair)
-    el1,el2 = ak.unzip(el_pair)
-
-    presel_mask = lambda leps1, leps2: ((leps1.charge * leps2.charge < 0) & (leps1.delta_r(leps2) > 0.15))
-
-    dlveto_mu_mask = presel_mask(mu1,mu2)
-    dlveto_el_mask = presel_mask(el1,el2)
-
-    dl_mu_veto = ak.sum(dlveto_mu_mask, axis=1) == 0
-    dl_el_veto = ak.sum(dlveto_el_mask, axis=1) == 0
-
-    dl_veto    = dl_mu_veto & dl_el_veto
+    """
+    Rejects events with an opposite-sign pair of double-veto muons or electrons with delta R > 0.15.
+    """
+    dl_veto = ~(
+        has_os_pair(events.Muon, double_veto_muon_index) |
+        has_os_pair(events.Electron, double_veto_electron_index)
+    )
 
     return events, SelectionResult(steps={"dilepton_veto": dl_veto})
-    
-
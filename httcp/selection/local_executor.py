@@ -0,0 +1,346 @@
+# coding: utf-8
+
+"""
+Local execution of the calibration and selection on a process pool, e.g. on a large interactive
+node without submission to a batch system.
+
+Usage:
+
+    python -m httcp.selection.local_executor FILE [FILE ...] --output-dir DIR [--workers 64] ...
+
+Input files are split into chunks of entries which are distributed over the workers. Workers only
+receive the path and entry range of their chunk and read the required branches themselves with
+uproot, so that no event data is pickled between processes. Branches are structured like in the
+NanoAOD reader of columnflow (e.g. ``HLT_IsoMu24`` as ``HLT.IsoMu24``) and missing optional columns
+are skipped. The calibrators and the selector are set up with the outputs of their required tasks,
+such as the external files bundled by ``cf.BundleExternalFiles``, which must exist. For progressive
+selectors, columns only needed by the candidate selection are read for surviving events only, and
+declared columns that were never read are reported per chunk (see
+:py:class:`httcp.selection.lazy_columns.LazyColumns`). Each worker writes the selection results and
+the produced columns of its chunk to parquet files and returns its stats. The parent merges the
+stats and the parquet files in the order of files and chunks, so the outputs do not depend on the
+number of workers or the order in which chunks finish.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import law
+
+from columnflow.calibration import Calibrator
+from columnflow.selection import Selector
+from columnflow.tasks.selection import SelectEvents
+from columnflow.production.util import attach_coffea_behavior
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, set_ak_column
+
+from httcp.util import load_analysis_insts, import_analysis_modules, scatter_to_events
+from httcp.selection.lazy_columns import LazyColumns
+from httcp.selection.mask_cache import calibration_hash, get_mask_cache
+from httcp.selection.stats import merge_stats
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+uproot = maybe_import("uproot")
+
+
+logger = law.logger.get_logger(__name__)
+
+# calibrator and selector instances of the current worker process, set by _init_worker
+_worker_state = {}
+
+
+def split_chunks(paths: list[str], chunk_size: int, treepath: str = "Events") -> list[tuple]:
+    """
+    Returns tuples ``(file_index, chunk_index, path, entry_start, entry_stop)`` that cover all
+    entries of the *treepath* trees in *paths* in chunks of at most *chunk_size* entries.
+    """
+    chunks = []
+    for file_index, path in enumerate(paths):
+        with uproot.open(path) as f:
+            num_entries = f[treepath].num_entries
+        for chunk_index, entry_start in enumerate(range(0, num_entries, chunk_size)):
+            entry_stop = min(entry_start + chunk_size, num_entries)
+            chunks.append((file_index, chunk_index, path, entry_start, entry_stop))
+    return chunks
+
+
+def selection_task(inst_kwargs: dict, calibrators: list[str], selector: str) -> SelectEvents:
+    """
+    Returns a ``cf.SelectEvents`` task for the *calibrators* and the *selector*, which is not run
+    but passed to their requires functions to obtain required tasks, such as
+    ``cf.BundleExternalFiles``.
+    """
+    return SelectEvents(
+        version="local",
+        calibrators=tuple(calibrators),
+        selector=selector,
+        **{key: value for key, value in inst_kwargs.items() if value},
+    )
+
+
+def setup_insts(insts: list, task: SelectEvents) -> None:
+    """
+    Runs the requires and setup functions of all *insts* with the outputs of their required tasks
+    for *task*, e.g. the lumi mask of the json filter or the files of the jet calibration. Raises
+    a *RuntimeError* when a required task is not complete.
+    """
+    for inst in insts:
+        reqs = inst.run_requires(task=task)
+        incomplete = [req for req in law.util.flatten(reqs) if not req.complete()]
+        if incomplete:
+            raise RuntimeError(
+                f"tasks required by {inst.cls_name} are not complete, run them first: "
+                f"{', '.join(req.repr() for req in incomplete)}",
+            )
+        inputs = law.util.map_struct(lambda req: req.output(), reqs)
+        inst.run_setup(reqs, inputs, law.util.InsertableDict())
+
+
+def build_selection(
+    inst_kwargs: dict,
+    calibrators: list[str],
+    selector: str,
+    progressive_reads: bool = True,
+) -> dict:
+    """
+    Creates and sets up the *calibrators* and the *selector* and returns them together with the
+    sorted lists of columns to read from the inputs, of all input columns declared by them and of
+    columns produced by them. When *progressive_reads* is *True* and the selector is progressive,
+    columns of the candidate selection are not part of the columns to read, as they are read later
+    on for surviving events only.
+    """
+    import_analysis_modules("calibration_modules", "selection_modules")
+    analysis_inst, config_inst, dataset_inst = load_analysis_insts(**inst_kwargs)
+    task = selection_task(inst_kwargs, calibrators, selector)
+    inst_dict = {
+        "task": task,
+        "analysis_inst": analysis_inst,
+        "config_inst": config_inst,
+        "dataset_inst": dataset_inst,
+    }
+    calibrator_insts = [Calibrator.get_cls(name)(inst_dict=inst_dict) for name in calibrators]
+    selector_inst = Selector.get_cls(selector)(inst_dict=inst_dict)
+    setup_insts([*calibrator_insts, selector_inst], task)
+
+    # columns to read from the input files, produced columns are set by the calibrators and selector
+    used_columns = set.union(selector_inst.used_columns, *(c.used_columns for c in calibrator_insts))
+    produced_columns = set.union(
+        selector_inst.produced_columns,
+        *(c.produced_columns for c in calibrator_insts),
+    )
+    read_columns = used_columns - produced_columns
+    if progressive_reads and getattr(selector_inst, "progressive", False):
+        from httcp.selection.main import deferred_columns
+        read_columns -= deferred_columns(selector_inst)
+
+    return {
+        "calibrator_insts": calibrator_insts,
+        "selector_inst": selector_inst,
+        "calibration_hash": calibration_hash(calibrator_insts),
+        "read_columns": sorted(read_columns, key=str),
+        "declared_columns": sorted(used_columns - produced_columns, key=str),
+        "produced_columns": sorted(produced_columns, key=str),
+    }
+
+
+def read_chunk(
+    path: str,
+    entry_start: int,
+    entry_stop: int,
+    columns: list,
+) -> tuple[ak.Array, LazyColumns]:
+    """
+    Reads *columns* of the entry range of the file at *path* into events structured like those of
+    the NanoAOD reader of columnflow, skipping missing optional columns, and returns the events and
+    the :py:class:`LazyColumns` reader for further columns.
+    """
+    lazy = LazyColumns.open(path, entry_start=entry_start, entry_stop=entry_stop)
+    events = ak.Array(ak.contents.RecordArray([], [], length=entry_stop - entry_start))
+    return lazy.attach(events, columns), lazy
+
+
+def select(state: dict, events: ak.Array, stats: dict, **kwargs) -> tuple[ak.Array, object]:
+    """
+    Runs the calibrators and the selector of a *state* obtained from :py:func:`build_selection` on
+    *events*, incrementing *stats* in-place.
+    """
+    selector_inst = state["selector_inst"]
+    events = selector_inst[attach_coffea_behavior](events)
+    for calibrator_inst in state["calibrator_insts"]:
+        events = calibrator_inst(events)
+    return selector_inst(events, stats, **kwargs)
+
+
+def write_chunk(
+    state: dict,
+    events: ak.Array,
+    results,
+    basename: str,
+    keep: np.ndarray | None = None,
+) -> tuple[str, str]:
+    """
+    Writes the selection *results* and the produced columns of *events* to parquet files starting
+    with *basename* and returns their paths. When *events* were selected out of a chunk by the
+    boolean *keep* mask, the outputs are written for all events of the chunk, with all other events
+    failing the selection and receiving default values (see :py:func:`httcp.util.scatter_to_events`).
+    """
+    def full(values: ak.Array) -> ak.Array:
+        return values if keep is None else scatter_to_events(values, keep)
+
+    results_path = f"{basename}_results.parquet"
+    columns_path = f"{basename}_columns.parquet"
+    ak.to_parquet(full(results.to_ak()), results_path)
+    columns = ak.Array(ak.contents.RecordArray([], [], length=len(events) if keep is None else len(keep)))
+    for route in state["produced_columns"]:
+        columns = set_ak_column(columns, route, full(Route(route).apply(events)))
+    ak.to_parquet(columns, columns_path)
+    return results_path, columns_path
+
+
+def merge_outputs(outputs: dict, output_dir: str, stats: dict | None = None) -> dict:
+    """
+    Merges the *outputs* per ``(file_index, chunk_index)``, given as tuples of stats, results path
+    and columns path, in the order of files and chunks into ``results.parquet``,
+    ``columns.parquet`` and ``stats.json`` in *output_dir*, and returns the merged stats, optionally
+    starting from *stats*.
+    """
+    law.contrib.load("pyarrow")
+
+    stats = {} if stats is None else stats
+    results_paths, columns_paths = [], []
+    for key in sorted(outputs):
+        chunk_stats, results_path, columns_path = outputs[key]
+        merge_stats(stats, chunk_stats)
+        results_paths.append(results_path)
+        columns_paths.append(columns_path)
+
+    law.pyarrow.merge_parquet_files(results_paths, os.path.join(output_dir, "results.parquet"))
+    law.pyarrow.merge_parquet_files(columns_paths, os.path.join(output_dir, "columns.parquet"))
+    for path in results_paths + columns_paths:
+        os.remove(path)
+
+    with open(os.path.join(output_dir, "stats.json"), "w") as f:
+        json.dump(stats, f, indent=4)
+
+    return stats
+
+
+def _init_worker(inst_kwargs: dict, calibrators: list[str], selector: str) -> None:
+    # set up the calibrators and the selector once per process
+    _worker_state.update(build_selection(inst_kwargs, calibrators, selector))
+
+
+def _run_chunk(chunk: tuple, output_dir: str) -> tuple[int, int, dict, str, str]:
+    file_index, chunk_index, path, entry_start, entry_stop = chunk
+    chunk_kwargs = {
+        "input_file": path,
+        "entry_start": entry_start,
+        "entry_stop": entry_stop,
+        "calibration_hash": _worker_state["calibration_hash"],
+    }
+
+    # load chunks cached by file and entry range without reading any column
+    stats = defaultdict(float)
+    selector_inst = _worker_state["selector_inst"]
+    cached = None
+    if getattr(selector_inst, "cache_masks", False):
+        mask_cache = get_mask_cache(selector_inst)
+        key = mask_cache.file_key(**chunk_kwargs)
+        if key is not None:
+            events = ak.Array(ak.contents.RecordArray([], [], length=entry_stop - entry_start))
+            cached = mask_cache.load(key, events, stats)
+
+    if cached is not None:
+        events, results = cached
+    else:
+        # read the columns needed before the candidate selection, the reader provides the others later
+        events, lazy = read_chunk(path, entry_start, entry_stop, _worker_state["read_columns"])
+        events, results = select(_worker_state, events, stats, lazy_columns=lazy, **chunk_kwargs)
+        lazy.report_untouched(_worker_state["declared_columns"])
+
+    # store the selection results and the produced columns of this chunk
+    basename = os.path.join(output_dir, f"chunk_{file_index}_{chunk_index}")
+    results_path, columns_path = write_chunk(_worker_state, events, results, basename)
+
+    return file_index, chunk_index, merge_stats({}, stats), results_path, columns_path
+
+
+def run_local(
+    paths: list[str],
+    output_dir: str,
+    workers: int | None = None,
+    chunk_size: int | None = None,
+    calibrators: list[str] | None = None,
+    selector: str | None = None,
+    **inst_kwargs,
+) -> dict:
+    """
+    Runs the *calibrators* and the *selector* (defaulting to those of the config) on all *paths* in
+    chunks of *chunk_size* entries (defaulting to ``chunked_io_chunk_size`` of the law.cfg) using
+    *workers* processes, and writes ``results.parquet``, ``columns.parquet`` and ``stats.json`` to
+    *output_dir*. The merged stats are returned.
+    """
+    _, config_inst, _ = load_analysis_insts(**inst_kwargs)
+    if calibrators is None:
+        calibrators = law.util.make_list(config_inst.x.default_calibrator)
+    if selector is None:
+        selector = config_inst.x.default_selector
+    if chunk_size is None:
+        chunk_size = law.config.get_expanded_int("analysis", "chunked_io_chunk_size")
+
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = split_chunks(paths, chunk_size)
+    logger.info(f"processing {len(chunks)} chunks of {len(paths)} files with {workers or os.cpu_count()} workers")
+
+    outputs = {}
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(inst_kwargs, calibrators, selector),
+    ) as pool:
+        futures = [pool.submit(_run_chunk, chunk, output_dir) for chunk in chunks]
+        for i, future in enumerate(as_completed(futures), 1):
+            file_index, chunk_index, *output = future.result()
+            outputs[(file_index, chunk_index)] = output
+            logger.debug(f"finished chunk {chunk_index} of file {file_index} ({i}/{len(chunks)})")
+
+    return merge_outputs(outputs, output_dir)
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("paths", nargs="+", help="input NanoAOD files")
+    parser.add_argument("--output-dir", required=True, help="directory of the merged outputs")
+    parser.add_argument("--workers", type=int, help="number of processes, defaults to the number of cpus")
+    parser.add_argument("--chunk-size", type=int, help="entries per chunk, defaults to the law.cfg")
+    parser.add_argument("--calibrators", help="comma-separated calibrators, defaults to the config")
+    parser.add_argument("--selector", help="selector, defaults to the config")
+    parser.add_argument("--analysis", help="analysis instance, defaults to the law.cfg")
+    parser.add_argument("--config", help="config name, defaults to the law.cfg")
+    parser.add_argument("--dataset", help="dataset name, defaults to the law.cfg")
+    args = parser.parse_args(argv)
+
+    stats = run_local(
+        args.paths,
+        args.output_dir,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        calibrators=args.calibrators.split(",") if args.calibrators else None,
+        selector=args.selector,
+        analysis=args.analysis,
+        config=args.config,
+        dataset=args.dataset,
+    )
+    logger.info(f"selected {stats.get('num_events_selected', 0)} of {stats.get('num_events', 0)} events")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -9,7 +9,6 @@ from functools import reduce
 from collections import defaultdict, OrderedDict
 
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.selection.stats import increment_stats
 from columnflow.selection.cms.json_filter import json_filter
 from columnflow.selection.cms.met_filters import met_filters
 
@@ -19,76 +18,507 @@ from columnflow.production.util import attach_coffea_behavior
 
 from columnflow.util import maybe_import
 from columnflow.columnar_util import optional_column as optional
-from columnflow.columnar_util import EMPTY_FLOAT, Route
+from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 
+from httcp.util import scatter_to_events
+from httcp.fourvector import transverse_mass
 from httcp.production.main import hcand_features
 #from httcp.production.main import cutflow_features
 
 from httcp.selection.physics_objects import *
-from httcp.selection.trigger import trigger_selection
+from httcp.selection.trigger import trigger_selection, subset_trigger_results
 from httcp.selection.lepton_pair_etau import etau_selection
 from httcp.selection.lepton_pair_mutau import mutau_selection
 from httcp.selection.lepton_pair_tautau import tautau_selection
 from httcp.selection.event_category import get_categories
-from httcp.selection.match_trigobj import match_trigobj
+from httcp.selection.match_trigobj import match_trigobj, trigger_flags
 from httcp.selection.lepton_veto import *
 from httcp.selection.higgscand import higgscand
+from httcp.selection.candidates import build_candidates, hcand_columns
+from httcp.selection.pair_ranking import get_best_pair
+from httcp.selection.stats import grouped_sums, merge_grouped_sums, merge_stats
+from httcp.selection.event_counts import get_file_counts
+from httcp.selection.step_bits import StepBitRegistry
+from httcp.selection.index_cache import IndexCache
+from httcp.selection.profiling import SelectorProfile, profiled, profiling_enabled
+from httcp.selection.mask_cache import get_mask_cache
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+# columns whose shifts, e.g. for jec, only affect the jet selection and the candidate selection, so
+# that the multi-shift mode can share all other steps with the nominal selection
+SHIFT_DEPENDENT_COLUMNS = ("Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "MET.pt", "MET.phi")
+
+# event-level steps before the candidate selection that depend on SHIFT_DEPENDENT_COLUMNS
+SHIFT_DEPENDENT_STEPS = ("b_veto",)
+
+# bit positions of the event and object selection steps in the packed step columns
+step_bit_registry = StepBitRegistry({
+    "event": (
+        "json", "trigger", "met_filter", "b_veto", "multiple_leptons", "dilepton_veto",
+        "has_higgs_cand", "extra_lepton_veto",
+    ),
+    "Muon": MUON_STEPS,
+    "Electron": ELECTRON_STEPS,
+    "Tau": TAU_STEPS,
+    "Jet": JET_STEPS,
+})
+
+
 @selector(uses={"process_id", optional("mc_weight")})
 def custom_increment_stats(
     self: Selector,
     events: ak.Array,
     results: SelectionResult,
     stats: dict,
+    weight_map: dict | None = None,
+    group_map: dict | None = None,
     **kwargs,
-) -> ak.Array:
+) -> tuple[ak.Array, SelectionResult]:
     """
     Unexposed selector that does not actually select objects but instead increments selection
-    *stats* in-place based on all input *events* and the final selection *mask*.
+    *stats* in-place based on all input *events* and the final event mask in *results*. The
+    *weight_map* and *group_map* default to those returned by :py:func:`stats_maps`. Sums per
+    group, e.g. per process or channel id, are computed with one ``np.bincount`` per entry (see
+    :py:func:`httcp.selection.stats.grouped_sums`) instead of one mask per group value.
+
+    All entries are summed over the events of the chunk. When the path of the NanoAOD file is passed
+    as *input_file* and the chunk starts at its first entry (*entry_start*), the numbers of
+    generated events and weights in the file metadata (see
+    :py:func:`httcp.selection.event_counts.get_file_counts`), which also cover events removed by a
+    NanoAOD-level skim, are added to ``num_events_generated`` and ``sum_mc_weight_generated``, so
+    that they are counted once per file. Both are passed by the local executor and, via the chunk
+    info set in ``httcp/columnflow_patches.py``, by ``cf.SelectEvents``. The normalization weights
+    use them through :py:func:`httcp.production.normalization.normalization_weights_generated`.
     """
-    # get event masks
-    event_mask = results.event
-
-    # get a list of unique process ids present in the chunk
-    unique_process_ids = np.unique(events.process_id)
-    # increment plain counts
-    n_evt_per_file = self.dataset_inst.n_events/self.dataset_inst.n_files
-    #from IPython import embed
-    #embed()
-    stats["num_events"] = n_evt_per_file
-    stats["num_events_selected"] += ak.sum(event_mask, axis=0)
-    if self.dataset_inst.is_mc:
-        stats[f"sum_mc_weight"] = n_evt_per_file
-        stats.setdefault(f"sum_mc_weight_per_process", defaultdict(float))
-        for p in unique_process_ids:
-            stats[f"sum_mc_weight_per_process"][int(p)] = n_evt_per_file
-        
-    # create a map of entry names to (weight, mask) pairs that will be written to stats
-    weight_map = OrderedDict()
-    if self.dataset_inst.is_mc:
-        # mc weight for selected events
-        weight_map["mc_weight_selected"] = (events.mc_weight, event_mask)
-
-    # get and store the sum of weights in the stats dictionary
-    for name, (weights, mask) in weight_map.items():
-        joinable_mask = True if mask is Ellipsis else mask
-
-        # sum of different weights in weight_map for all processes
-        stats[f"sum_{name}"] += ak.sum(weights[mask])
-        # sums per process id
-        stats.setdefault(f"sum_{name}_per_process", defaultdict(float))
-        for p in unique_process_ids:
-            stats[f"sum_{name}_per_process"][int(p)] += ak.sum(
-                weights[(events.process_id == p) & joinable_mask],
-            )
+    if weight_map is None:
+        weight_map, group_map = stats_maps(self.dataset_inst, events, results.event)
+
+    # weights per entry, with counts being sums of unit weights, and the event masks
+    weights, masks = {}, {}
+    for name, (values, mask) in weight_map.items():
+        weights[name] = np.ones(len(events)) if values is None else np.asarray(values, dtype=np.float64)
+        masks[name] = None if mask is Ellipsis else np.asarray(mask)
+
+    for name, values in weights.items():
+        total = np.sum(values if masks[name] is None else values[masks[name]])
+        stats[name] += int(total) if weight_map[name][0] is None else float(total)
+
+    for group_name, group_ids in (group_map or {}).items():
+        merge_grouped_sums(stats, grouped_sums(group_ids, weights, masks), group_name)
+
+    input_file = kwargs.get("input_file")
+    if input_file and kwargs.get("entry_start") == 0:
+        file_counts = get_file_counts(input_file)
+        stats["num_events_generated"] += file_counts["num_events"]
+        if self.dataset_inst.is_mc:
+            stats["sum_mc_weight_generated"] += file_counts["sum_mc_weight"]
+
+    return events, results
+
+
+def higgs_candidate_selection(
+    self: Selector,
+    events: ak.Array,
+    trigger_results: SelectionResult,
+    good_ele_indices: ak.Array,
+    good_muon_indices: ak.Array,
+    good_tau_indices: ak.Array,
+    veto_ele_indices: ak.Array,
+    veto_muon_indices: ak.Array,
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Expensive part of the :py:func:`main` selector, i.e., trigger object matching, pair building,
+    channel assignment and the extra lepton veto, evaluated on the given *events* which may be a
+    subset of the chunk in the progressive mode. *self* is the calling main selector.
+    """
+    results = SelectionResult()
+    profile = kwargs.get("selector_profile")
+
+    # trigger obj matching
+    # INFO: switched off by default, see the match_trigger_objects attribute of the main selector
+    events, good_ele_indices, good_muon_indices, good_tau_indices = profiled(self, match_trigobj, profile)(events,
+                                                                                                           trigger_results,
+                                                                                                           good_ele_indices,
+                                                                                                           good_muon_indices,
+                                                                                                           good_tau_indices,
+                                                                                                           domatch=self.match_trigger_objects,
+                                                                                                           batched=self.batched_matching)
+
+    # e-tau pair i.e. hcand selection
+    # e.g. [ [], [e1, tau1], [], [], [e1, tau2] ]
+    etau_results, etau_indices_pair = profiled(self, etau_selection, profile)(events,
+                                                                              good_ele_indices,
+                                                                              good_tau_indices,
+                                                                              call_force=True,
+                                                                              **kwargs)
+    results += etau_results
+
+    # mu-tau pair i.e. hcand selection
+    # e.g. [ [mu1, tau1], [], [mu1, tau2], [], [] ]
+    mutau_results, mutau_indices_pair = profiled(self, mutau_selection, profile)(events,
+                                                                                 good_muon_indices,
+                                                                                 good_tau_indices,
+                                                                                 call_force=True,
+                                                                                 **kwargs)
+    results += mutau_results
+
+    # tau-tau pair i.e. hcand selection
+    # e.g. [ [], [tau1, tau2], [], [], [] ]
+    tautau_results, tautau_indices_pair = profiled(self, tautau_selection, profile)(events,
+                                                                                    good_tau_indices,
+                                                                                    call_force=True,
+                                                                                    **kwargs)
+    results += tautau_results
+
+    # channel selection
+    # channel_id is now in columns
+    events, channel_results = profiled(self, get_categories, profile)(events,
+                                                                      trigger_results,
+                                                                      etau_indices_pair,
+                                                                      mutau_indices_pair,
+                                                                      tautau_indices_pair)
+    results += channel_results
+
+    # higgs candidates as channel and leg indices, one per channel with a selected pair
+    # e.g. [ [(mutau,mu1,tau1)], [(etau,e1,tau1),(tautau,tau1,tau2)], [(mutau,mu1,tau2)], [], [(etau,e1,tau2)] ]
+    hcand = build_candidates(self.config_inst, {
+        "etau": etau_indices_pair,
+        "mutau": mutau_indices_pair,
+        "tautau": tautau_indices_pair,
+    })
+    events = profiled(self, hcand_columns, profile)(events, hcand)
+
+    # inputs for the re-evaluation of the candidate selection in shifts, see evaluate_shifts
+    if kwargs.get("pair_cache") is not None:
+        kwargs["pair_cache"].update({
+            "events": events,
+            "pair_indices": {
+                "etau": etau_indices_pair,
+                "mutau": mutau_indices_pair,
+                "tautau": tautau_indices_pair,
+            },
+            "veto_indices": (veto_ele_indices, veto_muon_indices),
+        })
+
+    # make sure events have at least one lepton pair
+    hcand_results = SelectionResult(
+        steps={
+            "has_higgs_cand": ak.num(hcand.channel, axis=1) > 0,
+        },
+    )
+
+    events = profiled(self, hcand_features, profile)(events, hcand)
+    results += hcand_results
+    
+    # extra lepton veto, applied to the legs of all higgs candidates
+    events, extra_lepton_veto_results = profiled(self, extra_lepton_veto, profile)(events, 
+                                                                                   veto_ele_indices,
+                                                                                   veto_muon_indices,
+                                                                                   hcand)
+    results += extra_lepton_veto_results
+
 
     return events, results
 
 
+def deferred_columns(self: Selector) -> set[Route]:
+    """
+    Returns the columns that are only used by the selectors and producers called in
+    :py:func:`higgs_candidate_selection` and that therefore do not need to be read before the
+    progressive mode of the main selector *self* reduced the chunk to events with possible pairs.
+    """
+    if getattr(self, "_deferred_columns", None) is None:
+        stage = (
+            match_trigobj, etau_selection, mutau_selection, tautau_selection, get_categories, hcand_columns, hcand_features, extra_lepton_veto,
+        )
+        stage_columns = set.union(set(), *(self[func].used_columns for func in stage))
+        other_columns = set.union(set(), *(
+            dep.used_columns
+            for func, dep in self.deps.items()
+            if func not in stage
+        ))
+        self._deferred_columns = stage_columns - other_columns
+    return self._deferred_columns
+
+
+def skipped_candidate_results(self: Selector, lepton_indices: tuple[ak.Array]) -> dict:
+    """
+    Returns the outputs of the candidate selection assumed for events that the progressive mode of
+    the main selector *self* does not process, derived from the channels in which a pair can be
+    formed with the good electrons, muons and taus in *lepton_indices*, without building pairs. The
+    result contains the bitmask of these channels (``"pair_mask"``, in the order of
+    :py:attr:`httcp.selection.event_category.PAIR_CHANNELS`), the ``"channel_id"`` and the
+    ``"steps"`` and ``"aux"`` masks of the candidate selection. For events without any possible
+    pair, these are identical to the outputs of the full selection.
+    """
+    n_ele, n_muon, n_tau = (np.asarray(ak.num(indices, axis=1)) for indices in lepton_indices[:3])
+    pair_mask = (
+        ((n_ele >= 1) & (n_tau >= 1)).astype(np.uint8) |
+        ((n_muon >= 1) & (n_tau >= 1)).astype(np.uint8) << np.uint8(1) |
+        (n_tau >= 2).astype(np.uint8) << np.uint8(2)
+    )
+    categorizer = self[get_categories]
+    return {
+        "pair_mask": pair_mask,
+        "channel_id": categorizer.channel_table[pair_mask],
+        "steps": {
+            "has_higgs_cand": pair_mask > 0,
+            "extra_lepton_veto": np.ones(len(pair_mask), dtype=bool),
+        },
+        "aux": {name: pair_mask == mask for name, mask in categorizer.channel_step_masks.items()},
+    }
+
+
+def fill_skipped(values: dict[str, ak.Array], keep: np.ndarray, skipped: dict[str, np.ndarray]) -> dict:
+    """
+    Places the *values* of the candidate selection obtained on the events selected by *keep* back at
+    their original positions, using the *skipped* values, if any, for all other events (see
+    :py:func:`skipped_candidate_results`).
+    """
+    return {
+        name: (
+            np.where(keep, np.asarray(scatter_to_events(value, keep)), skipped[name])
+            if name in skipped else
+            scatter_to_events(value, keep)
+        )
+        for name, value in values.items()
+    }
+
+
+def candidate_stage(
+    self: Selector,
+    events: ak.Array,
+    trigger_results: SelectionResult,
+    lepton_indices: tuple[ak.Array],
+    base_steps: dict[str, ak.Array],
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Runs :py:func:`higgs_candidate_selection` with the *trigger_results* and the *lepton_indices*
+    in the order of its arguments. In the progressive mode of the main selector *self*, only events
+    passing all event-level *base_steps* and in which at least one lepton pair can be formed are
+    processed. Steps that differ between the ``selection_shifts``, i.e., the b-jet veto, are not
+    used to skip events when shifts are evaluated.
+
+    The event selection, all stats of selected events and all outputs of processed events are
+    identical to those of the default mode. Skipped events that fail a base step but could form a
+    pair receive the channel id and candidate steps of the channels in which a pair can be formed
+    (see :py:func:`skipped_candidate_results`), which are upper bounds of the selected pairs. Hence,
+    their channel ids, and therefore the per-channel sums over all events, as well as the N-1 masks
+    of the candidate steps can differ, and the higgs candidate columns of these events are empty.
+    """
+    if not self.progressive:
+        return higgs_candidate_selection(self, events, trigger_results, *lepton_indices, **kwargs)
+
+    # only process events passing the base steps and with enough good leptons for a pair
+    skipped = skipped_candidate_results(self, lepton_indices)
+    keep = reduce(
+        and_,
+        (
+            np.asarray(step)
+            for name, step in base_steps.items()
+            if not (self.selection_shifts and name in SHIFT_DEPENDENT_STEPS)
+        ),
+        skipped["pair_mask"] > 0,
+    )
+    if kwargs.get("pair_cache") is not None:
+        kwargs["pair_cache"].update({"keep": keep, "skipped": skipped})
+    sub_events = events[keep]
+    # when a column reader is given, which only the local executor does, columns only needed for the
+    # candidate selection are read now, and only from the baskets containing processed events
+    if kwargs.get("lazy_columns") is not None:
+        sub_events = kwargs["lazy_columns"].attach(sub_events, deferred_columns(self), keep=keep)
+    sub_events, cand_results = higgs_candidate_selection(
+        self,
+        sub_events,
+        subset_trigger_results(trigger_results, events, keep),
+        *(indices[keep] for indices in lepton_indices),
+        **kwargs,
+    )
+    for producer in (match_trigobj, get_categories, hcand_columns, hcand_features):
+        for route in self[producer].produced_columns:
+            events = set_ak_column(events, route, scatter_to_events(route.apply(sub_events), keep))
+    events = set_ak_column(events, "channel_id", fill_skipped(
+        {"channel_id": sub_events.channel_id},
+        keep,
+        skipped,
+    )["channel_id"])
+    # trigger flags depend on the trigger decisions only and are also set for skipped events
+    if self.match_trigger_objects:
+        for name, flag in trigger_flags(trigger_results, len(events)).items():
+            events = set_ak_column(events, name, flag)
+
+    return events, SelectionResult(
+        steps=fill_skipped(cand_results.steps, keep, skipped["steps"]),
+        aux=fill_skipped(cand_results.aux, keep, skipped["aux"]),
+    )
+
+
+def pack_object_steps(
+    self: Selector,
+    events: ak.Array,
+    collection: str,
+    object_results: SelectionResult,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Stores the per-object step masks in the aux data of *object_results* as packed column
+    ``<collection>.step_bits`` when the main selector *self* packs steps, and removes them from the
+    results so that they are not held until the end of the chunk.
+    """
+    if not self.pack_steps:
+        return events, object_results
+    events = set_ak_column(events, f"{collection}.step_bits", step_bit_registry.pack(
+        collection,
+        object_results.aux,
+        events[collection],
+    ))
+    object_results.aux.clear()
+    return events, object_results
+
+
+def get_selection_shifts(config_inst) -> dict[str, dict[str, str]]:
+    """
+    Returns the column aliases of all shifts of *config_inst* that affect
+    :py:attr:`SHIFT_DEPENDENT_COLUMNS`, restricted to these columns, per shift name.
+    """
+    shifts = {}
+    for shift_inst in config_inst.shifts:
+        aliases = {
+            src: dst
+            for src, dst in shift_inst.x("column_aliases", {}).items()
+            if src in SHIFT_DEPENDENT_COLUMNS
+        }
+        if aliases:
+            shifts[shift_inst.name] = aliases
+    return shifts
+
+
+def shifted_met_candidates(
+    self: Selector,
+    pair_cache: dict,
+    aliases: dict[str, str],
+) -> tuple[dict[str, ak.Array], ak.Array]:
+    """
+    Re-evaluates the MET dependent cuts of the nominal etau and mutau pairs in *pair_cache* with the
+    MET columns given by the shift *aliases* and returns the steps of the candidate selection and the
+    channel ids for the processed events. The tautau pairs do not depend on MET and are reused.
+    """
+    events = pair_cache["events"]
+    met = ak.zip({
+        field: Route(aliases.get(f"MET.{field}", f"MET.{field}")).apply(events)
+        for field in ("pt", "phi")
+    })
+
+    pair_indices = dict(pair_cache["pair_indices"])
+    for channel, pair_selection in (("etau", etau_selection), ("mutau", mutau_selection)):
+        pairs, indices, columns = pair_cache[channel]
+        cut_table = self[pair_selection].cut_table
+        steps = cut_table.jagged_steps({**columns, "mt": transverse_mass(pairs["0"], met)})
+        good_pair_mask = steps[cut_table.step_names[-1]]
+        pair_indices[channel] = get_best_pair(
+            pairs[good_pair_mask],
+            indices[good_pair_mask],
+            self[pair_selection].pair_ranking,
+        )
+
+    events, _ = self[get_categories](events, None, *(pair_indices[ch] for ch in ("etau", "mutau", "tautau")))
+    hcand = build_candidates(self.config_inst, pair_indices)
+    _, extra_lepton_veto_results = self[extra_lepton_veto](events, *pair_cache["veto_indices"], hcand)
+
+    steps = {
+        "has_higgs_cand": ak.num(hcand.channel, axis=1) > 0,
+        **extra_lepton_veto_results.steps,
+    }
+    return steps, events.channel_id
+
+
+def evaluate_shifts(
+    self: Selector,
+    events: ak.Array,
+    base_steps: dict[str, ak.Array],
+    cand_steps: dict[str, ak.Array],
+    pair_cache: dict,
+    **kwargs,
+) -> ak.Array:
+    """
+    Evaluates the event selection for all ``selection_shifts`` of the main selector *self*. Per
+    shift, only the jet selection is repeated with shifted jets, and for shifted MET, the MET
+    dependent pair cuts are re-evaluated on the nominal pairs in *pair_cache* (see
+    :py:func:`shifted_met_candidates`). All other steps in *base_steps* and, for shifts not affecting
+    MET, the nominal *cand_steps* and channel ids are shared with the nominal selection. The event
+    selection mask and the channel id per shift are added to *events* as
+    ``shift_event_sel.<shift>`` and ``shift_channel_id.<shift>``.
+    """
+    profile = kwargs.get("selector_profile")
+    keep, skipped = pair_cache.get("keep"), pair_cache.get("skipped")
+    for shift_name, aliases in self.selection_shifts.items():
+        steps = dict(base_steps)
+        jet_aliases = {src: dst for src, dst in aliases.items() if src.startswith("Jet.")}
+        if jet_aliases:
+            shifted = events
+            for src, dst in jet_aliases.items():
+                shifted = set_ak_column(shifted, src, Route(dst).apply(shifted))
+            _, jet_results = profiled(self, jet_selection, profile)(shifted, call_force=True, **kwargs)
+            steps.update(jet_results.steps)
+
+        shift_cand_steps, channel_id = cand_steps, events.channel_id
+        if any(src.startswith("MET.") for src in aliases):
+            shift_cand_steps, channel_id = shifted_met_candidates(self, pair_cache, aliases)
+            if keep is not None:
+                shift_cand_steps = fill_skipped(shift_cand_steps, keep, skipped["steps"])
+                channel_id = fill_skipped({"channel_id": channel_id}, keep, skipped)["channel_id"]
+
+        shift_sel = reduce(and_, {**steps, **shift_cand_steps}.values())
+        events = set_ak_column(events, f"shift_event_sel.{shift_name}", shift_sel)
+        events = set_ak_column(events, f"shift_channel_id.{shift_name}", channel_id)
+
+    return events
+
+
+def increment_shift_stats(self: Selector, events: ak.Array, stats: dict) -> None:
+    """
+    Adds the number of selected events and, for mc, the sum of their mc weights per shift in
+    ``selection_shifts`` of the main selector *self* to *stats* in-place.
+    """
+    for shift_name in self.selection_shifts:
+        shift_sel = np.asarray(events.shift_event_sel[shift_name])
+        stats[f"num_events_selected_{shift_name}"] += int(shift_sel.sum())
+        if self.dataset_inst.is_mc:
+            stats[f"sum_mc_weight_selected_{shift_name}"] += float(np.sum(events.mc_weight[shift_sel]))
+
+
+def stats_maps(dataset_inst, events: ak.Array, event_sel: ak.Array) -> tuple[dict, dict]:
+    """
+    Returns the weight and group maps passed to :py:func:`custom_increment_stats` for *events* and
+    the final event selection mask *event_sel*. The weight map contains per stats entry the weights
+    to sum, or *None* to count events, and the event mask, or *Ellipsis* for all events. The group
+    map contains per group name the ids for which all entries are also summed separately.
+    """
+    weight_map = {
+        "num_events": (None, Ellipsis),
+        "num_events_selected": (None, event_sel),
+    }
+    group_map = {}
+    if dataset_inst.is_mc:
+        weight_map = {
+            **weight_map,
+            # mc weight for all events
+            "sum_mc_weight": (events.mc_weight, Ellipsis),
+            "sum_mc_weight_selected": (events.mc_weight, event_sel),
+        }
+        group_map = {
+            # per process
+            "process": events.process_id,
+            # per channel
+            "channel": events.channel_id,
+        }
+    return weight_map, group_map
+
+
 # exposed selectors
 # (those that can be invoked from the command line)
 @selector(
@@ -99,17 +529,30 @@ def custom_increment_stats(
         trigger_selection, muon_selection, electron_selection, tau_selection, jet_selection,
         etau_selection, mutau_selection, tautau_selection, get_categories,
         extra_lepton_veto, double_lepton_veto, match_trigobj,
-        increment_stats, custom_increment_stats,
-        hcand_features, attach_coffea_behavior,
+        custom_increment_stats,
+        hcand_columns, hcand_features, attach_coffea_behavior,
         #higgscand, 
     },
     produces={
         # selectors / producers whose newly created columns should be kept
         mc_weight, trigger_selection, get_categories, process_ids,
-        match_trigobj, hcand_features, 
+        match_trigobj, hcand_columns, hcand_features, 
         #higgscand, 
     },
     exposed=True,
+    # when True, selected leptons are matched to the trigger objects of the fired triggers
+    match_trigger_objects=False,
+    # when True, trigger object matching uses a single pass over all trigger legs
+    batched_matching=True,
+    # when True, pair building and the extra lepton veto only run on events passing the event-level
+    # steps and with enough good leptons, see candidate_stage
+    progressive=False,
+    # when True, event and object selection steps are stored as packed bit columns "step_bits"
+    pack_steps=False,
+    # when True, selection outputs are cached per chunk, see httcp/selection/mask_cache.py
+    cache_masks=False,
+    # when True, the jet and candidate selection are evaluated for all shifts in selection_shifts
+    multi_shift=False,
 )
 def main(
     self: Selector,
@@ -118,49 +561,73 @@ def main(
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
 
+    # input file and entry range of the chunk in cf.SelectEvents, see httcp/columnflow_patches.py
+    for key, value in getattr(self, "chunk_info", {}).items():
+        kwargs.setdefault(key, value)
+
+    # reuse the outputs of a previous run on the same chunk with identical code, config and inputs
+    mask_cache = chunk_key = None
+    if self.cache_masks:
+        mask_cache = get_mask_cache(self)
+        chunk_key = mask_cache.chunk_key(events, self.used_columns - self.produced_columns, **kwargs)
+        cached = mask_cache.load(chunk_key, events, stats)
+        if cached is not None:
+            return cached
+
     # prepare the selection results that are updated at every step
     results = SelectionResult()
 
+    # sorted and local indices of collections, shared by all selectors within this chunk
+    kwargs["index_cache"] = IndexCache()
+
+    # optional timing and memory measurements of all calls, see httcp/selection/profiling.py
+    profile = SelectorProfile() if profiling_enabled() else None
+    kwargs["selector_profile"] = profile
+
     # filter bad data events according to golden lumi mask
     if self.dataset_inst.is_data:
-        events, json_filter_results = self[json_filter](events, **kwargs)
+        events, json_filter_results = profiled(self, json_filter, profile)(events, **kwargs)
         results += json_filter_results
 
     # trigger selection
-    events, trigger_results = self[trigger_selection](events, **kwargs)
+    events, trigger_results = profiled(self, trigger_selection, profile)(events, **kwargs)
     results += trigger_results
 
     # met filter selection
-    events, met_filter_results = self[met_filters](events, **kwargs)
+    events, met_filter_results = profiled(self, met_filters, profile)(events, **kwargs)
     results += met_filter_results
     
     # jet selection
-    events, bjet_veto_result = self[jet_selection](events, 
-                                                   call_force=True, 
-                                                   **kwargs)
+    events, bjet_veto_result = profiled(self, jet_selection, profile)(events, 
+                                                                      call_force=True, 
+                                                                      **kwargs)
+    events, bjet_veto_result = pack_object_steps(self, events, "Jet", bjet_veto_result)
     results += bjet_veto_result
 
     # muon selection
     # e.g. mu_idx: [ [0,1], [], [1], [0], [] ] 
-    events, muon_results, good_muon_indices, veto_muon_indices, dlveto_muon_indices = self[muon_selection](events,
-                                                                                                           call_force=True, 
-                                                                                                           **kwargs)
+    events, muon_results, good_muon_indices, veto_muon_indices, dlveto_muon_indices = profiled(self, muon_selection, profile)(events,
+                                                                                                                              call_force=True, 
+                                                                                                                              **kwargs)
+    events, muon_results = pack_object_steps(self, events, "Muon", muon_results)
     results += muon_results
 
     # electron selection
     # e.g. ele_idx: [ [], [0,1], [], [], [1,2] ] 
-    events, ele_results, good_ele_indices, veto_ele_indices, dlveto_ele_indices = self[electron_selection](events,
-                                                                                                           call_force=True, 
-                                                                                                           **kwargs)
+    events, ele_results, good_ele_indices, veto_ele_indices, dlveto_ele_indices = profiled(self, electron_selection, profile)(events,
+                                                                                                                              call_force=True, 
+                                                                                                                              **kwargs)
+    events, ele_results = pack_object_steps(self, events, "Electron", ele_results)
     results += ele_results
 
     # tau selection
     # e.g. tau_idx: [ [1], [0,1], [1,2], [], [0,1] ] 
-    events, tau_results, good_tau_indices = self[tau_selection](events,
-                                                                good_ele_indices,
-                                                                good_muon_indices,
-                                                                call_force=True, 
-                                                                **kwargs)
+    events, tau_results, good_tau_indices = profiled(self, tau_selection, profile)(events,
+                                                                                   good_ele_indices,
+                                                                                   good_muon_indices,
+                                                                                   call_force=True, 
+                                                                                   **kwargs)
+    events, tau_results = pack_object_steps(self, events, "Tau", tau_results)
     results += tau_results
 
     _lepton_indices = ak.concatenate([good_muon_indices, good_ele_indices, good_tau_indices], axis=1)
@@ -172,91 +639,25 @@ def main(
     )
     results += lepton_results
 
-    # trigger obj matching
-    # INFO: for now, it is switched off
-    events, good_ele_indices, good_muon_indices, good_tau_indices = self[match_trigobj](events,
-                                                                                        trigger_results,
-                                                                                        good_ele_indices,
-                                                                                        good_muon_indices,
-                                                                                        good_tau_indices,
-                                                                                        False)
-
     # double lepton veto
-    events, extra_double_lepton_veto_results = self[double_lepton_veto](events,
-                                                                        dlveto_ele_indices,
-                                                                        dlveto_muon_indices)
+    events, extra_double_lepton_veto_results = profiled(self, double_lepton_veto, profile)(events,
+                                                                                           dlveto_ele_indices,
+                                                                                           dlveto_muon_indices)
     results += extra_double_lepton_veto_results
-    
-    # e-tau pair i.e. hcand selection
-    # e.g. [ [], [e1, tau1], [], [], [e1, tau2] ]
-    etau_results, etau_indices_pair = self[etau_selection](events,
-                                                           good_ele_indices,
-                                                           good_tau_indices,
-                                                           call_force=True,
-                                                           **kwargs)
-    results += etau_results
-
-    etau_pair         = ak.concatenate([events.Electron[etau_indices_pair[:,0:1]], 
-                                        events.Tau[     etau_indices_pair[:,1:2]]], 
-                                       axis=1)
-
-    # mu-tau pair i.e. hcand selection
-    # e.g. [ [mu1, tau1], [], [mu1, tau2], [], [] ]
-    mutau_results, mutau_indices_pair = self[mutau_selection](events,
-                                                              good_muon_indices,
-                                                              good_tau_indices,
-                                                              call_force=True,
-                                                              **kwargs)
-    results += mutau_results
-
-    mutau_pair = ak.concatenate([events.Muon[mutau_indices_pair[:,0:1]], 
-                                 events.Tau[ mutau_indices_pair[:,1:2]]],
-                                axis=1)
-
-    # tau-tau pair i.e. hcand selection
-    # e.g. [ [], [tau1, tau2], [], [], [] ]
-    tautau_results, tautau_indices_pair = self[tautau_selection](events,
-                                                                 good_tau_indices,
-                                                                 call_force=True,
-                                                                 **kwargs)
-    results += tautau_results
-
-    tautau_pair = ak.concatenate([events.Tau[tautau_indices_pair[:,0:1]], 
-                                  events.Tau[tautau_indices_pair[:,1:2]]], 
-                                 axis=1)
-
-    # channel selection
-    # channel_id is now in columns
-    events, channel_results = self[get_categories](events,
-                                                   trigger_results,
-                                                   etau_indices_pair,
-                                                   mutau_indices_pair,
-                                                   tautau_indices_pair)
-    results += channel_results
 
-    # make sure events have at least one lepton pair
-    # hcand pair: [ [[mu1,tau1]], [[e1,tau1],[tau1,tau2]], [[mu1,tau2]], [], [[e1,tau2]] ]
-    hcand_pairs = ak.concatenate([etau_pair[:,None], mutau_pair[:,None], tautau_pair[:,None]], axis=1)
-    
-    hcand_results = SelectionResult(
-        steps={
-            "has_higgs_cand": ak.sum(ak.num(hcand_pairs.pt, axis=-1), axis=-1) > 0,
-        },
+    # pair building, extra lepton veto and channel assignment
+    lepton_indices = (
+        good_ele_indices, good_muon_indices, good_tau_indices,
+        veto_ele_indices, veto_muon_indices,
     )
-
-    events = self[hcand_features](events, hcand_pairs)
-    results += hcand_results
-    
-    # extra lepton veto
-    # it is only applied on the events with one higgs candidate only
-    events, extra_lepton_veto_results = self[extra_lepton_veto](events, 
-                                                                veto_ele_indices,
-                                                                veto_muon_indices,
-                                                                hcand_pairs)
-    results += extra_lepton_veto_results
+    # state before the candidate selection and the nominal pairs, reused for the evaluation of shifts
+    base_steps = dict(results.steps)
+    kwargs["pair_cache"] = {} if self.multi_shift else None
+    events, cand_results = candidate_stage(self, events, trigger_results, lepton_indices, base_steps, **kwargs)
+    results += cand_results
 
     # create process ids
-    events = self[process_ids](events, **kwargs)
+    events = profiled(self, process_ids, profile)(events, **kwargs)
 
     # combined event selection after all steps
     event_sel = reduce(and_, results.steps.values())
@@ -264,52 +665,67 @@ def main(
     
     # add the mc weight
     if self.dataset_inst.is_mc:
-        events = self[mc_weight](events, **kwargs)
+        events = profiled(self, mc_weight, profile)(events, **kwargs)
+
+    # selection masks and channels for shifts of jet and MET columns
+    if self.multi_shift:
+        events = evaluate_shifts(self, events, base_steps, cand_results.steps, **kwargs)
+
+    # store packed event selection steps, object steps were packed after each object selection
+    if self.pack_steps:
+        events = set_ak_column(events, "step_bits", step_bit_registry.pack("event", results.steps, events))
 
     # add cutflow features, passing per-object masks
     #events = self[cutflow_features](events, results.objects, **kwargs)
 
 
     # increment stats
-    weight_map = {
-        "num_events": Ellipsis,
-        "num_events_selected": event_sel,
-    }
-    group_map = {}
-    if self.dataset_inst.is_mc:
-        weight_map = {
-            **weight_map,
-            # mc weight for all events
-            "sum_mc_weight": (events.mc_weight, Ellipsis),
-            "sum_mc_weight_selected": (events.mc_weight, results.event),
-        }
-        group_map = {
-            # per process
-            "process": {
-                "values": events.process_id,
-                "mask_fn": (lambda v: events.process_id == v),
-            },
-            # per channel
-            "channel": {
-                "values": events.channel_id,
-                "mask_fn": (lambda v: events.channel_id == v),
-            },
-        }
-    events, results = self[increment_stats](
+    # stats of this chunk are kept separately when they are cached
+    chunk_stats = stats if mask_cache is None else defaultdict(float)
+    events, results = profiled(self, custom_increment_stats, profile)(
         events,
         results,
-        stats,
-        weight_map=weight_map,
-        group_map=group_map,
+        chunk_stats,
         **kwargs,
     )
-    """
-    events, results = self[custom_increment_stats]( 
-        events,
-        results,
-        stats,
-    )
-    """
+    if self.multi_shift:
+        increment_shift_stats(self, events, chunk_stats)
+    if mask_cache is not None:
+        mask_cache.save(chunk_key, events, results, chunk_stats)
+        merge_stats(stats, chunk_stats)
+    if profile is not None:
+        profile.merge_into(stats)
     #from IPython import embed; embed()
     #1/0
     return events, results
+
+
+@main.init
+def main_init(self: Selector) -> None:
+    self.selection_shifts = get_selection_shifts(self.config_inst) if self.multi_shift else {}
+    for shift_name, aliases in self.selection_shifts.items():
+        self.uses |= set(aliases.values())
+        self.produces |= {f"shift_event_sel.{shift_name}", f"shift_channel_id.{shift_name}"}
+
+    if self.pack_steps:
+        self.produces |= {"step_bits"} | {
+            f"{collection}.step_bits"
+            for collection in step_bit_registry.steps
+            if collection != "event"
+        }
+
+
+# variant of the main selector with trigger object matching of the selected leptons
+main_trigmatch = main.derive("main_trigmatch", cls_dict={"match_trigger_objects": True})
+
+# progressive variant of the main selector
+main_progressive = main.derive("main_progressive", cls_dict={"progressive": True})
+
+# variant of the main selector evaluating all selection-dependent shifts in one pass
+main_multi_shift = main.derive("main_multi_shift", cls_dict={"multi_shift": True})
+
+# variant of the main selector storing packed step bit columns instead of per-object step masks
+main_packed = main.derive("main_packed", cls_dict={"pack_steps": True})
+
+# variant of the main selector reusing cached outputs of unchanged chunks
+main_cached = main.derive("main_cached", cls_dict={"cache_masks": True})
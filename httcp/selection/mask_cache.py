@@ -0,0 +1,406 @@
+# coding: utf-8
+
+"""
+Cache of event masks, object indices and produced columns of the selection per chunk, keyed by a
+hash of the selection code, the relevant config entries and the chunk inputs.
+
+Usage:
+
+    python -m httcp.selection.mask_cache [--max-age DAYS] [--max-size GB]
+
+Cached chunks that were not used for ``--max-age`` days are removed, followed by the least recently
+used ones until the cache is smaller than ``--max-size``. The same cleanup runs with the default
+limits when a cache is opened, at most once per :py:attr:`CLEANUP_INTERVAL_HOURS`.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import inspect
+import hashlib
+import argparse
+from typing import Any
+
+import law
+import order as od
+
+from columnflow.selection import Selector, SelectionResult
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, flat_np_view, has_ak_column, set_ak_column
+
+from httcp.selection.event_counts import file_identity
+from httcp.selection.stats import merge_stats, int_keys
+from httcp.selection.lazy_columns import nano_route
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+# config entries that affect the selection
+HASHED_CONFIG_ENTRIES = ("triggers", "btag_working_points", "met_filters", "cut_overrides")
+
+# config entries that affect the calibrations applied before the selection
+CALIBRATION_CONFIG_ENTRIES = ("external_files",)
+
+# columns identifying the events of a chunk
+IDENTITY_COLUMNS = ("run", "luminosityBlock", "event")
+
+# default limits of the cache, see cleanup
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_SIZE_GB = 20
+
+# minimum time between two automatic cleanups, see cleanup_due
+CLEANUP_INTERVAL_HOURS = 24
+
+
+def default_cache_dir() -> str:
+    return os.path.join(os.getenv("HTTCP_BASE", os.getcwd()), ".data", "selection_masks")
+
+
+def _source_files(selector_inst: Selector, package: str = "httcp") -> list[str]:
+    # source files of the selector and all its dependencies, plus all modules of the *package* that
+    # are referenced by those, e.g. for cut tables or kernels defined in other modules
+    modules = {}
+    queue = [selector_inst]
+    seen = set()
+    while queue:
+        inst = queue.pop()
+        if id(inst) in seen:
+            continue
+        seen.add(id(inst))
+        for func in (getattr(inst, "call_func", None), getattr(inst, "init_func", None)):
+            module = inspect.getmodule(func) if func is not None else None
+            if module is not None:
+                modules[module.__name__] = module
+        queue.extend(inst.deps.values())
+
+    pending = list(modules.values())
+    while pending:
+        module = pending.pop()
+        for value in list(vars(module).values()):
+            ref = value if inspect.ismodule(value) else inspect.getmodule(value)
+            if ref is None or ref.__name__ in modules:
+                continue
+            if ref.__name__ == package or ref.__name__.startswith(f"{package}."):
+                modules[ref.__name__] = ref
+                pending.append(ref)
+
+    return sorted(
+        path for path in (getattr(module, "__file__", None) for module in modules.values())
+        if path and path.endswith(".py")
+    )
+
+
+def _config_entry(value: Any, dataset_inst: Any = None) -> Any:
+    # json-compatible representation of config entries, triggers are described by their attributes
+    if hasattr(value, "legs") and hasattr(value, "hlt_field"):
+        return {
+            "name": value.name,
+            "id": value.id,
+            "run_range": value.run_range,
+            "legs": [(leg.pdg_id, leg.min_pt, leg.trigger_bits) for leg in value.legs or []],
+            "tags": sorted(value.tags),
+            "applies": bool(value.applies_to_dataset(dataset_inst)) if dataset_inst else None,
+        }
+    if isinstance(value, dict):
+        return {str(k): _config_entry(v, dataset_inst) for k, v in value.items()}
+    if isinstance(value, set):
+        return sorted((_config_entry(v, dataset_inst) for v in value), key=repr)
+    if isinstance(value, (list, tuple, od.UniqueObjectIndex)):
+        return [_config_entry(v, dataset_inst) for v in value]
+    return value
+
+
+def selection_hash(selector_inst: Selector) -> str:
+    """
+    Returns a hash over the sources of *selector_inst* and its dependencies, its class attributes
+    such as ``progressive``, the config entries in :py:attr:`HASHED_CONFIG_ENTRIES`, the dataset and
+    the shift.
+    """
+    config_inst = selector_inst.config_inst
+    dataset_inst = selector_inst.dataset_inst
+    shift_inst = getattr(selector_inst, "global_shift_inst", None)
+
+    h = hashlib.sha256()
+    for path in _source_files(selector_inst):
+        with open(path, "rb") as f:
+            h.update(os.path.basename(path).encode())
+            h.update(f.read())
+
+    attrs = {
+        attr: getattr(selector_inst, attr)
+        for attr in (
+            "cls_name", "match_trigger_objects", "batched_matching", "progressive", "pack_steps",
+            "multi_shift",
+        )
+        if hasattr(selector_inst, attr)
+    }
+    description = {
+        "attrs": attrs,
+        "config": {
+            name: _config_entry(config_inst.x(name, None), dataset_inst)
+            for name in HASHED_CONFIG_ENTRIES
+        },
+        "dataset": dataset_inst.name,
+        "shift": shift_inst.name if shift_inst else None,
+        "versions": [
+            getattr(sys.modules.get(name), "__version__", None)
+            for name in ("columnflow", "awkward", "coffea")
+        ],
+    }
+    h.update(json.dumps(description, sort_keys=True, default=repr).encode())
+
+    return h.hexdigest()
+
+
+def calibration_hash(calibrator_insts: list) -> str:
+    """
+    Returns a hash over the sources and names of the *calibrator_insts* applied before the
+    selection and the config entries in :py:attr:`CALIBRATION_CONFIG_ENTRIES`, which identifies the
+    calibrated inputs of a chunk together with its input file and entry range.
+    """
+    h = hashlib.sha256()
+    description = {"calibrators": [inst.cls_name for inst in calibrator_insts]}
+    for inst in calibrator_insts:
+        for path in _source_files(inst):
+            with open(path, "rb") as f:
+                h.update(os.path.basename(path).encode())
+                h.update(f.read())
+    if calibrator_insts:
+        config_inst = calibrator_insts[0].config_inst
+        shift_inst = getattr(calibrator_insts[0], "global_shift_inst", None)
+        description["config"] = {
+            name: _config_entry(config_inst.x(name, None))
+            for name in CALIBRATION_CONFIG_ENTRIES
+        }
+        description["shift"] = shift_inst.name if shift_inst else None
+    h.update(json.dumps(description, sort_keys=True, default=repr).encode())
+
+    return h.hexdigest()
+
+
+def cleanup(
+    cache_dir: str | None = None,
+    max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+    max_size_gb: float = DEFAULT_MAX_SIZE_GB,
+) -> int:
+    """
+    Removes cached chunks in *cache_dir* (defaulting to ``$HTTCP_BASE/.data/selection_masks``) that
+    were not used for *max_age_days*, then the least recently used ones until the total size is
+    below *max_size_gb*, as well as empty directories of outdated selection hashes. Returns the
+    number of removed chunks.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    # chunks as (last use, size, paths), the last use is the modification time of the stats file
+    chunks = []
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            stats_path = os.path.join(dirpath, filename)
+            paths = [stats_path, f"{stats_path[:-len('.json')]}.parquet"]
+            try:
+                last_use = os.stat(stats_path).st_mtime
+                size = sum(os.stat(path).st_size for path in paths if os.path.exists(path))
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            chunks.append((last_use, size, paths))
+    chunks.sort()
+
+    min_last_use = time.time() - max_age_days * 86400
+    total_size = sum(size for _, size, _ in chunks)
+    n_removed = 0
+    for last_use, size, paths in chunks:
+        if last_use >= min_last_use and total_size <= max_size_gb * 1024**3:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total_size -= size
+        n_removed += 1
+
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not os.listdir(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    if n_removed:
+        logger.info(f"removed {n_removed} cached chunks from {cache_dir}")
+    return n_removed
+
+
+def cleanup_due(cache_dir: str | None = None, interval_hours: float = CLEANUP_INTERVAL_HOURS) -> bool:
+    """
+    Returns whether the last automatic cleanup of *cache_dir* is older than *interval_hours*, as
+    recorded by the modification time of the file ``.last_cleanup`` in it, and updates that time if
+    so, so that concurrent jobs do not scan the whole cache again.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    stamp_path = os.path.join(cache_dir, ".last_cleanup")
+    try:
+        if time.time() - os.stat(stamp_path).st_mtime < interval_hours * 3600:
+            return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(stamp_path, "a"):
+        os.utime(stamp_path)
+    return True
+
+
+class MaskCache(object):
+    """
+    Cache of the selection outputs per chunk in *cache_dir* (defaulting to
+    ``$HTTCP_BASE/.data/selection_masks``), below a directory named after the
+    :py:func:`selection_hash` of *selector_inst*. Chunks are identified by the identity of their
+    input file, their entry range and the :py:func:`calibration_hash` when these are known, so
+    that cached chunks are found without reading any column. Otherwise, they are identified by the
+    hash of their input *columns* (typically all columns read by the selector, so that calibrations
+    are covered as well) and the identity columns.
+
+    Per chunk, the selection result (event mask, steps and object indices), the *produced_columns*
+    and the stats increments are stored. Unused chunks are removed when the cache is opened and the
+    last cleanup is older than :py:attr:`CLEANUP_INTERVAL_HOURS` (see :py:func:`cleanup`).
+    """
+
+    def __init__(self, selector_inst: Selector, produced_columns, cache_dir: str | None = None):
+        super().__init__()
+
+        if cleanup_due(cache_dir):
+            cleanup(cache_dir)
+
+        self.produced_columns = sorted({Route(column) for column in produced_columns}, key=str)
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), selection_hash(selector_inst))
+
+    def file_key(
+        self,
+        input_file: str | None = None,
+        entry_start: int | None = None,
+        entry_stop: int | None = None,
+        calibration_hash: str | None = None,
+        **kwargs,
+    ) -> str | None:
+        """
+        Returns the key of the chunk with entries from *entry_start* to *entry_stop* of the
+        *input_file*, calibrated as described by the *calibration_hash*, or *None* when one of them is
+        unknown or the file cannot be identified.
+        """
+        if not input_file or entry_start is None or entry_stop is None or calibration_hash is None:
+            return None
+        identity = file_identity(input_file)
+        if identity is None:
+            return None
+        return hashlib.sha256(f"{identity}:{entry_start}:{entry_stop}:{calibration_hash}".encode()).hexdigest()
+
+    def chunk_key(self, events: ak.Array, columns, **kwargs) -> str:
+        """
+        Returns the :py:meth:`file_key` of the chunk described by *kwargs* when known, and the hash
+        of the input *columns* and the identity columns of *events* otherwise.
+        """
+        key = self.file_key(**kwargs)
+        if key is not None:
+            return key
+
+        h = hashlib.sha256()
+        for column in sorted({nano_route(c) for c in (*IDENTITY_COLUMNS, *columns)}, key=str):
+            if not has_ak_column(events, column):
+                continue
+            values = column.apply(events)
+            h.update(str(column).encode())
+            if values.ndim > 1:
+                h.update(np.asarray(ak.num(values, axis=1)).tobytes())
+            h.update(np.ascontiguousarray(flat_np_view(values)).tobytes())
+        return h.hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}.parquet", f"{base}.json"
+
+    def load(self, key: str, events: ak.Array, stats: dict) -> tuple[ak.Array, SelectionResult] | None:
+        """
+        Returns the *events* with the cached produced columns and the cached selection result for
+        the chunk *key*, and adds the cached stats to *stats*, or returns *None* when the chunk is
+        not cached.
+        """
+        arrays_path, stats_path = self._paths(key)
+        if not os.path.exists(arrays_path) or not os.path.exists(stats_path):
+            return None
+
+        arrays = ak.from_parquet(arrays_path)
+        with open(stats_path, "r") as f:
+            merge_stats(stats, int_keys(json.load(f)))
+        # mark the chunk as used for the cleanup
+        os.utime(stats_path)
+
+        for column in self.produced_columns:
+            events = set_ak_column(events, column, column.apply(arrays.columns))
+        results = SelectionResult(
+            main={"event": arrays.results.event},
+            steps={name: arrays.results.steps[name] for name in arrays.results.steps.fields},
+            objects={
+                src: {dst: arrays.results.objects[src][dst] for dst in arrays.results.objects[src].fields}
+                for src in arrays.results.objects.fields
+            },
+        )
+        logger.debug(f"loaded selection of chunk {key} from cache")
+
+        return events, results
+
+    def save(self, key: str, events: ak.Array, results: SelectionResult, stats: dict) -> None:
+        """
+        Stores the produced columns of *events*, the *results* and the *stats* increments of the
+        chunk *key*.
+        """
+        columns = ak.Array(ak.contents.RecordArray([], [], length=len(events)))
+        for column in self.produced_columns:
+            columns = set_ak_column(columns, column, column.apply(events))
+        arrays = ak.zip({"results": results.to_ak(), "columns": columns}, depth_limit=1)
+
+        # write atomically since several jobs might process the same chunk
+        os.makedirs(self.cache_dir, exist_ok=True)
+        arrays_path, stats_path = self._paths(key)
+        ak.to_parquet(arrays, f"{arrays_path}.{os.getpid()}")
+        with open(f"{stats_path}.{os.getpid()}", "w") as f:
+            json.dump(stats, f, default=float)
+        os.replace(f"{arrays_path}.{os.getpid()}", arrays_path)
+        os.replace(f"{stats_path}.{os.getpid()}", stats_path)
+        logger.debug(f"stored selection of chunk {key} in cache")
+
+
+def get_mask_cache(selector_inst: Selector) -> MaskCache:
+    """
+    Returns the :py:class:`MaskCache` of *selector_inst*, creating it on first access.
+    """
+    if getattr(selector_inst, "mask_cache", None) is None:
+        selector_inst.mask_cache = MaskCache(selector_inst, selector_inst.produced_columns)
+    return selector_inst.mask_cache
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="remove unused chunks from the selection mask cache")
+    parser.add_argument("--cache-dir", help="cache directory, defaults to $HTTCP_BASE/.data/selection_masks")
+    parser.add_argument("--max-age", type=float, default=DEFAULT_MAX_AGE_DAYS, help="maximum days since last use")
+    parser.add_argument("--max-size", type=float, default=DEFAULT_MAX_SIZE_GB, help="maximum size in GB")
+    args = parser.parse_args(argv)
+
+    n_removed = cleanup(args.cache_dir, max_age_days=args.max_age, max_size_gb=args.max_size)
+    print(f"removed {n_removed} cached chunks")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
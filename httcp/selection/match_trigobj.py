@@ -10,12 +10,169 @@ from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column
 
-from httcp.util import trigger_object_matching
+from httcp.util import trigger_object_matching, njit, layout_offsets, flat_column
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+# condition types per trigger and collection in the batched matching
+NO_MATCH, MATCH_LEG, MATCH_BOTH_LEGS = 0, 1, 2
+
+# trigger tags and the names of the flags set for events in which such a trigger fired
+TRIGGER_FLAGS = {
+    "single_el": "single_electron_triggered",
+    "cross_el_tau": "cross_electron_triggered",
+    "single_mu": "single_muon_triggered",
+    "cross_mu_tau": "cross_muon_triggered",
+    "cross_tau_tau": "cross_tau_triggered",
+}
+
+
+def trigger_flags(trigger_results: SelectionResult, n_events: int) -> dict[str, np.ndarray]:
+    """
+    Returns the flags in :py:attr:`TRIGGER_FLAGS` per event, which only depend on the decisions of
+    the fired triggers in *trigger_results* and not on the matched objects.
+    """
+    flags = {name: np.zeros(n_events, dtype=bool) for name in TRIGGER_FLAGS.values()}
+    for trigger, trigger_fired, _ in trigger_results.x.trigger_data:
+        for tag, name in TRIGGER_FLAGS.items():
+            if trigger.has_tag(tag):
+                flags[name] |= np.asarray(trigger_fired)
+    return flags
+
+
+@njit(cache=True)
+def _leg_match_bits_kernel(offsets1, eta1, phi1, offsets2, eta2, phi2, leg_matrix, threshold):
+    # compute delta R once for all (object, trigger object) combinations per event and set bit r of
+    # an object when it is matched to a trigger object passing the unique leg definition r
+    bits = np.zeros(len(eta1), dtype=np.uint64)
+    threshold2 = threshold * threshold
+    n_legs = leg_matrix.shape[0]
+
+    for i in range(len(offsets1) - 1):
+        for k in range(offsets1[i], offsets1[i + 1]):
+            for t in range(offsets2[i], offsets2[i + 1]):
+                deta = eta2[t] - eta1[k]
+                if abs(deta) >= threshold:
+                    continue
+                dphi = (phi2[t] - phi1[k] + np.pi) % (2 * np.pi) - np.pi
+                if deta * deta + dphi * dphi >= threshold2:
+                    continue
+                for r in range(n_legs):
+                    if leg_matrix[r, t]:
+                        bits[k] |= np.uint64(1) << np.uint64(r)
+
+    return bits
+
+
+@njit(cache=True)
+def _apply_leg_matches_kernel(offsets, bits, fired, cond_types, bits_a, bits_b):
+    # apply the matching requirements of all fired triggers in their configured order per event,
+    # reproducing the sequential filtering of the per-trigger loop with bit operations only
+    keep = np.ones(len(bits), dtype=np.bool_)
+
+    for i in range(len(offsets) - 1):
+        start = offsets[i]
+        stop = offsets[i + 1]
+        for t in range(len(cond_types)):
+            if cond_types[t] == NO_MATCH or not fired[t, i]:
+                continue
+            if cond_types[t] == MATCH_LEG:
+                for k in range(start, stop):
+                    keep[k] = keep[k] and (bits[k] & bits_a[t]) != 0
+            else:
+                # both legs must be matched by at least one of the remaining objects
+                any_a = False
+                any_b = False
+                for k in range(start, stop):
+                    if keep[k]:
+                        any_a = any_a or (bits[k] & bits_a[t]) != 0
+                        any_b = any_b or (bits[k] & bits_b[t]) != 0
+                for k in range(start, stop):
+                    keep[k] = (
+                        keep[k] and any_a and any_b and
+                        (bits[k] & (bits_a[t] | bits_b[t])) != 0
+                    )
+
+    return keep
+
+
+def match_trigobj_batched(
+        events: ak.Array,
+        trigger_results: SelectionResult,
+        electron_indices: ak.Array,
+        muon_indices: ak.Array,
+        tau_indices: ak.Array,
+        threshold: float = 0.5,
+) -> tuple[ak.Array, ak.Array, ak.Array]:
+    """
+    Batched version of the per-trigger matching loop in :py:func:`match_trigobj`. All selected
+    leptons are matched against all unique trigger legs in one pass, resulting in an
+    (object x leg) bitmask per collection, from which the filtered indices are derived.
+    """
+    leg_matrix = trigger_results.x.trigger_leg_matrix
+    if len(leg_matrix) > 64:
+        raise ValueError(f"batched trigger matching supports at most 64 unique legs, got {len(leg_matrix)}")
+
+    # per collection, the matching condition and leg bits per trigger
+    collections = {"Electron": electron_indices, "Muon": muon_indices, "Tau": tau_indices}
+    n_trigger = len(trigger_results.x.trigger_data)
+    cond_types = {name: np.zeros(n_trigger, dtype=np.int64) for name in collections}
+    bits_a = {name: np.zeros(n_trigger, dtype=np.uint64) for name in collections}
+    bits_b = {name: np.zeros(n_trigger, dtype=np.uint64) for name in collections}
+    fired = np.zeros((n_trigger, len(events)), dtype=bool)
+    for t, ((trigger, trigger_fired, _), leg_refs) in enumerate(zip(
+        trigger_results.x.trigger_data,
+        trigger_results.x.trigger_leg_refs,
+    )):
+        fired[t] = np.asarray(trigger_fired)
+        leg_bits = [np.uint64(1) << np.uint64(r) for r in leg_refs]
+        if trigger.has_tag("single_mu") or trigger.has_tag("single_el"):
+            name = "Muon" if trigger.has_tag("single_mu") else "Electron"
+            # catch config errors
+            assert trigger.n_legs == len(leg_refs) == 1
+            assert abs(trigger.legs[0].pdg_id) == (13 if name == "Muon" else 11)
+            cond_types[name][t], bits_a[name][t] = MATCH_LEG, leg_bits[0]
+        elif trigger.has_tag("cross_mu_tau") or trigger.has_tag("cross_el_tau"):
+            name = "Muon" if trigger.has_tag("cross_mu_tau") else "Electron"
+            # catch config errors
+            assert trigger.n_legs == len(leg_refs) == 2
+            assert abs(trigger.legs[0].pdg_id) == (13 if name == "Muon" else 11)
+            assert abs(trigger.legs[1].pdg_id) == 15
+            cond_types[name][t], bits_a[name][t] = MATCH_LEG, leg_bits[0]
+            cond_types["Tau"][t], bits_a["Tau"][t] = MATCH_LEG, leg_bits[1]
+        elif trigger.has_tag("cross_tau_tau"):
+            # catch config errors
+            assert trigger.n_legs == len(leg_refs) >= 2
+            assert abs(trigger.legs[0].pdg_id) == 15
+            assert abs(trigger.legs[1].pdg_id) == 15
+            cond_types["Tau"][t] = MATCH_BOTH_LEGS
+            bits_a["Tau"][t], bits_b["Tau"][t] = leg_bits[0], leg_bits[1]
+
+    trig_offsets = layout_offsets(events.TrigObj.eta)
+    trig_eta = np.asarray(flat_column(events.TrigObj.eta), dtype=np.float64)
+    trig_phi = np.asarray(flat_column(events.TrigObj.phi), dtype=np.float64)
+
+    matched_indices = []
+    for name, indices in collections.items():
+        objects = events[name][indices]
+        offsets = layout_offsets(indices)
+        bits = _leg_match_bits_kernel(
+            offsets,
+            np.asarray(flat_column(objects.eta), dtype=np.float64),
+            np.asarray(flat_column(objects.phi), dtype=np.float64),
+            trig_offsets, trig_eta, trig_phi,
+            leg_matrix, float(threshold),
+        )
+        keep = _apply_leg_matches_kernel(
+            offsets, bits, fired, cond_types[name], bits_a[name], bits_b[name],
+        )
+        matched_indices.append(indices[ak.unflatten(keep, ak.num(indices, axis=1))])
+
+    return tuple(matched_indices)
+
+
 @selector(
     uses={
         "Electron.pt", "Electron.eta", "Electron.phi", "Electron.mass",
@@ -37,9 +194,15 @@ def match_trigobj(
         muon_indices: ak.Array,
         tau_indices: ak.Array,
         domatch: Optional[bool] = False,
+        batched: Optional[bool] = False,
         **kwargs
 ) -> ak.Array:
-    
+    """
+    Trigger object matching of the selected electrons, muons and taus. When *domatch* is *True*, the
+    indices are filtered per fired trigger and its legs, either in a loop over all triggers or, when
+    *batched* is *True*, with a single pass over all legs via :py:func:`match_trigobj_batched`.
+    """
+
     # prepare vectors for output vectors
     false_mask = (abs(events.event) < 0)
     single_electron_triggered = false_mask
@@ -51,7 +214,23 @@ def match_trigobj(
     electron_indices_dummy = electron_indices[:,:0]
     muon_indices_dummy     = muon_indices[:,:0]
     tau_indices_dummy      = tau_indices[:,:0]
-    if domatch:
+    if domatch and batched:
+        # flags from the trigger decisions alone
+        flags = trigger_flags(trigger_results, len(events))
+        single_electron_triggered = flags["single_electron_triggered"]
+        cross_electron_triggered = flags["cross_electron_triggered"]
+        single_muon_triggered = flags["single_muon_triggered"]
+        cross_muon_triggered = flags["cross_muon_triggered"]
+        cross_tau_triggered = flags["cross_tau_triggered"]
+
+        electron_indices, muon_indices, tau_indices = match_trigobj_batched(
+            events,
+            trigger_results,
+            electron_indices,
+            muon_indices,
+            tau_indices,
+        )
+    elif domatch:
         # perform each lepton election step separately per trigger
         for trigger, trigger_fired, leg_masks in trigger_results.x.trigger_data:
             #print(f"trigger: {trigger}")
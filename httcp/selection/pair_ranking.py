@@ -0,0 +1,82 @@
+# coding: utf-8
+
+"""
+Shared ranking of lepton pairs, i.e. the choice of the best h-candidate pair per event.
+Reference: Section 7.6 of http://cms.cern.ch/iCMS/jsp/openfile.jsp?tp=draft&files=AN2019_192_v15.pdf
+"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+from columnflow.util import maybe_import
+
+from httcp.util import njit, layout_offsets, flat_column
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+@njit(cache=True)
+def _best_pair_kernel(offsets, keys, ascending):
+    # single pass over all pairs per event, keeping the position of the best one so far
+    # (a pair only replaces the current best when it is strictly better, so the first pair wins ties)
+    n_events = len(offsets) - 1
+    n_keys = keys.shape[0]
+    best = np.full(n_events, -1, dtype=np.int64)
+
+    for i in range(n_events):
+        start = offsets[i]
+        stop = offsets[i + 1]
+        if stop == start:
+            continue
+        b = start
+        for j in range(start + 1, stop):
+            for c in range(n_keys):
+                x = keys[c, j]
+                y = keys[c, b]
+                if x == y:
+                    continue
+                if (x < y) if ascending[c] else (x > y):
+                    b = j
+                break
+        best[i] = b
+
+    return best
+
+
+def get_best_pair(
+        pairs: ak.Array,
+        pair_indices: ak.Array,
+        criteria: Sequence[tuple[str, str, bool]],
+) -> ak.Array:
+    """
+    Picks the best pair per event out of the lepton *pairs* (as obtained from ``ak.cartesian`` or
+    ``ak.combinations``) according to a lexicographic ranking and returns the corresponding entries
+    of *pair_indices* as ``[lep1_idx, lep2_idx]``, or an empty list for events without pairs.
+
+    *criteria* is a sequence of ``(leg, field, ascending)`` tuples, e.g.
+    ``("0", "pfRelIso03_all", True)``, that are compared in the given order. The next criterion is
+    only considered when all previous ones are equal. No sorting is involved, so the cost is linear
+    in the number of pairs.
+    """
+    # float64 keys preserve the ordering of all nano column types
+    keys = np.stack([
+        np.asarray(flat_column(pairs[leg][field]), dtype=np.float64)
+        for leg, field, _ in criteria
+    ])
+    ascending = np.array([asc for _, _, asc in criteria], dtype=np.bool_)
+
+    best = _best_pair_kernel(layout_offsets(pair_indices), keys, ascending)
+    best = best[best >= 0]
+
+    # interleave the indices of both legs of the chosen pairs
+    lep1_idx = flat_column(pair_indices["0"])
+    lep2_idx = flat_column(pair_indices["1"])
+    flat_pair = np.empty(2 * len(best), dtype=lep1_idx.dtype)
+    flat_pair[0::2] = lep1_idx[best]
+    flat_pair[1::2] = lep2_idx[best]
+
+    counts = 2 * (np.asarray(ak.num(pair_indices, axis=1)) > 0)
+
+    return ak.unflatten(flat_pair, counts)
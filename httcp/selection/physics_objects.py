@@ -11,12 +11,130 @@ from columnflow.selection.util import sorted_indices_from_mask
 from columnflow.util import maybe_import, DotDict
 from columnflow.columnar_util import optional_column as optional
 
-from httcp.util import IF_NANO_V9, IF_NANO_V11
+from httcp.util import IF_NANO_V9, IF_NANO_V11, layout_offsets, flat_column
+from httcp.selection.cut_tables import CutTable, cut_names
+from httcp.selection.index_cache import IndexCache, sorted_indices, local_index
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+# ------------------------------------------------------------------------------------------------------- #
+# Cut tables
+#
+# Per collection, the good selection (whose cumulative steps are kept) followed by the veto selections,
+# each as a list of (name, variable, operator, threshold, use_abs). Thresholds can be overridden per
+# config, see httcp.selection.cut_tables.
+# ------------------------------------------------------------------------------------------------------- #
+MUON_CUTS = {
+    "good": [
+        ("muon_pt_26", "pt", ">", 26, False),
+        ("muon_eta_2p4", "eta", "<", 2.4, True),
+        ("mediumID", "mediumId", "==", 1, False),
+        ("muon_dxy_0p045", "dxy", "<", 0.045, True),
+        ("muon_dz_0p2", "dz", "<", 0.2, True),
+        ("muon_iso_0p15", "pfRelIso04_all", "<", 0.15, False),
+    ],
+    "veto": [
+        ("veto_muon_pt_10", "pt", ">", 10, False),
+        ("veto_muon_eta_2p4", "eta", "<", 2.4, True),
+        ("veto_mediumID", "mediumId", "==", 1, False),
+        ("veto_muon_dxy_0p045", "dxy", "<", 0.045, True),
+        ("veto_muon_dz_0p2", "dz", "<", 0.2, True),
+        ("veto_muon_iso_0p3", "pfRelIso04_all", "<", 0.3, False),
+    ],
+    "double_veto": [
+        ("dlveto_muon_pt_15", "pt", ">", 15, False),
+        ("dlveto_muon_eta_2p4", "eta", "<", 2.4, True),
+        ("dlveto_isGlobal", "isGlobal", "==", 1, False),
+        ("dlveto_isPFcand", "isPFcand", "==", 1, False),
+        ("dlveto_muon_dxy_0p045", "dxy", "<", 0.045, True),
+        ("dlveto_muon_dz_0p2", "dz", "<", 0.2, True),
+        ("dlveto_muon_iso_0p3", "pfRelIso04_all", "<", 0.3, False),
+    ],
+}
+
+# >= nano v10 column names
+ELECTRON_CUTS = {
+    "good": [
+        ("electron_pt_25", "pt", ">", 25, False),
+        ("electron_eta_2p1", "eta", "<", 2.1, True),
+        ("electron_dxy_0p045", "dxy", "<", 0.045, True),
+        ("electron_dz_0p2", "dz", "<", 0.2, True),
+        ("electron_mva_iso_wp80", "mvaIso_WP80", "==", 1, False),
+    ],
+    "veto": [
+        ("veto_electron_pt_10", "pt", ">", 10, False),
+        ("veto_electron_eta_2p5", "eta", "<", 2.5, True),
+        ("veto_electron_dxy_0p045", "dxy", "<", 0.045, True),
+        ("veto_electron_dz_0p2", "dz", "<", 0.2, True),
+        ("veto_electron_mva_noniso_wp90", "mvaNoIso_WP90", "==", 1, False),
+        ("veto_electron_conv_veto", "convVeto", "==", 1, False),
+        ("veto_electron_iso_0p3", "pfRelIso03_all", "<", 0.3, False),
+    ],
+    "double_veto": [
+        ("dlveto_electron_pt_15", "pt", ">", 15, False),
+        ("dlveto_electron_eta_2p5", "eta", "<", 2.5, True),
+        ("dlveto_electron_dxy_0p045", "dxy", "<", 0.045, True),
+        ("dlveto_electron_dz_0p2", "dz", "<", 0.2, True),
+        ("dlveto_electron_cut_based", "cutBased", "==", 1, False),
+        ("dlveto_electron_iso_0p3", "pfRelIso03_all", "<", 0.3, False),
+    ],
+}
+
+# DeepTau working points, see
+# https://cms-nanoaod-integration.web.cern.ch/integration/cms-swmaster/data106Xul17v2_v10_doc.html#Tau
+# vs e: vvloose = 2, vloose = 3; vs mu: vloose = 1, tight = 4; vs jet: vvloose = 2, loose = 4, medium = 5
+TAU_CUTS = {
+    "good": [
+        ("tau_pt_20", "pt", ">", 20, False),
+        ("tau_eta_2p3", "eta", "<", 2.3, True),
+        ("tau_dz_0p2", "dz", "<", 0.2, True),
+        ("DeepTauVSjet", "idDeepTau2018v2p5VSjet", ">=", 5, False),
+        ("DeepTauVSe", "idDeepTau2018v2p5VSe", ">=", 2, False),
+        ("DeepTauVSmu", "idDeepTau2018v2p5VSmu", ">=", 4, False),
+    ],
+}
+
+# names of the per-object selection steps, in the order in which they are applied
+MUON_STEPS = cut_names(MUON_CUTS["good"])
+ELECTRON_STEPS = cut_names(ELECTRON_CUTS["good"])
+TAU_STEPS = cut_names(TAU_CUTS["good"])
+JET_STEPS = ("jet_pt_30", "jet_eta_2.4", "jet_id", "jet_puId", "btag")
+
+# bit of the loose working point in the Run-2 UL pileup jet id flags (tight = 1, medium = 2, loose = 4)
+JET_PUID_LOOSE = 0b100
+
+
+def apply_cut_table(
+        cut_table: CutTable,
+        events: ak.Array,
+        collection_name: str,
+        index_cache: IndexCache | None = None,
+) -> tuple[dict[str, ak.Array], list[ak.Array]]:
+    """
+    Evaluates a compiled *cut_table* on the objects of a collection, visited in pt-sorted order,
+    and returns a dictionary of per-object step masks of the first selection as well as a list of
+    pt-sorted index arrays per selection.
+    """
+    collection = events[collection_name]
+    object_counts = ak.num(collection.pt, axis=1)
+    pt_sorted = sorted_indices(events, collection_name, index_cache=index_cache)
+    columns = {variable: flat_column(collection[variable]) for variable in cut_table.variables}
+
+    steps, indices, counts = cut_table(layout_offsets(collection.pt), flat_column(pt_sorted), columns)
+
+    selection_steps = {
+        name: ak.unflatten(steps[i], object_counts)
+        for i, name in enumerate(cut_table.step_names)
+    }
+    index_lists = [
+        ak.unflatten(indices[i, :n_total], counts[i])
+        for i, n_total in enumerate(counts.sum(axis=1))
+    ]
+    return selection_steps, index_lists
+
+
 # ------------------------------------------------------------------------------------------------------- #
 # Muon Selection
 # Reference:
@@ -38,75 +156,34 @@ def muon_selection(
 ) -> tuple[ak.Array, SelectionResult, ak.Array, ak.Array, ak.Array]:
     """
     Muon selection returning two sets of indidces for default and veto muons.
+
+    Good muons:
+      pt > 26, |eta| < 2.4, mediumId, |dxy| < 0.045, |dz| < 0.2, pfRelIso04_all < 0.15
+    Single veto muons:
+      pt > 10, |eta| < 2.4, mediumId, |dxy| < 0.045, |dz| < 0.2, pfRelIso04_all < 0.3
+    Double veto muons:
+      pt > 15, |eta| < 2.4, isGlobal, isPFcand, |dxy| < 0.045, |dz| < 0.2, pfRelIso04_all < 0.3
+
+    The cuts are defined in :py:attr:`MUON_CUTS`.
     
     References:
       - Isolation working point: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2?rev=59
       - ID und ISO : https://twiki.cern.ch/twiki/bin/view/CMS/MuonUL2017?rev=15
     """
-    good_selections = {
-        "muon_pt_26"          : events.Muon.pt > 26,
-        "muon_eta_2p4"        : abs(events.Muon.eta) < 2.4,
-        "mediumID"            : events.Muon.mediumId == 1,
-        "muon_dxy_0p045"      : abs(events.Muon.dxy) < 0.045,
-        "muon_dz_0p2"         : abs(events.Muon.dz) < 0.2,
-        "muon_iso_0p15"       : events.Muon.pfRelIso04_all < 0.15
-    }
-    single_veto_selections = {
-        "muon_pt_10"          : events.Muon.pt > 10,
-        "muon_eta_2p4"        : abs(events.Muon.eta) < 2.4,
-        "mediumID"            : events.Muon.mediumId == 1,
-        "muon_dxy_0p045"      : abs(events.Muon.dxy) < 0.045,
-        "muon_dz_0p2"         : abs(events.Muon.dz) < 0.2,
-        "muon_iso_0p3"        : events.Muon.pfRelIso04_all < 0.3
-    }
-    double_veto_selections = {
-        "muon_pt_15"          : events.Muon.pt > 15,
-        "muon_eta_2p4"        : abs(events.Muon.eta) < 2.4,
-        "muon_isGlobal"       : events.Muon.isGlobal == True,
-        "muon_isPF"           : events.Muon.isPFcand == True,
-        #"muon_isTracker"      : events.Muon.isTracker ==True,
-        "muon_dxy_0p045"      : abs(events.Muon.dxy) < 0.045,
-        "muon_dz_0p2"         : abs(events.Muon.dz) < 0.2,
-        "muon_iso_0p3"        : events.Muon.pfRelIso04_all < 0.3
-    }
-
-    # pt sorted indices for converting masks to indices
-    sorted_indices = ak.argsort(events.Muon.pt, axis=-1, ascending=False)
-    muon_mask  = ak.local_index(events.Muon.pt) >= 0
-    
-    good_muon_mask = muon_mask
-    single_veto_muon_mask = muon_mask
-    double_veto_muon_mask = muon_mask
-    selection_steps = {}
-
-    for cut in good_selections.keys():
-        good_muon_mask = good_muon_mask & good_selections[cut]
-        selection_steps[cut] = good_muon_mask
-
-
-    for cut in single_veto_selections.keys():
-        single_veto_muon_mask = single_veto_muon_mask & single_veto_selections[cut]
-    #single_veto_muon_mask = single_veto_muon_mask & ~good_muon_mask
-
-    for cut in double_veto_selections.keys():
-        double_veto_muon_mask = double_veto_muon_mask & double_veto_selections[cut]
-    #double_veto_muon_mask = double_veto_muon_mask & ~good_muon_mask
-
-    # convert to sorted indices
-    good_muon_indices = sorted_indices[good_muon_mask[sorted_indices]]
-    good_muon_indices = ak.values_astype(good_muon_indices, np.int32)
-
-    veto_muon_indices = sorted_indices[single_veto_muon_mask[sorted_indices]]
-    veto_muon_indices = ak.values_astype(veto_muon_indices, np.int32)
-
-    double_veto_muon_indices = sorted_indices[double_veto_muon_mask[sorted_indices]]
-    double_veto_muon_indices = ak.values_astype(double_veto_muon_indices, np.int32)
+    selection_steps, (good_muon_indices, veto_muon_indices, double_veto_muon_indices) = (
+        apply_cut_table(self.cut_table, events, "Muon", kwargs.get("index_cache"))
+    )
 
     return events, SelectionResult(
         aux=selection_steps,
     ), good_muon_indices, veto_muon_indices, double_veto_muon_indices
 
 
+@muon_selection.init
+def muon_selection_init(self: Selector) -> None:
+    self.cut_table = CutTable.from_config(getattr(self, "config_inst", None), "muon", MUON_CUTS)
+
+
 # ------------------------------------------------------------------------------------------------------- #
 # Electron Selection
 # Reference:
@@ -130,78 +207,33 @@ def electron_selection(
 ) -> tuple[ak.Array, SelectionResult, ak.Array, ak.Array, ak.Array]:
     """
     Electron selection returning two sets of indidces for default and veto muons.
+
+    Good electrons:
+      pt > 25, |eta| < 2.1, |dxy| < 0.045, |dz| < 0.2, mvaIso_WP80
+    Single veto electrons:
+      pt > 10, |eta| < 2.5, |dxy| < 0.045, |dz| < 0.2, mvaNoIso_WP90, convVeto, pfRelIso03_all < 0.3
+    Double veto electrons:
+      pt > 15, |eta| < 2.5, |dxy| < 0.045, |dz| < 0.2, cutBased == 1, pfRelIso03_all < 0.3
+
+    The cuts are defined in :py:attr:`ELECTRON_CUTS`.
     
     References:
       - https://twiki.cern.ch/twiki/bin/view/CMS/EgammaNanoAOD?rev=4
     """
-    # >= nano v10
-    mva_iso_wp80 = events.Electron.mvaIso_WP80
-    mva_iso_wp90 = events.Electron.mvaIso_WP90
-    mva_noniso_wp90 = events.Electron.mvaNoIso_WP90
-
-    good_selections = {
-        "electron_pt_25"          : events.Electron.pt > 25,
-        "electron_eta_2p1"        : abs(events.Electron.eta) < 2.1,
-        "electron_dxy_0p045"      : abs(events.Electron.dxy) < 0.045,
-        "electron_dz_0p2"         : abs(events.Electron.dz) < 0.2,
-        "electron_mva_iso_wp80"   : mva_iso_wp80 == 1,
-    }
-    single_veto_selections = {
-        "electron_pt_10"          : events.Electron.pt > 10,
-        "electron_eta_2p5"        : abs(events.Electron.eta) < 2.5,
-        "electron_dxy_0p045"      : abs(events.Electron.dxy) < 0.045,
-        "electron_dz_0p2"         : abs(events.Electron.dz) < 0.2,
-        "electron_mva_noniso_wp90": mva_noniso_wp90 == 1,
-        "electron_convVeto"       : events.Electron.convVeto == 1,
-        #"electron_lostHits"       : events.Electron.lostHits <= 1,
-        "electron_pfRelIso03_all" : events.Electron.pfRelIso03_all < 0.3,
-    }
-    double_veto_selections = {
-        "electron_pt_15"          : events.Electron.pt > 15,
-        "electron_eta_2p5"        : abs(events.Electron.eta) < 2.5,
-        "electron_dxy_0p045"      : abs(events.Electron.dxy) < 0.045,
-        "electron_dz_0p2"         : abs(events.Electron.dz) < 0.2,
-        "electron_cutBased"       : events.Electron.cutBased == 1,
-        "electron_pfRelIso03_all" : events.Electron.pfRelIso03_all < 0.3,
-    }
-
-    # pt sorted indices for converting masks to indices
-    sorted_indices = ak.argsort(events.Electron.pt, axis=-1, ascending=False)    
-    electron_mask  = ak.local_index(events.Electron.pt) >= 0
-    good_electron_mask = electron_mask
-    single_veto_electron_mask = electron_mask
-    double_veto_electron_mask = electron_mask
-    selection_steps = {}
-
-    for cut in good_selections.keys():
-        good_electron_mask = good_electron_mask & good_selections[cut]
-        selection_steps[cut] = good_electron_mask
-
-
-    for cut in single_veto_selections.keys():
-        single_veto_electron_mask = single_veto_electron_mask & single_veto_selections[cut]
-    #single_veto_electron_mask = single_veto_electron_mask & ~good_electron_mask
-
-    for cut in double_veto_selections.keys():
-        double_veto_electron_mask = double_veto_electron_mask & double_veto_selections[cut]
-    #double_veto_electron_mask = double_veto_electron_mask & ~good_electron_mask
-
-    # convert to sorted indices
-    good_electron_indices = sorted_indices[good_electron_mask[sorted_indices]]
-    good_electron_indices = ak.values_astype(good_electron_indices, np.int32)
-
-    veto_electron_indices = sorted_indices[single_veto_electron_mask[sorted_indices]]
-    veto_electron_indices = ak.values_astype(veto_electron_indices, np.int32)
-
-    double_veto_electron_indices = sorted_indices[double_veto_electron_mask[sorted_indices]]
-    double_veto_electron_indices = ak.values_astype(double_veto_electron_indices, np.int32)
-
+    selection_steps, (good_electron_indices, veto_electron_indices, double_veto_electron_indices) = (
+        apply_cut_table(self.cut_table, events, "Electron", kwargs.get("index_cache"))
+    )
 
     return events, SelectionResult(
         aux=selection_steps,
     ), good_electron_indices, veto_electron_indices, double_veto_electron_indices
 
 
+@electron_selection.init
+def electron_selection_init(self: Selector) -> None:
+    self.cut_table = CutTable.from_config(getattr(self, "config_inst", None), "electron", ELECTRON_CUTS)
+
+
 # ------------------------------------------------------------------------------------------------------- #
 # Tau Selection
 # Reference:
@@ -226,46 +258,25 @@ def tau_selection(
 ) -> tuple[ak.Array, SelectionResult, ak.Array]:
     """
     Tau selection returning two sets of indidces for default and veto muons.
+    The cuts are defined in :py:attr:`TAU_CUTS`.
     
     References:
       - 
     """
-    # https://cms-nanoaod-integration.web.cern.ch/integration/cms-swmaster/data106Xul17v2_v10_doc.html#Tau
-    tau_vs_e = DotDict(vvloose=2, vloose=3)
-    tau_vs_mu = DotDict(vloose=1, tight=4)
-    tau_vs_jet = DotDict(vvloose=2, loose=4, medium=5)
-    
-    good_selections = {
-        "tau_pt_20"     : events.Tau.pt > 20,
-        "tau_eta_2p3"   : abs(events.Tau.eta) < 2.3,
-        "tau_dz_0p2"    : abs(events.Tau.dz) < 0.2,
-        "DeepTauVSjet"  : events.Tau.idDeepTau2018v2p5VSjet >= tau_vs_jet.medium,
-        "DeepTauVSe"    : events.Tau.idDeepTau2018v2p5VSe   >= tau_vs_e.vvloose,
-        "DeepTauVSmu"   : events.Tau.idDeepTau2018v2p5VSmu  >= tau_vs_mu.tight,
-        #"CleanFromEle"  : ak.all(events.Tau.metric_table(events.Electron[electron_indices]) > 0.5, axis=2),
-        #"CleanFromMu"   : ak.all(events.Tau.metric_table(events.Muon[muon_indices]) > 0.5, axis=2),
-    }
-
-    # pt sorted indices for converting masks to indices
-    sorted_indices = ak.argsort(events.Tau.pt, axis=-1, ascending=False)
-    tau_mask  = ak.local_index(events.Tau.pt) >= 0
-
-    good_tau_mask = tau_mask
-    selection_steps = {}
-
-    for cut in good_selections.keys():
-        good_tau_mask = good_tau_mask & good_selections[cut]
-        selection_steps[cut] = good_tau_mask
-
-    # convert to sorted indices
-    good_tau_indices = sorted_indices[good_tau_mask[sorted_indices]]
-    good_tau_indices = ak.values_astype(good_tau_indices, np.int32)
+    #"CleanFromEle"  : ak.all(events.Tau.metric_table(events.Electron[electron_indices]) > 0.5, axis=2),
+    #"CleanFromMu"   : ak.all(events.Tau.metric_table(events.Muon[muon_indices]) > 0.5, axis=2),
+    selection_steps, (good_tau_indices,) = apply_cut_table(self.cut_table, events, "Tau", kwargs.get("index_cache"))
 
     return events, SelectionResult(
         aux=selection_steps,
     ), good_tau_indices
 
 
+@tau_selection.init
+def tau_selection_init(self: Selector) -> None:
+    self.cut_table = CutTable.from_config(getattr(self, "config_inst", None), "tau", TAU_CUTS)
+
+
 # ------------------------------------------------------------------------------------------------------- #
 # Jet Selection
 # Reference:
@@ -291,7 +302,7 @@ def jet_selection(
     year = self.config_inst.campaign.x.year
     is_run2 = (self.config_inst.campaign.x.year in [2016,2017,2018])
 
-    sorted_indices = ak.argsort(events.Jet.pt, axis=-1, ascending=False)
+    jet_sorted_indices = sorted_indices(events, "Jet", index_cache=kwargs.get("index_cache"))
     # nominal selection
     jet_selections = {
         "jet_pt_30"               : events.Jet.pt > 30.0,
@@ -299,20 +310,20 @@ def jet_selection(
         "jet_id"                  : events.Jet.jetId == 0b110,  # Jet ID flag: bit2 is tight, bit3 is tightLepVeto 
     }
     
-    if is_run2: good_selections["jet_puId"] = ((events.Jet.pt >= 50.0) | (events.Jet.puId)) #For the Run2 there was an additional selection to mitigate pile-up jets
+    if is_run2: jet_selections["jet_puId"] = ((events.Jet.pt >= 50.0) | ((events.Jet.puId & JET_PUID_LOOSE) != 0)) #For the Run2 there was an additional selection to mitigate pile-up jets
     
     # b-tagged jets, tight working point
     btag_wp = self.config_inst.x.btag_working_points[year].deepjet.medium
     jet_selections["btag"] = events.Jet.btagDeepFlavB >= btag_wp
     
-    jet_mask  = ak.local_index(events.Jet.pt) >= 0 #Create a mask filled with ones
+    jet_mask  = local_index(events, "Jet", index_cache=kwargs.get("index_cache")) >= 0 #Create a mask filled with ones
     selection_steps = {}
 
     for cut in jet_selections.keys():
         jet_mask = jet_mask & jet_selections[cut]
         selection_steps[cut] = jet_mask
 
-    jet_indices = ak.values_astype(sorted_indices[~jet_mask[sorted_indices]], np.int32) #Save the jets that do not satisfy veto criteria 
+    jet_indices = ak.values_astype(jet_sorted_indices[~jet_mask[jet_sorted_indices]], np.int32) #Save the jets that do not satisfy veto criteria 
    
     # bjet veto
     bjet_veto = ak.sum(jet_mask, axis=1) == 0
@@ -0,0 +1,413 @@
+# coding: utf-8
+
+"""
+Preskim with loosened object cuts and exact re-selection on the preskimmed events.
+
+Usage:
+
+    python -m httcp.selection.preskim skim FILE [FILE ...] --output-dir DIR
+    python -m httcp.selection.preskim reselect DIR --output-dir OUT
+    python -m httcp.selection.preskim verify DIR --output-dir OUT
+
+The :py:func:`preskim` selector keeps events with at least two leptons passing loosened versions of
+the good muon, electron and tau cut tables. The loosening per variable is configured by the
+auxiliary entry ``preskim_loosening`` (e.g. ``{"pt": 5.0}`` lowers all pt thresholds by 5 GeV).
+Since the main selection requires two good leptons, dropped events fail it for all cuts that are at
+least as tight as the loosened ones. They also never form a pair and so always end up in the channel
+of events without pairs, so their stats contributions are computed once during the preskim.
+
+The re-selection runs the exact calibration and main selection on the stored input columns of the
+preskimmed events and adds the stats of the dropped events. Its outputs cover all input events in
+their original order, with dropped events failing the selection and receiving default values in all
+other results and produced columns. The event selection masks and all outputs of selected events
+are identical to those of a run on the full input, and so are the stats, up to the summation order
+of weights. Before running, it checks that the current cuts lie within the loosened envelope.
+``verify`` runs both the re-selection and the selection of the full input files of a preskim and
+compares their outputs.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+import law
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.production.processes import process_ids
+from columnflow.production.cms.mc_weight import mc_weight
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column, get_ak_routes, has_ak_column
+
+from httcp.util import load_analysis_insts
+from httcp.selection.cut_tables import CutTable
+from httcp.selection.physics_objects import (
+    MUON_CUTS, ELECTRON_CUTS, TAU_CUTS, apply_cut_table, muon_selection, electron_selection,
+    tau_selection,
+)
+from httcp.selection.event_category import get_categories
+from httcp.selection.main import custom_increment_stats
+from httcp.selection.stats import merge_stats, int_keys
+from httcp.selection.local_executor import (
+    build_selection, read_chunk, select, write_chunk, merge_outputs, split_chunks, run_local,
+)
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+# cut tables entering the preskim, as table name -> (collection, cut table)
+PRESKIM_TABLES = {
+    "muon": ("Muon", MUON_CUTS),
+    "electron": ("Electron", ELECTRON_CUTS),
+    "tau": ("Tau", TAU_CUTS),
+}
+
+# stats entries that are not expected to agree between the re-selection and a full run, e.g. timings
+UNCOMPARED_STATS = ("selector_profile",)
+
+# loosening of thresholds per variable when not configured via the auxiliary entry
+# "preskim_loosening"
+DEFAULT_LOOSENING = {"pt": 5.0}
+
+
+def tight_cuts(config_inst, table_name: str, cuts: dict) -> list[tuple]:
+    """
+    Returns the cuts of the good selection of the table *table_name* with the thresholds used by the
+    main selection, i.e., including the overrides of *config_inst*.
+    """
+    return CutTable.from_config(config_inst, table_name, cuts).selections["good"]
+
+
+def loosen_cuts(cuts: list[tuple], loosening: dict[str, float]) -> list[tuple]:
+    """
+    Returns *cuts* whose thresholds are moved by the amounts in *loosening* per variable in the
+    direction in which more objects pass. Equality cuts are kept.
+    """
+    loose = []
+    for name, variable, op, threshold, use_abs in cuts:
+        amount = loosening.get(variable, 0)
+        if op in (">", ">="):
+            threshold = threshold - amount
+        elif op in ("<", "<="):
+            threshold = threshold + amount
+        loose.append((name, variable, op, threshold, use_abs))
+    return loose
+
+
+def check_envelope(config_inst, loose_cuts: dict[str, list]) -> None:
+    """
+    Raises a *ValueError* when a current good cut of *config_inst* is looser than the corresponding
+    cut in *loose_cuts* that was used to create a preskim.
+    """
+    for table_name, (_, cuts) in PRESKIM_TABLES.items():
+        loose = {cut[0]: cut for cut in loose_cuts[table_name]}
+        for name, variable, op, threshold, _ in tight_cuts(config_inst, table_name, cuts):
+            if name not in loose:
+                raise ValueError(f"cut '{name}' of the {table_name} selection is not part of the preskim")
+            loose_threshold = loose[name][3]
+            if op in (">", ">="):
+                within = threshold >= loose_threshold
+            elif op in ("<", "<="):
+                within = threshold <= loose_threshold
+            else:
+                within = threshold == loose_threshold
+            if not within:
+                raise ValueError(
+                    f"cut '{name}' ({variable} {op} {threshold}) of the {table_name} selection is looser than "
+                    f"in the preskim ({variable} {op} {loose_threshold}), the preskim must be produced again",
+                )
+
+
+@selector(
+    uses={
+        muon_selection, electron_selection, tau_selection, get_categories,
+        process_ids, mc_weight, custom_increment_stats,
+    },
+    produces={process_ids, mc_weight},
+    exposed=True,
+)
+def preskim(
+    self: Selector,
+    events: ak.Array,
+    stats: defaultdict,
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    n_loose = 0
+    for collection, cut_table in self.loose_tables.items():
+        _, (indices,) = apply_cut_table(cut_table, events, collection)
+        n_loose = n_loose + ak.num(indices, axis=1)
+    keep = np.asarray(n_loose >= 2)
+
+    events = self[process_ids](events, **kwargs)
+    if self.dataset_inst.is_mc:
+        events = self[mc_weight](events, **kwargs)
+
+    # stats of the dropped events, which never pass the main selection and have no pair
+    dropped = events[~keep]
+    no_pair_id = self[get_categories].channel_table[0]
+    dropped = set_ak_column(dropped, "channel_id", np.full(len(dropped), no_pair_id))
+    never = np.zeros(len(dropped), dtype=bool)
+    self[custom_increment_stats](dropped, SelectionResult(main={"event": never}), stats, **kwargs)
+
+    return events, SelectionResult(
+        main={"event": keep},
+        steps={"preskim": keep},
+    )
+
+
+@preskim.init
+def preskim_init(self: Selector) -> None:
+    config_inst = getattr(self, "config_inst", None)
+    loosening = DEFAULT_LOOSENING
+    if config_inst is not None and config_inst.has_aux("preskim_loosening"):
+        loosening = config_inst.x.preskim_loosening
+
+    self.loose_cuts = {
+        table_name: loosen_cuts(tight_cuts(config_inst, table_name, cuts), loosening)
+        for table_name, (_, cuts) in PRESKIM_TABLES.items()
+    }
+    self.loose_tables = {
+        collection: CutTable({"good": self.loose_cuts[table_name]})
+        for table_name, (collection, _) in PRESKIM_TABLES.items()
+    }
+
+
+def run_preskim(
+    paths: list[str],
+    output_dir: str,
+    chunk_size: int | None = None,
+    calibrators: list[str] | None = None,
+    **inst_kwargs,
+) -> None:
+    """
+    Runs the :py:func:`preskim` on all *paths* in chunks of *chunk_size* entries and stores, per
+    chunk, all input columns of the calibrators and the main selector for the kept events, the mask
+    of kept events and the stats of the dropped events in *output_dir*.
+    """
+    _, config_inst, _ = load_analysis_insts(**inst_kwargs)
+    if calibrators is None:
+        calibrators = law.util.make_list(config_inst.x.default_calibrator)
+    if chunk_size is None:
+        chunk_size = law.config.get_expanded_int("analysis", "chunked_io_chunk_size")
+
+    main_state = build_selection(inst_kwargs, calibrators, "main", progressive_reads=False)
+    skim_state = build_selection(inst_kwargs, calibrators, "preskim")
+    columns = sorted(set(main_state["read_columns"]) | set(skim_state["read_columns"]), key=str)
+
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = []
+    n_total = n_kept = 0
+    for file_index, chunk_index, path, entry_start, entry_stop in split_chunks(paths, chunk_size):
+        # keep the uncalibrated inputs, the calibration is repeated in the re-selection
+        events, _ = read_chunk(path, entry_start, entry_stop, columns)
+        stats = defaultdict(float)
+        # the generated counts of the file are part of the stats of the dropped events
+        _, results = select(skim_state, events, stats, input_file=path, entry_start=entry_start)
+        keep = np.asarray(results.event)
+
+        basename = f"preskim_{file_index}_{chunk_index}"
+        ak.to_parquet(events[keep], os.path.join(output_dir, f"{basename}.parquet"))
+        np.save(os.path.join(output_dir, f"{basename}_keep.npy"), keep)
+        chunks.append({
+            "file_index": file_index,
+            "chunk_index": chunk_index,
+            "input_file": path,
+            "entry_start": entry_start,
+            "entry_stop": entry_stop,
+            "basename": basename,
+            "stats": merge_stats({}, stats),
+        })
+        n_total += len(events)
+        n_kept += int(keep.sum())
+
+    with open(os.path.join(output_dir, "preskim.json"), "w") as f:
+        json.dump({"loose_cuts": skim_state["selector_inst"].loose_cuts, "chunks": chunks}, f, indent=4)
+    logger.info(f"preskim kept {n_kept} of {n_total} events")
+
+
+def dropped_stats(selector_inst: Selector, stats: dict) -> dict:
+    """
+    Returns the *stats* of the dropped events of a preskim chunk, completed with the entries of the
+    selected events per shift of *selector_inst* in the multi-shift mode. Shifts only affect jets
+    and MET, so dropped events fail the selection in all of them.
+    """
+    stats = merge_stats(defaultdict(float), stats)
+    for shift_name in getattr(selector_inst, "selection_shifts", {}):
+        stats[f"num_events_selected_{shift_name}"] += 0
+        if selector_inst.dataset_inst.is_mc:
+            stats[f"sum_mc_weight_selected_{shift_name}"] += 0.0
+    return stats
+
+
+def compare_outputs(output_dir: str, reference_dir: str, rtol: float = 1e-9) -> list[str]:
+    """
+    Compares the merged selection outputs in *output_dir* to those in *reference_dir* and returns
+    descriptions of all differences. Event selection masks and the stats must agree, the latter up
+    to the relative tolerance *rtol*, and all other results and columns must agree for selected
+    events.
+    """
+    differences = []
+
+    results = ak.from_parquet(os.path.join(output_dir, "results.parquet"))
+    ref_results = ak.from_parquet(os.path.join(reference_dir, "results.parquet"))
+    if len(results) != len(ref_results):
+        return [f"number of events differs: {len(results)} != {len(ref_results)}"]
+    event_sel = np.asarray(ref_results.event)
+    n_diff = int(np.sum(np.asarray(results.event) != event_sel))
+    if n_diff:
+        differences.append(f"event selection differs in {n_diff} events")
+
+    columns = ak.from_parquet(os.path.join(output_dir, "columns.parquet"))
+    ref_columns = ak.from_parquet(os.path.join(reference_dir, "columns.parquet"))
+    for name, arrays, ref_arrays in (("results", results, ref_results), ("columns", columns, ref_columns)):
+        for route in sorted(set(get_ak_routes(arrays)) | set(get_ak_routes(ref_arrays)), key=str):
+            if not has_ak_column(arrays, route) or not has_ak_column(ref_arrays, route):
+                differences.append(f"{name} column {route} only exists in one of the outputs")
+            elif not ak.array_equal(route.apply(arrays)[event_sel], route.apply(ref_arrays)[event_sel], equal_nan=True):
+                differences.append(f"{name} column {route} differs for selected events")
+
+    with open(os.path.join(output_dir, "stats.json"), "r") as f:
+        stats = json.load(f)
+    with open(os.path.join(reference_dir, "stats.json"), "r") as f:
+        ref_stats = json.load(f)
+    for key in sorted((set(stats) | set(ref_stats)) - set(UNCOMPARED_STATS)):
+        value, ref_value = stats.get(key), ref_stats.get(key)
+        if isinstance(value, dict) and isinstance(ref_value, dict):
+            pairs = [(f"{key}.{k}", value.get(k), ref_value.get(k)) for k in sorted(set(value) | set(ref_value))]
+        else:
+            pairs = [(key, value, ref_value)]
+        for name, a, b in pairs:
+            numbers = all(isinstance(v, (int, float)) for v in (a, b))
+            if not numbers or not np.isclose(a, b, rtol=rtol, atol=0):
+                differences.append(f"stats entry {name} differs: {a} != {b}")
+
+    return differences
+
+
+def verify(
+    preskim_dir: str,
+    output_dir: str,
+    calibrators: list[str] | None = None,
+    selector: str | None = None,
+    workers: int | None = None,
+    **inst_kwargs,
+) -> list[str]:
+    """
+    Runs :py:func:`reselect` on the preskim in *preskim_dir* and the local executor on the full input
+    files of the preskim, writing to the ``reselect`` and ``full`` subdirectories of *output_dir*,
+    and returns the differences between both (see :py:func:`compare_outputs`).
+    """
+    with open(os.path.join(preskim_dir, "preskim.json"), "r") as f:
+        meta = json.load(f)
+    paths = list(dict.fromkeys(
+        chunk["input_file"]
+        for chunk in sorted(meta["chunks"], key=lambda chunk: (chunk["file_index"], chunk["chunk_index"]))
+    ))
+
+    reselect_dir = os.path.join(output_dir, "reselect")
+    full_dir = os.path.join(output_dir, "full")
+    reselect(preskim_dir, reselect_dir, calibrators=calibrators, selector=selector, **inst_kwargs)
+    os.makedirs(full_dir, exist_ok=True)
+    run_local(paths, full_dir, workers=workers, calibrators=calibrators, selector=selector, **inst_kwargs)
+
+    return compare_outputs(reselect_dir, full_dir)
+
+
+def reselect(
+    preskim_dir: str,
+    output_dir: str,
+    calibrators: list[str] | None = None,
+    selector: str | None = None,
+    **inst_kwargs,
+) -> dict:
+    """
+    Runs the *calibrators* and the *selector* (defaulting to those of the config) on the preskim
+    in *preskim_dir* and writes ``results.parquet``, ``columns.parquet`` and ``stats.json`` to
+    *output_dir*, see :py:func:`httcp.selection.local_executor.merge_outputs`. Results and columns
+    cover all input events, and the merged stats include the dropped events and are returned.
+    """
+    _, config_inst, _ = load_analysis_insts(**inst_kwargs)
+    if calibrators is None:
+        calibrators = law.util.make_list(config_inst.x.default_calibrator)
+    if selector is None:
+        selector = config_inst.x.default_selector
+
+    with open(os.path.join(preskim_dir, "preskim.json"), "r") as f:
+        meta = json.load(f)
+    check_envelope(config_inst, meta["loose_cuts"])
+
+    state = build_selection(inst_kwargs, calibrators, selector, progressive_reads=False)
+
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    for chunk in meta["chunks"]:
+        events = ak.from_parquet(os.path.join(preskim_dir, f"{chunk['basename']}.parquet"))
+        keep = np.load(os.path.join(preskim_dir, f"{chunk['basename']}_keep.npy"))
+        stats = defaultdict(float)
+        events, results = select(state, events, stats)
+
+        # stats of the dropped events first, then those of the re-selected ones
+        chunk_stats = dropped_stats(state["selector_inst"], int_keys(chunk["stats"]))
+        chunk_stats = merge_stats(chunk_stats, stats)
+        basename = os.path.join(output_dir, f"chunk_{chunk['file_index']}_{chunk['chunk_index']}")
+        outputs[(chunk["file_index"], chunk["chunk_index"])] = (
+            chunk_stats,
+            *write_chunk(state, events, results, basename, keep=keep),
+        )
+
+    return merge_outputs(outputs, output_dir)
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    skim_parser = subparsers.add_parser("skim", help="create a preskim of NanoAOD files")
+    skim_parser.add_argument("paths", nargs="+", help="input NanoAOD files")
+    skim_parser.add_argument("--chunk-size", type=int, help="entries per chunk, defaults to the law.cfg")
+    reselect_parser = subparsers.add_parser("reselect", help="run the selection on a preskim")
+    reselect_parser.add_argument("preskim_dir", help="directory of the preskim")
+    reselect_parser.add_argument("--selector", help="selector, defaults to the config")
+    verify_parser = subparsers.add_parser("verify", help="compare the re-selection to a run on the full input")
+    verify_parser.add_argument("preskim_dir", help="directory of the preskim")
+    verify_parser.add_argument("--selector", help="selector, defaults to the config")
+    verify_parser.add_argument("--workers", type=int, help="processes for the full run, defaults to the number of cpus")
+    for sub in (skim_parser, reselect_parser, verify_parser):
+        sub.add_argument("--output-dir", required=True, help="output directory")
+        sub.add_argument("--calibrators", help="comma-separated calibrators, defaults to the config")
+        sub.add_argument("--analysis", help="analysis instance, defaults to the law.cfg")
+        sub.add_argument("--config", help="config name, defaults to the law.cfg")
+        sub.add_argument("--dataset", help="dataset name, defaults to the law.cfg")
+    args = parser.parse_args(argv)
+
+    inst_kwargs = {"analysis": args.analysis, "config": args.config, "dataset": args.dataset}
+    calibrators = args.calibrators.split(",") if args.calibrators else None
+    if args.command == "skim":
+        run_preskim(args.paths, args.output_dir, chunk_size=args.chunk_size, calibrators=calibrators, **inst_kwargs)
+    elif args.command == "verify":
+        differences = verify(
+            args.preskim_dir,
+            args.output_dir,
+            calibrators=calibrators,
+            selector=args.selector,
+            workers=args.workers,
+            **inst_kwargs,
+        )
+        for difference in differences:
+            logger.error(difference)
+        if differences:
+            return 1
+        logger.info("re-selection and full run agree")
+    else:
+        stats = reselect(args.preskim_dir, args.output_dir, calibrators=calibrators, selector=args.selector, **inst_kwargs)
+        logger.info(f"selected {stats.get('num_events_selected', 0)} of {stats.get('num_events', 0)} events")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+"""
+Opt-in timing and memory instrumentation of the selectors called by the main selector.
+
+Profiling is enabled by setting the level of the ``httcp.selection.profiling`` logger in the
+``[logging]`` section of the law.cfg to ``INFO`` (or ``DEBUG`` to also log the numbers per call).
+When disabled, selectors are called directly without any wrapping.
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+import resource
+from collections import defaultdict
+from typing import Any, Callable
+
+import law
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+# keys of the measured quantities, summed over calls, chunks and files
+PROFILE_KEYS = ("calls", "wall_time", "cpu_time", "max_rss_growth_mb", "output_mb")
+
+
+def profiling_enabled() -> bool:
+    return logger.isEnabledFor(logging.INFO)
+
+
+def output_nbytes(obj: Any) -> int:
+    """
+    Returns the summed size in bytes of all arrays in *obj*, which can be an array, a
+    :py:class:`SelectionResult`, or a nested tuple, list or dict of those.
+    """
+    if isinstance(obj, ak.Array):
+        return obj.nbytes
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(output_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(output_nbytes(o) for o in obj.values())
+    if hasattr(obj, "steps") and hasattr(obj, "aux"):
+        # SelectionResult
+        return output_nbytes(obj.steps) + output_nbytes(obj.aux) + output_nbytes(obj.objects)
+    return 0
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is given in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class SelectorProfile(object):
+    """
+    Accumulates the wall time, cpu time, growth of the peak resident memory and size of the outputs
+    of calls to selectors and producers for one chunk.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.entries = defaultdict(lambda: dict.fromkeys(PROFILE_KEYS, 0))
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            rss_before = _max_rss_mb()
+            cpu_before = time.process_time()
+            wall_before = time.perf_counter()
+
+            output = func(*args, **kwargs)
+
+            entry = self.entries[name]
+            entry["calls"] += 1
+            entry["wall_time"] += time.perf_counter() - wall_before
+            entry["cpu_time"] += time.process_time() - cpu_before
+            entry["max_rss_growth_mb"] += _max_rss_mb() - rss_before
+            entry["output_mb"] += output_nbytes(output) / 1024.0**2
+            logger.debug(f"{name}: {entry}")
+
+            return output
+
+        return wrapper
+
+    def merge_into(self, stats: dict, key: str = "selector_profile") -> dict:
+        """
+        Adds the numbers of this profile to the entry *key* of the selection *stats* in-place, so
+        that they are written to the stats json next to the selection results and are summed by the
+        merging of stats across files.
+        """
+        profile = stats.setdefault(key, {})
+        for name, entry in self.entries.items():
+            merged = profile.setdefault(name, dict.fromkeys(PROFILE_KEYS, 0))
+            for k, v in entry.items():
+                merged[k] += v
+        return stats
+
+
+def profiled(self, func: Any, profile: SelectorProfile | None) -> Callable:
+    """
+    Returns the instance of the dependency *func* of the calling selector *self*, wrapped by the
+    *profile* if given.
+    """
+    inst = self[func]
+    if profile is None:
+        return inst
+    return profile.wrap(inst.cls_name, inst)
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+"""
+Helpers for accumulating selection stats.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def grouped_sums(
+    group_ids: np.ndarray | ak.Array,
+    weights: dict[str, np.ndarray | ak.Array],
+    masks: dict[str, np.ndarray | ak.Array] | None = None,
+) -> dict[str, dict[int, float]]:
+    """
+    Computes the sums of all *weights* columns per unique value of *group_ids*, e.g. per process
+    or channel id. Ids are remapped to a dense range once and each weight column is reduced with a
+    single ``np.bincount``, so the cost does not scale with the number of groups. Optional event
+    *masks* per weight name restrict the events entering the respective sum.
+
+    The result maps the weight names to dictionaries of ``{group_id: sum}``.
+    """
+    unique_ids, dense_ids = np.unique(np.asarray(group_ids), return_inverse=True)
+    unique_ids = unique_ids.tolist()
+
+    sums = {}
+    for name, values in weights.items():
+        values = np.asarray(values, dtype=np.float64)
+        if masks and masks.get(name) is not None:
+            values = np.where(np.asarray(masks[name]), values, 0.0)
+        group_sums = np.bincount(dense_ids, weights=values, minlength=len(unique_ids))
+        sums[name] = dict(zip(unique_ids, group_sums.tolist()))
+
+    return sums
+
+
+def merge_grouped_sums(
+    stats: dict,
+    sums: dict[str, dict[int, float]],
+    group_name: str,
+) -> dict:
+    """
+    Adds the partial *sums* obtained with :py:func:`grouped_sums` for one chunk to the *stats*
+    entries ``"{name}_per_{group_name}"`` in-place and returns *stats*. Sums of event counts, i.e.,
+    of entries starting with ``"num_"``, are stored as integers like in columnflow.
+    """
+    for name, group_sums in sums.items():
+        is_count = name.startswith("num_")
+        entry = stats.setdefault(f"{name}_per_{group_name}", defaultdict(int if is_count else float))
+        for group_id, value in group_sums.items():
+            entry[int(group_id)] += int(round(value)) if is_count else value
+
+    return stats
+
+
+def merge_stats(target: dict, stats: dict) -> dict:
+    """
+    Adds all numbers in *stats*, including nested dictionaries such as the per-process sums, to
+    *target* in-place and returns *target*. Numpy scalars are converted to python numbers so that
+    the merged stats can be written to json.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(target.setdefault(key, defaultdict(float)), value)
+        else:
+            value = value.item() if isinstance(value, np.generic) else value
+            target[key] = target.get(key, 0) + value
+
+    return target
+
+
+def int_keys(stats: dict) -> dict:
+    """
+    Converts the keys of nested *stats* that were read from json back to integers where possible,
+    e.g. for the sums per process or channel id.
+    """
+    return {
+        (int(k) if k.lstrip("-").isdigit() else k): (int_keys(v) if isinstance(v, dict) else v)
+        for k, v in stats.items()
+    }
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+"""
+Packing of selection step masks into integer bit columns.
+"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+from columnflow.util import maybe_import
+
+from httcp.util import flat_column
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class StepBitRegistry(object):
+    """
+    Registry of bit positions of selection steps per collection, e.g.
+    ``{"event": ("trigger", "b_veto", ...), "Muon": ("muon_pt_26", ...)}``. Step *i* of a collection
+    is stored in bit *i* of its packed column, which is a uint32 for up to 32 steps and a uint64
+    otherwise. Since positions only follow from the order of the registered names, cutflows and
+    N-1 selections can be evaluated later on the packed columns using :py:meth:`mask`. Steps that
+    were not applied to a chunk count as passed.
+    """
+
+    def __init__(self, steps: dict[str, Sequence[str]] | None = None):
+        super().__init__()
+
+        self.steps = {}
+        for collection, names in (steps or {}).items():
+            self.register(collection, names)
+
+    def register(self, collection: str, names: Sequence[str]) -> None:
+        names = tuple(self.steps.get(collection, ())) + tuple(
+            name for name in names
+            if name not in self.steps.get(collection, ())
+        )
+        if len(names) > 64:
+            raise ValueError(f"cannot pack {len(names)} steps of collection '{collection}' into 64 bits")
+        self.steps[collection] = names
+
+    def bit(self, collection: str, name: str) -> int:
+        return self.steps[collection].index(name)
+
+    def dtype(self, collection: str) -> np.dtype:
+        return np.dtype(np.uint32 if len(self.steps[collection]) <= 32 else np.uint64)
+
+    def mask(self, collection: str, names: Sequence[str] | None = None) -> int:
+        """
+        Returns the integer with the bits of all step *names* of a *collection* set, defaulting to
+        all registered steps. Objects or events passing all these steps fulfill
+        ``packed & mask == mask``.
+        """
+        if names is None:
+            names = self.steps[collection]
+        return sum(1 << self.bit(collection, name) for name in names)
+
+    def pack(
+        self,
+        collection: str,
+        masks: dict[str, np.ndarray | ak.Array],
+        like: np.ndarray | ak.Array,
+    ) -> np.ndarray | ak.Array:
+        """
+        Packs the boolean step *masks* of a *collection* into a single integer column with the
+        layout of *like*, i.e., flat per event or jagged per object. *masks* must be registered.
+        Registered steps that are missing in *masks* were not applied, e.g. the json filter in
+        simulation, and have their bit set so that ``packed & mask == mask`` only tests applied
+        steps.
+        """
+        dtype = self.dtype(collection)
+        counts = ak.num(like, axis=1) if getattr(like, "ndim", 1) > 1 else None
+        size = len(like) if counts is None else int(ak.sum(counts))
+
+        not_applied = [name for name in self.steps[collection] if name not in masks]
+        packed = np.full(size, self.mask(collection, not_applied), dtype=dtype)
+        for name, values in masks.items():
+            values = flat_column(values) if counts is not None else np.asarray(values)
+            packed |= values.astype(dtype) << dtype.type(self.bit(collection, name))
+
+        return packed if counts is None else ak.unflatten(packed, counts)
@@ -8,6 +8,8 @@ from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column, optional_column as opt
 
+from httcp.util import flat_column
+from httcp.selection.index_cache import local_index
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -38,13 +40,34 @@ def trigger_selection(
     trigger_ids = []
 
     # index of TrigObj's to repeatedly convert masks to indices
-    index = ak.local_index(events.TrigObj)
-    
-    for trigger in self.config_inst.x.triggers:
-        # skip the trigger if it does not apply to the dataset
-        if not trigger.applies_to_dataset(self.dataset_inst):
-            continue
-        
+    index = local_index(events, "TrigObj", index_cache=kwargs.get("index_cache"))
+
+    # evaluate each unique leg definition once on the flat TrigObj content
+    n_objs = ak.num(events.TrigObj.id, axis=1)
+    abs_id = np.abs(flat_column(events.TrigObj.id))
+    obj_pt = flat_column(events.TrigObj.pt)
+    filter_bits = flat_column(events.TrigObj.filterBits)
+    leg_table = []
+    leg_matrix = np.zeros((len(self.unique_legs), len(abs_id)), dtype=bool)
+    for r, (pdg_id, min_pt, trigger_bits) in enumerate(self.unique_legs):
+        # start with a True mask
+        leg_mask = np.ones(len(abs_id), dtype=bool)
+        # pdg id selection
+        if pdg_id is not None:
+            leg_mask &= abs_id == pdg_id
+        # pt cut
+        if min_pt is not None:
+            leg_mask &= obj_pt >= min_pt
+        # trigger bits match
+        # OR across bits themselves, AND between all decision in the list
+        for bits in trigger_bits:
+            leg_mask &= (filter_bits & bits) > 0
+        leg_matrix[r] = leg_mask
+        leg_mask = ak.unflatten(leg_mask, n_objs)
+        # store the indices of matching objects and whether at least one object matches this leg
+        leg_table.append((index[leg_mask], ak.any(leg_mask, axis=1)))
+
+    for trigger, leg_refs in self.trigger_leg_refs:
         # get bare decisions
         fired = events.HLT[trigger.hlt_field] == 1
         any_fired = any_fired | fired
@@ -52,23 +75,10 @@ def trigger_selection(
         # get trigger objects for fired events per leg
         leg_masks = []
         all_legs_match = True
-        for leg in trigger.legs:
-            # start with a True mask
-            leg_mask = abs(events.TrigObj.id) >= 0
-            # pdg id selection
-            if leg.pdg_id is not None:
-                leg_mask = leg_mask & (abs(events.TrigObj.id) == leg.pdg_id)
-            # pt cut
-            if leg.min_pt is not None:
-                leg_mask = leg_mask & (events.TrigObj.pt >= leg.min_pt)
-            # trigger bits match
-            if leg.trigger_bits is not None:
-                # OR across bits themselves, AND between all decision in the list
-                for bits in leg.trigger_bits:
-                    leg_mask = leg_mask & ((events.TrigObj.filterBits & bits) > 0)
-            leg_masks.append(index[leg_mask])
-            # at least one object must match this leg
-            all_legs_match = all_legs_match & ak.any(leg_mask, axis=1)
+        for ref in leg_refs:
+            leg_indices, leg_matched = leg_table[ref]
+            leg_masks.append(leg_indices)
+            all_legs_match = all_legs_match & leg_matched
 
         # final trigger decision
         fired_and_all_legs_match = fired & all_legs_match
@@ -90,6 +100,10 @@ def trigger_selection(
         },
         aux={
             "trigger_data": trigger_data,
+            # flat TrigObj masks per unique leg and, aligned with trigger_data, the positions of the
+            # legs of each trigger in that table (used by the batched trigger object matching)
+            "trigger_leg_matrix": leg_matrix,
+            "trigger_leg_refs": [leg_refs for _, leg_refs in self.trigger_leg_refs],
         },
     )
 
@@ -99,9 +113,51 @@ def trigger_selection_init(self: Selector) -> None:
     if getattr(self, "dataset_inst", None) is None:
         return
 
-    # full used columns
-    self.uses |= {
-        opt(trigger.name)
+    # triggers that apply to the dataset
+    triggers = [
+        trigger
         for trigger in self.config_inst.x.triggers
         if trigger.applies_to_dataset(self.dataset_inst)
-    }
+    ]
+
+    # full used columns
+    self.uses |= {opt(trigger.name) for trigger in triggers}
+
+    # table of unique (pdg_id, min_pt, trigger_bits) leg definitions that are evaluated once per
+    # chunk, and per trigger the positions of its legs in that table
+    self.unique_legs = []
+    self.trigger_leg_refs = []
+    for trigger in triggers:
+        leg_refs = []
+        for leg in trigger.legs or []:
+            key = (leg.pdg_id, leg.min_pt, tuple(leg.trigger_bits or ()))
+            if key not in self.unique_legs:
+                self.unique_legs.append(key)
+            leg_refs.append(self.unique_legs.index(key))
+        self.trigger_leg_refs.append((trigger, leg_refs))
+
+
+def subset_trigger_results(
+    trigger_results: SelectionResult,
+    events: ak.Array,
+    keep: np.ndarray,
+) -> SelectionResult:
+    """
+    Returns a new :py:class:`SelectionResult` with the aux data of *trigger_results* restricted to
+    the *events* selected by the boolean *keep* mask, as needed by subsequent selectors that only run
+    on the surviving subset of events.
+    """
+    trigger_data = [
+        (trigger, fired[keep], [leg_indices[keep] for leg_indices in leg_masks])
+        for trigger, fired, leg_masks in trigger_results.x.trigger_data
+    ]
+    # the leg matrix is defined on the flat TrigObj content
+    keep_objs = np.repeat(keep, np.asarray(ak.num(events.TrigObj.id, axis=1)))
+
+    return SelectionResult(
+        aux={
+            "trigger_data": trigger_data,
+            "trigger_leg_matrix": trigger_results.x.trigger_leg_matrix[:, keep_objs],
+            "trigger_leg_refs": trigger_results.x.trigger_leg_refs,
+        },
+    )
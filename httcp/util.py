@@ -7,18 +7,89 @@ Collection of helpers
 from __future__ import annotations
 
 
+import importlib
 import law
 import order as od
 from typing import Any
 from columnflow.util import maybe_import
-from columnflow.columnar_util import ArrayFunction, deferred_column
+from columnflow.columnar_util import ArrayFunction, EMPTY_FLOAT, deferred_column, flat_np_view
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
+nb = maybe_import("numba")
 coffea = maybe_import("coffea")
 maybe_import("coffea.nanoevents.methods.nanoaod")
 
 
+def njit(*args, **kwargs) -> Any:
+    """
+    Wrapper around ``numba.njit`` that leaves the decorated function untouched when numba is not
+    available, e.g. when modules are imported outside of the columnar sandbox.
+    """
+    if nb:
+        return nb.njit(*args, **kwargs)
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda func: func
+
+
+def layout_offsets(array: ak.Array) -> np.ndarray:
+    """
+    Returns the offsets of a jagged *array* along the first axis as a numpy array with one entry
+    more than the number of events.
+    """
+    counts = np.asarray(ak.num(array, axis=1))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def flat_column(array: ak.Array) -> np.ndarray:
+    """
+    Returns the flat content of a jagged *array* as a numpy array to be passed to compiled kernels.
+    """
+    return flat_np_view(array, axis=1)
+
+
+def scatter_to_events(values: ak.Array, keep: np.ndarray) -> ak.Array:
+    """
+    Inverse of ``values = full[keep]``, i.e., places *values* obtained on the subset of events
+    selected by the boolean *keep* mask back at their original positions. Rejected events receive
+    None for option types, empty lists for jagged arrays, and *False*, 0 or ``EMPTY_FLOAT``
+    otherwise, depending on the dtype of *values*. Fields of records are treated separately.
+    """
+    if values.fields and values.ndim == 1 and not values.layout.is_option:
+        return ak.zip(
+            {field: scatter_to_events(values[field], keep) for field in values.fields},
+            depth_limit=1,
+        )
+
+    index = ak.mask(np.cumsum(keep) - 1, keep)
+    full = values[index]
+
+    if values.layout.is_option:
+        return full
+    if values.ndim > 1:
+        return ak.fill_none(full, [], axis=0)
+
+    dtype = np.asarray(values).dtype
+    fill_value = False if dtype.kind == "b" else (EMPTY_FLOAT if dtype.kind == "f" else 0)
+    return ak.fill_none(full, dtype.type(fill_value), axis=0)
+
+
+def as_threshold(value: float | int, array: np.ndarray) -> float:
+    """
+    Rounds a cut *value* to the precision of the flat float *array* it is compared to and returns it
+    as a python float. Comparisons in compiled kernels then yield the same decisions as the numpy
+    comparison of the array against the plain value. Values compared to integer or boolean arrays
+    are kept as they are, since these comparisons are exact anyway and casting would truncate
+    fractional thresholds.
+    """
+    if np.asarray(array).dtype.kind != "f":
+        return float(value)
+    return float(np.asarray(value, dtype=array.dtype))
+
+
 @deferred_column
 def IF_NANO_V9(self, func: ArrayFunction) -> Any | set[Any]:
     return self.get() if func.config_inst.campaign.x.version == 9 else None
@@ -29,30 +100,68 @@ def IF_NANO_V11(self, func: ArrayFunction) -> Any | set[Any]:
     return self.get() if func.config_inst.campaign.x.version >= 10 else None
 
 
-def transverse_mass(lepton: ak.Array, met: ak.Array) -> ak.Array:
-    dphi_lep_met = lepton.delta_phi(met)
-    mt = np.sqrt(2 * lepton.pt * met.pt * (1 - np.cos(dphi_lep_met)))
-    return mt
+@njit(cache=True)
+def _trigger_object_matching_kernel(offsets1, eta1, phi1, offsets2, eta2, phi2, threshold):
+    # per event, sort the objects in vectors2 by eta and sweep over the window |deta| < threshold
+    # around each object in vectors1, so that delta R is only computed for nearby candidates
+    matched = np.full(len(eta1), -1, dtype=np.int64)
+    threshold2 = threshold * threshold
+
+    for i in range(len(offsets1) - 1):
+        start2 = offsets2[i]
+        stop2 = offsets2[i + 1]
+        if start2 == stop2:
+            continue
+        order = np.argsort(eta2[start2:stop2])
+        sorted_eta = eta2[start2:stop2][order]
+
+        for k in range(offsets1[i], offsets1[i + 1]):
+            best_dr2 = threshold2
+            first = np.searchsorted(sorted_eta, eta1[k] - threshold)
+            for m in range(first, stop2 - start2):
+                deta = sorted_eta[m] - eta1[k]
+                if deta >= threshold:
+                    break
+                j = order[m]
+                dphi = (phi2[start2 + j] - phi1[k] + np.pi) % (2 * np.pi) - np.pi
+                dr2 = deta * deta + dphi * dphi
+                if dr2 < best_dr2:
+                    best_dr2 = dr2
+                    matched[k] = j
+
+    return matched
 
 
 def trigger_object_matching(
     vectors1: ak.Array,
     vectors2: ak.Array,
     threshold: float = 0.5,
-    axis: int = 2,
-) -> ak.Array:
+    return_indices: bool = False,
+) -> ak.Array | tuple[ak.Array, ak.Array]:
     """
     Helper to check per object in *vectors1* if there is at least one object in *vectors2* that
-    leads to a delta R metric below *threshold*. The final reduction is applied over *axis* of the
-    resulting metric table containing the full combinatorics. When *return_all_matches* is *True*,
-    the matrix with all matching decisions is returned as well.
+    leads to a delta R metric below *threshold*. Both arrays are expected to be jagged with one list
+    of objects per event. Instead of the full metric table, objects in *vectors2* are sorted by eta
+    per event and delta R is only computed for candidates within the eta window of *threshold*.
+    When *return_indices* is *True*, the local index of the closest matching object in *vectors2*
+    (or -1 when there is none) is returned as well.
     """
-    # delta_r for all combinations
-    dr = vectors1.metric_table(vectors2)
+    eta1 = np.asarray(flat_column(vectors1.eta), dtype=np.float64)
+    phi1 = np.asarray(flat_column(vectors1.phi), dtype=np.float64)
+    eta2 = np.asarray(flat_column(vectors2.eta), dtype=np.float64)
+    phi2 = np.asarray(flat_column(vectors2.phi), dtype=np.float64)
+
+    matched = _trigger_object_matching_kernel(
+        layout_offsets(vectors1.eta), eta1, phi1,
+        layout_offsets(vectors2.eta), eta2, phi2,
+        float(threshold),
+    )
+    matched = ak.unflatten(matched, ak.num(vectors1.eta, axis=1))
+
     # check per element in vectors1 if there is at least one matching element in vectors2
-    any_match = ak.any(dr < threshold, axis=axis)
+    any_match = matched >= 0
 
-    return any_match
+    return (any_match, matched) if return_indices else any_match
 
 
 def get_dataset_lfns(
@@ -60,12 +169,34 @@ def get_dataset_lfns(
         shift_inst: od.Shift,
         dataset_key: str,
 ) -> list[str]:
-    # destructure dataset_key into parts and create the lfn base directory
-    lfn_base = law.wlcg.WLCGDirectoryTarget(
-        dataset_key,
-        fs=f"local",
-    )
-    # loop though files and interpret paths as lfns
-    paths = [lfn_base.child(basename, type="f").path for basename in lfn_base.listdir(pattern="*.root")]
+    # files of the dataset directory, listed only when it changed since the last call
+    from httcp.dataset_index import DatasetIndex
+    return DatasetIndex(dataset_key, fs="local").paths()
+
+
+def load_analysis_insts(
+        analysis: str | None = None,
+        config: str | None = None,
+        dataset: str | None = None,
+) -> tuple[od.Analysis, od.Config, od.Dataset]:
+    """
+    Returns the analysis, config and dataset instances for usage outside of law tasks, defaulting
+    to the ones defined in the analysis section of the law.cfg.
+    """
+    analysis = analysis or law.config.get_expanded("analysis", "default_analysis")
+    module_name, attr = analysis.rsplit(".", 1)
+    analysis_inst = getattr(importlib.import_module(module_name), attr)
+    config_inst = analysis_inst.get_config(config or law.config.get_expanded("analysis", "default_config"))
+    dataset_inst = config_inst.get_dataset(dataset or law.config.get_expanded("analysis", "default_dataset"))
+    return analysis_inst, config_inst, dataset_inst
+
 
-    return paths
+def import_analysis_modules(*keys: str) -> None:
+    """
+    Imports the modules listed in the analysis section of the law.cfg under *keys* (e.g.
+    ``"selection_modules"``) so that the classes they define are registered.
+    """
+    for key in keys:
+        for mod in law.config.get_expanded("analysis", key, [], split_csv=True):
+            for name in law.util.brace_expand(mod.strip()):
+                importlib.import_module(name)
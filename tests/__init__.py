@@ -15,4 +15,4 @@ sys.path.append(base)
 import httcp  # noqa
 
 # import all tests
-# ...
+from .test_selection import *
@@ -0,0 +1,262 @@
+# coding: utf-8
+
+"""
+Equivalence tests of the selection kernels on synthetic events.
+"""
+
+__all__ = [
+    "CutTableTest", "PairRankingTest", "StepBitRegistryTest", "SelectorEquivalenceTest",
+]
+
+import operator
+import unittest
+from collections import defaultdict
+
+from columnflow.util import maybe_import
+from columnflow.production.util import attach_coffea_behavior
+
+from httcp.benchmark.synthetic import generate_events
+from httcp.selection.cut_tables import CutTable
+from httcp.selection.index_cache import sorted_indices
+from httcp.selection.pair_ranking import get_best_pair
+from httcp.selection.step_bits import StepBitRegistry
+from httcp.selection.physics_objects import MUON_CUTS, ELECTRON_CUTS, TAU_CUTS, apply_cut_table
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+N_EVENTS = 2000
+
+
+def reference_cuts(collection: ak.Array, cuts: list) -> dict[str, ak.Array]:
+    # cumulative masks per step name with plain awkward comparisons
+    steps = {}
+    mask = ak.ones_like(collection.pt, dtype=bool)
+    for name, variable, op, threshold, use_abs in cuts:
+        values = abs(collection[variable]) if use_abs else collection[variable]
+        mask = mask & OPERATORS[op](values, threshold)
+        steps[name] = mask
+    return steps
+
+
+class CutTableTest(unittest.TestCase):
+
+    def check_table(self, collection_name: str, selections: dict) -> None:
+        columns = {
+            f"{collection_name}.{cut[1]}"
+            for cuts in selections.values()
+            for cut in cuts
+        }
+        events = generate_events(columns, N_EVENTS, multiplicities={collection_name: 3.0})
+        table = CutTable(selections)
+        steps, index_lists = apply_cut_table(table, events, collection_name)
+
+        collection = events[collection_name]
+        pt_sorted = sorted_indices(events, collection_name)
+        for (sel_name, cuts), indices in zip(selections.items(), index_lists):
+            ref_steps = reference_cuts(collection, cuts)
+            ref_mask = ref_steps[cuts[-1][0]]
+            self.assertEqual(
+                ak.to_list(indices),
+                ak.to_list(pt_sorted[ref_mask[pt_sorted]]),
+                f"indices of selection '{sel_name}' of {collection_name} differ",
+            )
+            if sel_name == next(iter(selections)):
+                for name, mask in ref_steps.items():
+                    self.assertEqual(
+                        ak.to_list(steps[name]),
+                        ak.to_list(mask),
+                        f"step '{name}' differs",
+                    )
+
+    def test_muon(self):
+        self.check_table("Muon", MUON_CUTS)
+
+    def test_electron(self):
+        self.check_table("Electron", ELECTRON_CUTS)
+
+    def test_tau(self):
+        self.check_table("Tau", TAU_CUTS)
+
+    def test_overrides(self):
+        table = CutTable(MUON_CUTS, overrides={"good": {"muon_pt_26": 30.0}})
+        self.assertEqual(table.selections["good"][0][3], 30.0)
+        with self.assertRaises(ValueError):
+            CutTable(MUON_CUTS, overrides={"good": {"unknown_cut": 1.0}})
+
+
+class PairRankingTest(unittest.TestCase):
+
+    def test_best_pair(self):
+        events = generate_events(
+            {"Muon.pfRelIso04_all", "Muon.pt", "Tau.rawDeepTau2018v2p5VSjet", "Tau.pt"},
+            N_EVENTS,
+            multiplicities={"Muon": 2.0, "Tau": 3.0},
+        )
+        # coarse isolation values to produce ties that are resolved by the following criteria
+        coarse_iso = ak.values_astype(events.Muon.pfRelIso04_all * 10, np.int32) / 10.0
+        muons = ak.with_field(events.Muon, coarse_iso, "pfRelIso04_all")
+        pairs = ak.cartesian([muons, events.Tau], axis=1)
+        pair_indices = ak.argcartesian([muons, events.Tau], axis=1)
+        criteria = [
+            ("0", "pfRelIso04_all", True),
+            ("0", "pt", False),
+            ("1", "rawDeepTau2018v2p5VSjet", False),
+            ("1", "pt", False),
+        ]
+
+        best = ak.to_list(get_best_pair(pairs, pair_indices, criteria))
+
+        event_data = zip(ak.to_list(pairs), ak.to_list(pair_indices), best)
+        for event_pairs, event_indices, event_best in event_data:
+            if not event_pairs:
+                self.assertEqual(event_best, [])
+                continue
+            keys = [
+                tuple(pair[leg][field] * (1 if asc else -1) for leg, field, asc in criteria)
+                for pair in event_pairs
+            ]
+            # min returns the first of equal pairs, as the kernel does
+            ref = min(range(len(keys)), key=keys.__getitem__)
+            self.assertEqual(event_best, [event_indices[ref]["0"], event_indices[ref]["1"]])
+
+
+class StepBitRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = StepBitRegistry({
+            "event": ("json", "trigger", "b_veto"),
+            "Jet": ("jet_pt_30", "jet_puId", "btag"),
+        })
+
+    def test_event_bits(self):
+        rng = np.random.default_rng(1)
+        masks = {name: rng.random(100) < 0.5 for name in ("trigger", "b_veto")}
+        packed = self.registry.pack("event", masks, np.zeros(100))
+
+        self.assertEqual(packed.dtype, np.uint32)
+        for name, mask in masks.items():
+            bit = self.registry.mask("event", [name])
+            np.testing.assert_array_equal((packed & bit) == bit, mask)
+        # the json step was not applied and counts as passed
+        full = self.registry.mask("event")
+        np.testing.assert_array_equal((packed & full) == full, masks["trigger"] & masks["b_veto"])
+
+    def test_object_bits(self):
+        jets = generate_events({"Jet.pt"}, 100).Jet
+        masks = {"jet_pt_30": jets.pt > 30, "btag": jets.pt > 50}
+        packed = self.registry.pack("Jet", masks, jets)
+
+        self.assertEqual(ak.to_list(ak.num(packed, axis=1)), ak.to_list(ak.num(jets, axis=1)))
+        full = self.registry.mask("Jet")
+        self.assertEqual(
+            ak.to_list((packed & full) == full),
+            ak.to_list(masks["jet_pt_30"] & masks["btag"]),
+        )
+
+    def test_empty_masks(self):
+        jets = generate_events({"Jet.pt"}, 100).Jet
+        packed = self.registry.pack("Jet", {}, jets)
+        self.assertEqual(ak.to_list(ak.num(packed, axis=1)), ak.to_list(ak.num(jets, axis=1)))
+        self.assertTrue(ak.all(packed == self.registry.mask("Jet")))
+
+    def test_limits(self):
+        with self.assertRaises(ValueError):
+            StepBitRegistry({"event": [f"step_{i}" for i in range(65)]})
+        registry = StepBitRegistry({"event": [f"step_{i}" for i in range(40)]})
+        self.assertEqual(registry.dtype("event"), np.uint64)
+
+
+class SelectorEquivalenceTest(unittest.TestCase):
+    """
+    Compares the optional modes of the main selector to the default mode on synthetic events, using
+    the analysis, config and dataset of the law.cfg.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from httcp.util import load_analysis_insts, import_analysis_modules
+        from httcp.benchmark.suite import create_main, prepare
+
+        import_analysis_modules("selection_modules")
+        analysis_inst, config_inst, dataset_inst = load_analysis_insts()
+        cls.inst_dict = {
+            "analysis_inst": analysis_inst,
+            "config_inst": config_inst,
+            "dataset_inst": dataset_inst,
+        }
+        cls.main_inst = create_main(cls.inst_dict)
+        cls.events = generate_events(
+            cls.main_inst.used_columns - cls.main_inst.produced_columns,
+            N_EVENTS,
+            triggers=config_inst.x.triggers,
+        )
+        cls.inputs = prepare(cls.main_inst, cls.main_inst[attach_coffea_behavior](cls.events))
+
+    def run_main(self, name: str) -> tuple[ak.Array, object, dict]:
+        from columnflow.selection import Selector
+
+        selector_inst = Selector.get_cls(name)(inst_dict=self.inst_dict)
+        events = selector_inst[attach_coffea_behavior](self.events)
+        stats = defaultdict(float)
+        events, results = selector_inst(events, stats)
+        return events, results, stats
+
+    def test_batched_trigger_matching(self):
+        from httcp.selection.match_trigobj import match_trigobj, TRIGGER_FLAGS
+
+        outputs = []
+        for batched in (False, True):
+            outputs.append(self.main_inst[match_trigobj](
+                self.inputs["events"],
+                self.inputs["trigger_results"],
+                self.inputs["electron"],
+                self.inputs["muon"],
+                self.inputs["tau"],
+                domatch=True,
+                batched=batched,
+            ))
+        (loop_events, *loop_indices), (batched_events, *batched_indices) = outputs
+
+        for loop, batched in zip(loop_indices, batched_indices):
+            self.assertEqual(ak.to_list(loop), ak.to_list(batched))
+        for flag in TRIGGER_FLAGS.values():
+            self.assertEqual(ak.to_list(loop_events[flag]), ak.to_list(batched_events[flag]))
+
+    def test_progressive(self):
+        _, results, stats = self.run_main("main")
+        _, prog_results, prog_stats = self.run_main("main_progressive")
+
+        self.assertEqual(ak.to_list(results.event), ak.to_list(prog_results.event))
+        for key in ("num_events", "num_events_selected", "sum_mc_weight", "sum_mc_weight_selected"):
+            self.assertAlmostEqual(stats.get(key, 0), prog_stats.get(key, 0))
+        for key in ("num_events_selected_per_channel", "sum_mc_weight_selected_per_channel"):
+            self.assertEqual(
+                {k: v for k, v in stats.get(key, {}).items() if v},
+                {k: v for k, v in prog_stats.get(key, {}).items() if v},
+            )
+
+    def test_packed_steps(self):
+        from httcp.selection.main import step_bit_registry
+
+        _, results, _ = self.run_main("main")
+        packed_events, packed_results, _ = self.run_main("main_packed")
+
+        self.assertEqual(ak.to_list(results.event), ak.to_list(packed_results.event))
+        for name, step in results.steps.items():
+            bit = step_bit_registry.mask("event", [name])
+            passed = (packed_events.step_bits & bit) == bit
+            self.assertEqual(ak.to_list(passed), ak.to_list(step))
+        full = step_bit_registry.mask("event")
+        passed = (packed_events.step_bits & full) == full
+        self.assertEqual(ak.to_list(passed), ak.to_list(results.event))